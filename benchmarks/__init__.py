@@ -0,0 +1 @@
+"""Mediciones de rendimiento de los flujos de trabajo del curso."""
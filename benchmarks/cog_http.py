@@ -0,0 +1,214 @@
+"""Verifica ``cog_utils.leer_cog_http`` contra un servidor HTTP local.
+
+Escribe un COG sintético con ``cog_utils.escribir_cog``, lo publica con un
+servidor local que atiende solicitudes ``Range`` (HTTP/1.1, con hilos) y
+compara las lecturas por HTTP con las de rasterio sobre el archivo local:
+a resolución completa, en una vista general y con un ``bbox`` en
+EPSG:4326. Además comprueba que las teselas se pidan en menos solicitudes
+que teselas y que, sin combinar rangos, cada tesela cueste exactamente una
+solicitud: si cambia la forma en que GDAL guarda o lee las teselas (los
+bytes de más que agrega ``_rangos_teselas``), GDAL vuelve a pedirlas una a
+una y la verificación falla.
+
+Uso, desde la raíz del repositorio::
+
+    python -m benchmarks.cog_http
+
+Termina con código 1 si alguna verificación falla. Requiere ``urllib3``,
+igual que ``leer_cog_http``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import rasterio
+import xarray as xr
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+from utils import cog_utils
+
+# Lado (en píxeles) del COG sintético; con teselas de 512 tiene varias vistas
+LADO = 4096
+
+
+class _ManejadorRangos(BaseHTTPRequestHandler):
+    """Sirve los archivos de ``directorio`` atendiendo encabezados ``Range``."""
+
+    protocol_version = "HTTP/1.1"
+    directorio = "."
+
+    def log_message(self, *argumentos):
+        pass
+
+    def _ruta(self) -> str:
+        nombre = os.path.basename(self.path.split("?", 1)[0])
+        return os.path.join(self.directorio, nombre)
+
+    def _sin_archivo(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        ruta = self._ruta()
+        if not os.path.isfile(ruta):
+            return self._sin_archivo()
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(ruta)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        ruta = self._ruta()
+        if not os.path.isfile(ruta):
+            return self._sin_archivo()
+        total = os.path.getsize(ruta)
+        rango = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        with open(ruta, "rb") as archivo:
+            if rango:
+                inicio = int(rango.group(1))
+                fin = min(int(rango.group(2) or total - 1), total - 1)
+                archivo.seek(inicio)
+                datos = archivo.read(fin - inicio + 1)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {inicio}-{fin}/{total}")
+            else:
+                datos = archivo.read()
+                self.send_response(200)
+        self.send_header("Content-Length", str(len(datos)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        self.wfile.write(datos)
+
+
+def servir(directorio: str) -> ThreadingHTTPServer:
+    """Publica ``directorio`` en un puerto libre de ``127.0.0.1``."""
+    manejador = type("Manejador", (_ManejadorRangos,), {"directorio": directorio})
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+def _cog_sintetico(ruta: str, lado: int = LADO) -> str:
+    """Escribe un COG ``uint16`` de una banda en EPSG:32719 (10 m)."""
+    filas, columnas = np.mgrid[0:lado, 0:lado]
+    ruido = np.random.default_rng(0).integers(0, 300, (lado, lado))
+    valores = 1000 + 800 * np.sin(filas / 97) + 600 * np.cos(columnas / 53) + ruido
+    raster = xr.DataArray(
+        valores.astype(np.uint16),
+        dims=("y", "x"),
+        coords={
+            "y": 7_000_000 - 10 * np.arange(lado) - 5,
+            "x": 300_000 + 10 * np.arange(lado) + 5,
+        },
+    )
+    raster = raster.rio.write_crs("EPSG:32719").rio.write_nodata(0)
+    return cog_utils.escribir_cog(raster, ruta)
+
+
+def verificar(ruta: str, url: str) -> list:
+    """Ejecuta las verificaciones; devuelve ``(nombre, correcto, detalle)``."""
+    resultados = []
+
+    def _registrar(nombre, correcto, reporte):
+        detalle = f"{reporte['solicitudes']} solicitudes, {reporte['teselas']} teselas"
+        resultados.append((nombre, bool(correcto), detalle))
+
+    # Resolución completa: una ventana de varias teselas
+    ventana = Window(1000, 1500, 1800, 1300)
+    leido, reporte = cog_utils.leer_cog_http(url, ventana=ventana, informar=False)
+    with rasterio.open(ruta) as src:
+        esperado = src.read(window=ventana)
+        transform = src.window_transform(ventana)
+    _registrar(
+        "ventana a resolución completa",
+        np.array_equal(leido.values, esperado)
+        and leido.rio.transform() == transform
+        and reporte["solicitudes"] < reporte["teselas"],
+        reporte,
+    )
+
+    # Vista general (la primera reducción a la mitad), archivo completo
+    leido, reporte = cog_utils.leer_cog_http(url, vista=0, informar=False)
+    with rasterio.open(ruta, overview_level=0) as src:
+        esperado = src.read()
+    _registrar("vista general", np.array_equal(leido.values, esperado), reporte)
+
+    # Extensión en EPSG:4326, como el bbox de una búsqueda STAC
+    with rasterio.open(ruta) as src:
+        xmin, ymin, xmax, ymax = src.bounds
+        ancho, alto = xmax - xmin, ymax - ymin
+        limites = transform_bounds(
+            src.crs,
+            "EPSG:4326",
+            xmin + 0.3 * ancho,
+            ymin + 0.3 * alto,
+            xmin + 0.6 * ancho,
+            ymin + 0.6 * alto,
+        )
+        ventana = rasterio.windows.from_bounds(
+            *transform_bounds("EPSG:4326", src.crs, *limites),
+            transform=src.transform,
+        )
+        ventana = ventana.round_offsets().round_lengths()
+        esperado = src.read(window=ventana)
+    leido, reporte = cog_utils.leer_cog_http(
+        url, ventana=limites, crs="EPSG:4326", informar=False
+    )
+    _registrar("bbox en EPSG:4326", np.array_equal(leido.values, esperado), reporte)
+
+    # Sin combinar rangos, cada tesela precargada debe bastarle a GDAL: las
+    # solicitudes son las del encabezado (medidas con una sola tesela) más
+    # una por tesela. Si los rangos no cubren lo que GDAL lee, vuelve a
+    # pedir cada tesela por su cuenta y sobran solicitudes
+    sin_combinar = {"hueco_max": 0, "max_bytes_solicitud": 1, "informar": False}
+    _, reporte = cog_utils.leer_cog_http(
+        url, ventana=Window(0, 0, 1, 1), **sin_combinar
+    )
+    encabezado = reporte["solicitudes"] - reporte["teselas"]
+    ventana = Window(512, 512, 1536, 1024)
+    leido, reporte = cog_utils.leer_cog_http(url, ventana=ventana, **sin_combinar)
+    with rasterio.open(ruta) as src:
+        esperado = src.read(window=ventana)
+    _registrar(
+        "una solicitud por tesela sin combinar",
+        np.array_equal(leido.values, esperado)
+        and reporte["solicitudes"] == encabezado + reporte["teselas"],
+        reporte,
+    )
+    return resultados
+
+
+def main(argumentos=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lado", type=int, default=LADO)
+    args = parser.parse_args(argumentos)
+
+    directorio = tempfile.mkdtemp(prefix="cog_http_")
+    servidor = servir(directorio)
+    try:
+        ruta = _cog_sintetico(os.path.join(directorio, "sintetico.tif"), args.lado)
+        url = f"http://127.0.0.1:{servidor.server_address[1]}/sintetico.tif"
+        resultados = verificar(ruta, url)
+    finally:
+        servidor.shutdown()
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    for nombre, correcto, detalle in resultados:
+        print(f"{'ok   ' if correcto else 'FALLA'} {nombre} ({detalle})")
+    return 0 if all(correcto for _, correcto, _ in resultados) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+"""Mide cada etapa del flujo raster de ``01_datos_raster.py``.
+
+Las etapas son las del cuaderno: abrir, valores únicos, recorte,
+estadísticas, reproyección, derivados de terreno y escritura. Se ejecutan
+sobre la cobertura de MapBiomas incluida en ``data/raster`` y sobre rasters
+sintéticos de 1024² a 32768² píxeles, para ver dónde deja de escalar cada
+etapa. Por cada etapa se registra el tiempo de reloj, el pico de memoria
+residente (RSS) y los bytes leídos, y los resultados se guardan en JSON.
+
+Además de las dependencias de los cuadernos requiere ``psutil`` (``pip
+install psutil``), que se usa para medir la memoria y las lecturas.
+
+Uso, desde la raíz del repositorio::
+
+    python -m benchmarks.pipeline_raster --tamanos 1024 4096 --salida base.json
+    python -m benchmarks.pipeline_raster --tamanos 1024 4096 --comparar base.json
+
+Con ``--comparar`` el programa termina con código 1 si alguna etapa tardó
+más de ``--tolerancia`` veces lo registrado en el archivo de referencia.
+Los bytes leídos incluyen lo que el sistema operativo entrega desde su caché
+de páginas (``bytes_leidos``); ``bytes_disco`` cuenta solo las lecturas que
+llegaron al disco.
+
+La etapa de reproyección usa ``rio.reproject`` igual que el cuaderno, que
+carga el raster completo en memoria: mide ese costo a propósito, y en los
+tamaños mayores su pico de RSS es el que marca el límite del flujo.
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psutil
+import rasterio
+
+from utils import cog_utils, raster_utils, terrain_utils
+
+COBERTURA = os.path.join("data", "raster", "chile_coverage_2018s.tif")
+
+# Lados (en píxeles) de los rasters sintéticos
+TAMANOS = (1024, 2048, 4096, 8192, 16384, 32768)
+
+ETAPAS = (
+    "abrir",
+    "unicos",
+    "recorte",
+    "estadisticas",
+    "reproyeccion",
+    "terreno",
+    "escritura",
+)
+
+# Lado de las teselas de dask para los derivados de terreno
+LADO_TESELA = 2048
+
+# Intervalo de muestreo de la memoria residente, en segundos
+INTERVALO_RSS = 0.005
+
+
+class _Medicion:
+    """Mide tiempo, pico de RSS y bytes leídos del proceso en un bloque ``with``.
+
+    El RSS se muestrea en un hilo aparte, porque el pico que informa el
+    sistema operativo es el de toda la vida del proceso y no el de la etapa.
+    """
+
+    def __init__(self):
+        self._proceso = psutil.Process()
+        self._detener = threading.Event()
+        self.rss_pico = 0
+
+    def _muestrear(self):
+        while not self._detener.is_set():
+            self.rss_pico = max(self.rss_pico, self._proceso.memory_info().rss)
+            self._detener.wait(INTERVALO_RSS)
+
+    def __enter__(self):
+        self.rss_inicial = self._proceso.memory_info().rss
+        self.rss_pico = self.rss_inicial
+        self._io_inicial = self._proceso.io_counters()
+        self._hilo = threading.Thread(target=self._muestrear, daemon=True)
+        self._hilo.start()
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.segundos = time.perf_counter() - self._inicio
+        self._detener.set()
+        self._hilo.join()
+        self.rss_pico = max(self.rss_pico, self._proceso.memory_info().rss)
+        io_final = self._proceso.io_counters()
+        self.bytes_leidos = io_final.read_chars - self._io_inicial.read_chars
+        self.bytes_disco = io_final.read_bytes - self._io_inicial.read_bytes
+        return False
+
+
+def _raster_sintetico(lado: int, directorio: str) -> str:
+    """Escribe (una sola vez) un raster categórico sintético de ``lado``².
+
+    Es un DEM sintético clasificado en franjas de altura con códigos de
+    MapBiomas, en EPSG:4326 y con la misma extensión de un grado para todos
+    los tamaños, guardado como GeoTIFF comprimido en teselas como la
+    cobertura original.
+    """
+    ruta = os.path.join(directorio, f"sintetico_{lado}.tif")
+    if os.path.exists(ruta):
+        return ruta
+    dem = raster_utils.generar_dem_sintetico(
+        filas=lado,
+        columnas=lado,
+        resolucion=1.0 / lado,
+        origen=(-71.5, -33.5),
+        crs="EPSG:4326",
+        colinas=[
+            {
+                "fila": lado / 2,
+                "columna": lado / 2,
+                "altura": 400.0,
+                "pendiente": 800.0 / lado,
+            }
+        ],
+        semilla=0,
+        chunks=2048,
+        dtype="float32",
+    )
+    codigos = np.array(sorted(raster_utils.LEYENDA_MAPBIOMAS), dtype=np.uint8)
+    clases = dem.copy(
+        data=dem.data.map_blocks(
+            lambda b: codigos[(b // 25).astype(np.int64) % codigos.size],
+            dtype=np.uint8,
+        )
+    )
+    temporal = ruta + ".tmp"
+    clases.rio.to_raster(
+        temporal,
+        driver="GTiff",
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        compress="DEFLATE",
+        windowed=True,
+        lock=threading.Lock(),
+    )
+    os.replace(temporal, ruta)
+    return ruta
+
+
+def _ejecutar_etapas(ruta: str, directorio: str):
+    """Ejecuta las etapas en orden; entrega ``(etapa, medición)`` de cada una."""
+    with rasterio.open(ruta) as src:
+        xmin, ymin, xmax, ymax = src.bounds
+    ancho, alto = xmax - xmin, ymax - ymin
+    salida = os.path.join(directorio, "escritura.tif")
+
+    with _Medicion() as medicion:
+        raster = raster_utils.abrir_raster(ruta)
+    yield "abrir", medicion
+
+    with _Medicion() as medicion:
+        raster_utils.valores_unicos(raster)
+    yield "unicos", medicion
+
+    with _Medicion() as medicion:
+        raster_utils.leer_ventana(
+            ruta,
+            limites=(
+                xmin + ancho * 0.25,
+                ymin + alto * 0.25,
+                xmin + ancho * 0.75,
+                ymin + alto * 0.75,
+            ),
+        )
+    yield "recorte", medicion
+
+    with _Medicion() as medicion:
+        raster_utils.estadisticas_raster(raster)
+    yield "estadisticas", medicion
+
+    # Reproyección en memoria, como en el cuaderno (ver la nota del módulo)
+    with _Medicion() as medicion:
+        reproyectado = raster.squeeze("band", drop=True).rio.reproject("EPSG:32719")
+    yield "reproyeccion", medicion
+
+    # Los productos se calculan por teselas y se reducen a su media, para que
+    # la etapa mida el kernel sin acumular tres capas float32 en memoria
+    with _Medicion() as medicion:
+        terreno = terrain_utils.derivados_terreno(
+            reproyectado.chunk({"y": LADO_TESELA, "x": LADO_TESELA}),
+            ["pendiente", "aspecto", "sombreado"],
+        )
+        terreno.mean().compute()
+    yield "terreno", medicion
+
+    with _Medicion() as medicion:
+        cog_utils.escribir_cog(reproyectado, salida, validar=False)
+    yield "escritura", medicion
+    os.remove(salida)
+
+
+def _entorno() -> dict:
+    """Versión del código y del equipo en que se midió."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "nucleos": os.cpu_count(),
+        "memoria_gb": round(psutil.virtual_memory().total / 2**30, 1),
+    }
+
+
+def medir(entradas: dict, repeticiones: int = 1, directorio: str | None = None) -> list:
+    """Mide todas las etapas sobre cada entrada.
+
+    Parameters
+    ----------
+    entradas : dict
+        ``{nombre: ruta}`` de los rasters a medir.
+    repeticiones : int
+        Veces que se repite el flujo completo; se informa la mediana del
+        tiempo y el máximo del pico de RSS y de los bytes leídos.
+    directorio : str, optional
+        Carpeta para los archivos intermedios.
+
+    Returns
+    -------
+    list of dict
+        Un registro por entrada y etapa.
+    """
+    directorio = directorio or tempfile.mkdtemp(prefix="bench_raster_")
+    registros = []
+    for nombre, ruta in entradas.items():
+        with rasterio.open(ruta) as src:
+            pixeles = src.width * src.height
+        mediciones = {etapa: [] for etapa in ETAPAS}
+        for _ in range(repeticiones):
+            for etapa, medicion in _ejecutar_etapas(ruta, directorio):
+                mediciones[etapa].append(medicion)
+        for etapa in ETAPAS:
+            segundos = statistics.median(m.segundos for m in mediciones[etapa])
+            registro = {
+                "entrada": nombre,
+                "pixeles": pixeles,
+                "etapa": etapa,
+                "segundos": segundos,
+                "ns_por_pixel": segundos * 1e9 / pixeles,
+                "rss_pico_mb": max(m.rss_pico for m in mediciones[etapa]) / 2**20,
+                "rss_incremento_mb": max(
+                    m.rss_pico - m.rss_inicial for m in mediciones[etapa]
+                )
+                / 2**20,
+                "bytes_leidos": max(m.bytes_leidos for m in mediciones[etapa]),
+                "bytes_disco": max(m.bytes_disco for m in mediciones[etapa]),
+            }
+            registros.append(registro)
+            print(
+                f"{nombre:>16} {etapa:>13} {segundos:9.3f} s "
+                f"{registro['ns_por_pixel']:8.1f} ns/px "
+                f"{registro['rss_pico_mb']:9.1f} MB "
+                f"{registro['bytes_leidos'] / 2**20:9.1f} MB leídos",
+                flush=True,
+            )
+    return registros
+
+
+def comparar(actual: list, referencia: list, tolerancia: float) -> list:
+    """Etapas que tardaron más de ``tolerancia`` veces que en ``referencia``."""
+    base = {(r["entrada"], r["etapa"]): r["segundos"] for r in referencia}
+    regresiones = []
+    for registro in actual:
+        previo = base.get((registro["entrada"], registro["etapa"]))
+        if previo and registro["segundos"] > tolerancia * previo:
+            regresiones.append(
+                {
+                    "entrada": registro["entrada"],
+                    "etapa": registro["etapa"],
+                    "segundos": registro["segundos"],
+                    "referencia": previo,
+                    "razon": registro["segundos"] / previo,
+                }
+            )
+    return regresiones
+
+
+def main(argumentos=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--tamanos",
+        type=int,
+        nargs="*",
+        default=list(TAMANOS),
+        help="lados de los rasters sintéticos (vacío para omitirlos)",
+    )
+    parser.add_argument(
+        "--sin-cobertura",
+        action="store_true",
+        help="no medir la cobertura de MapBiomas incluida en el repositorio",
+    )
+    parser.add_argument("--repeticiones", type=int, default=1)
+    parser.add_argument(
+        "--datos",
+        default=os.path.join(tempfile.gettempdir(), "geomatica-bench"),
+        help="carpeta donde se guardan (y reutilizan) los rasters sintéticos",
+    )
+    parser.add_argument("--salida", default="resultados_benchmark.json")
+    parser.add_argument("--comparar", help="JSON de una medición anterior")
+    parser.add_argument("--tolerancia", type=float, default=1.25)
+    args = parser.parse_args(argumentos)
+
+    os.makedirs(args.datos, exist_ok=True)
+    entradas = {}
+    if not args.sin_cobertura:
+        entradas["cobertura"] = COBERTURA
+    for lado in args.tamanos:
+        print(f"Preparando raster sintético de {lado}x{lado}...", flush=True)
+        entradas[f"sintetico_{lado}"] = _raster_sintetico(lado, args.datos)
+
+    intermedios = tempfile.mkdtemp(prefix="bench_raster_")
+    try:
+        registros = medir(entradas, args.repeticiones, intermedios)
+    finally:
+        shutil.rmtree(intermedios, ignore_errors=True)
+
+    with open(args.salida, "w") as archivo:
+        json.dump({"entorno": _entorno(), "resultados": registros}, archivo, indent=2)
+    print(f"Resultados guardados en {args.salida}")
+
+    if args.comparar:
+        with open(args.comparar) as archivo:
+            referencia = json.load(archivo)["resultados"]
+        regresiones = comparar(registros, referencia, args.tolerancia)
+        for r in regresiones:
+            print(
+                f"Regresión en {r['entrada']}/{r['etapa']}: {r['segundos']:.3f} s "
+                f"frente a {r['referencia']:.3f} s ({r['razon']:.2f}x)"
+            )
+        if regresiones:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
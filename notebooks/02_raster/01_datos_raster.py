@@ -10,7 +10,7 @@
 # %%
 # @title Instalación de paquetes necesarios
 # Necesitamos instalar las librerías necesarias para trabajar con datos raster.
-# %pip install rioxarray xarray matplotlib numpy rasterio xarray-spatial geopandas
+# %pip install rioxarray xarray matplotlib numpy rasterio xarray-spatial geopandas dask
 
 # %%
 # @title Importación de bibliotecas
@@ -20,11 +20,6 @@ import os
 
 import matplotlib.pyplot as plt
 import numpy as np
-import rioxarray as rxr
-import xarray as xr
-
-# Importamos xarray-spatial para cálculos de productos derivados de DEM
-import xrspatial
 
 # Configuración para visualización
 plt.rcParams["figure.figsize"] = (12, 8)
@@ -34,6 +29,21 @@ plt.style.use("ggplot")
 os.system("git clone https://github.com/alvaroparedesl/geomatica-aplicada.git")
 # %cd geomatica-aplicada
 
+# Funciones de apoyo del curso (carpeta utils del repositorio)
+from utils import (
+    cache_utils,
+    cog_utils,
+    focal_utils,
+    hydro_utils,
+    landscape_utils,
+    plot_utils,
+    proximity_utils,
+    raster_utils,
+    sampling_utils,
+    terrain_utils,
+    vector_utils,
+)
+
 
 # %% [markdown]
 # ## 1. ¿Qué son los datos raster?
@@ -68,26 +78,15 @@ os.system("git clone https://github.com/alvaroparedesl/geomatica-aplicada.git")
 # Vamos a crear un raster simple utilizando NumPy y rioxarray:
 
 # %%
-# Creamos una matriz de datos simple (elevación simulada)
-datos = np.zeros((100, 100))
-
-# Agregamos algunas características
-for i in range(100):
-    for j in range(100):
-        # Simulamos una colina
-        dist_centro = np.sqrt((i - 50) ** 2 + (j - 50) ** 2)
-        datos[i, j] = 100 - dist_centro * 1.5
-
-        # Agregamos algo de ruido
-        datos[i, j] += np.random.normal(0, 5)
-
-# Valores negativos los convertimos a 0 (nivel del mar)
-datos[datos < 0] = 0
-
-# Convertimos a un DataArray de xarray
-raster = xr.DataArray(
-    data=datos, dims=["y", "x"], coords={"y": np.arange(100), "x": np.arange(100)}
-)
+# Creamos una matriz de datos simple (elevación simulada): una colina centrada
+# en el píxel (50, 50) que baja 1.5 m por píxel, más algo de ruido gaussiano.
+# Los valores negativos los convertimos a 0 (nivel del mar).
+#
+# En lugar de recorrer cada píxel con un ciclo `for`, la función
+# `generar_dem_sintetico` calcula la grilla completa con NumPy y devuelve
+# directamente un DataArray de xarray con CRS y transformación.
+# Con el argumento `chunks` puede generar grillas enormes por bloques (dask).
+raster = raster_utils.generar_dem_sintetico(filas=100, columnas=100, semilla=42)
 
 # Visualizamos el raster
 plt.figure(figsize=(10, 8))
@@ -113,8 +112,16 @@ archivo_cobertura = "data/raster/chile_coverage_2018s.tif"
 # ### Cargando y explorando los datos de cobertura de suelo
 
 # %%
-# Cargamos el archivo de cobertura con rioxarray
-cobertura = rxr.open_rasterio(archivo_cobertura)
+# Cargamos el archivo de cobertura de forma "perezosa": `abrir_raster` solo lee
+# los metadatos y divide el raster en chunks alineados con los bloques internos
+# del GeoTIFF; los píxeles se leen recién cuando se necesita un resultado.
+#
+# Aun así, cada sesión vuelve a descomprimir el GeoTIFF. `abrir_con_cache`
+# guarda una copia ya decodificada (.npy) y, desde la segunda vez, la abre
+# mapeada en memoria sin copiar ni descomprimir nada (también dividida en
+# chunks de dask). Compara el tiempo de apertura de la primera ejecución
+# (fallo) con el de las siguientes (acierto).
+cobertura = cache_utils.abrir_con_cache(archivo_cobertura)
 
 # Información básica del raster
 print("Información del raster de cobertura de suelo:")
@@ -123,18 +130,27 @@ print(f"Sistema de coordenadas: {cobertura.rio.crs}")
 print(f"Resolución: {cobertura.rio.resolution()}")
 print(f"Bounds: {cobertura.rio.bounds()}")
 
-# Visualizamos la cobertura
+# Visualizamos la cobertura.
+# `plot_utils.graficar` reemplaza a `.plot()`: antes de dibujar reduce el raster
+# a la resolución de la figura (con la clase más frecuente en datos categóricos
+# y el promedio en datos continuos), así el costo depende del tamaño de la
+# figura y no del raster.
 plt.figure(figsize=(12, 8))
-im = cobertura.squeeze().plot(cmap="terrain", add_colorbar=False)
+im = plot_utils.graficar(cobertura.squeeze(), cmap="terrain", add_colorbar=False)
 plt.title("Cobertura de Suelo de Chile (2018)")
 plt.xlabel("Longitud")
 plt.ylabel("Latitud")
 plt.colorbar(im, label="Clase de cobertura")
 plt.show()
 
-# Calculamos estadísticas básicas
+# Calculamos estadísticas básicas.
+# `estadisticas_raster` recorre el raster una sola vez (chunk a chunk y en
+# paralelo) y entrega mínimo, máximo, media, desviación estándar, píxeles sin
+# dato y los valores distintos; así no repetimos una lectura completa por cada
+# estadística.
+estadisticas = raster_utils.estadisticas_raster(cobertura)
 print("\nEstadísticas de la cobertura de suelo:")
-valores_unicos = np.unique(cobertura.values)
+valores_unicos = estadisticas["valores"]
 print(f"Clases de cobertura presentes: {valores_unicos}")
 
 # %% [markdown]
@@ -165,26 +181,96 @@ print(f"Clases de cobertura presentes: {valores_unicos}")
 
 # %%
 # 1. Recorte de un área de interés
-raster_recortado = cobertura.rio.clip_box(
-    minx=cobertura.x.min() + (cobertura.x.max() - cobertura.x.min()) * 0.25,
-    miny=cobertura.y.min() + (cobertura.y.max() - cobertura.y.min()) * 0.25,
-    maxx=cobertura.x.min() + (cobertura.x.max() - cobertura.x.min()) * 0.75,
-    maxy=cobertura.y.min() + (cobertura.y.max() - cobertura.y.min()) * 0.75,
+# En lugar de recortar el raster ya abierto con rio.clip_box, leer_ventana
+# traduce los límites a una ventana de píxeles y lee del disco solo los
+# bloques que la intersectan (también acepta una geometría y otro CRS)
+xmin, ymin, xmax, ymax = cobertura.rio.bounds()
+ancho, alto = xmax - xmin, ymax - ymin
+raster_recortado = raster_utils.leer_ventana(
+    archivo_cobertura,
+    limites=(
+        xmin + ancho * 0.25,
+        ymin + alto * 0.25,
+        xmin + ancho * 0.75,
+        ymin + alto * 0.75,
+    ),
 )
 
 # Visualizamos el recorte
 plt.figure(figsize=(10, 8))
-im = raster_recortado.squeeze().plot(add_colorbar=False)
+im = plot_utils.graficar(raster_recortado.squeeze(), add_colorbar=False)
 plt.title("Área de Interés Recortada")
 plt.colorbar(im)
 plt.show()
 
 # 2. Cálculo de estadísticas básicas
+# Reutilizamos las estadísticas calculadas en la sección 4: equivalen a
+# cobertura.min(), .max(), .mean() y .std(), sin volver a leer el raster.
 print("\nEstadísticas del raster:")
-print(f"Valor mínimo: {cobertura.min().values}")
-print(f"Valor máximo: {cobertura.max().values}")
-print(f"Valor promedio: {cobertura.mean().values:.2f}")
-print(f"Desviación estándar: {cobertura.std().values:.2f}")
+print(f"Valor mínimo: {estadisticas['minimo']:.0f}")
+print(f"Valor máximo: {estadisticas['maximo']:.0f}")
+print(f"Valor promedio: {estadisticas['media']:.2f}")
+print(f"Desviación estándar: {estadisticas['desviacion']:.2f}")
+
+# %%
+# 3. Agregación a una grilla más gruesa
+# Promediar códigos de clase no tiene sentido; agregar_categorico cuenta las
+# clases de cada bloque de 10x10 píxeles y entrega la clase dominante (moda),
+# la fracción de cada clase y la diversidad de Shannon de cada celda.
+agregado = raster_utils.agregar_categorico(cobertura, factor=10, nodata=0)
+
+fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
+agregado["moda"].plot(ax=ax1, cmap="tab20")
+ax1.set_title("Clase dominante (moda, 10x10 píxeles)")
+agregado["diversidad"].plot(ax=ax2, cmap="viridis")
+ax2.set_title("Diversidad de Shannon")
+plt.show()
+
+# %%
+# 4. Fragmentación del bosque
+# Un parche es un grupo de píxeles vecinos de la misma clase. `metricas_parches`
+# etiqueta los parches de Bosque (3) y Plantación Forestal (9) chunk por chunk
+# y entrega, por clase, el número de parches, su área, la densidad de borde y
+# el índice del parche mayor (porcentaje del paisaje que ocupa el parche más grande).
+metricas = landscape_utils.metricas_parches(cobertura, clases=(3, 9), nodata=0)
+metricas["clases"]
+
+# %%
+# 5. Distancia al agua
+# `distancia_a_clases` calcula, para cada píxel, la distancia en metros al
+# píxel más cercano de una o más clases, aquí Cuerpos de Agua (33). Es la
+# transformada de distancia exacta, calculada por columnas y luego por filas,
+# de modo que trabaja por chunks sin cortar las distancias en sus bordes.
+distancia_agua = proximity_utils.distancia_a_clases(cobertura, 33, nodata=0)
+plt.figure(figsize=(10, 8))
+plot_utils.graficar(distancia_agua / 1000, categorico=False, cmap="viridis")
+plt.title("Distancia al agua (km)")
+plt.show()
+
+# %%
+# 6. Estadísticas focales
+# `fracciones_focales` entrega, para cada píxel, la fracción de cada clase en
+# una ventana centrada en él. Con imágenes integrales el costo no depende del
+# tamaño de la ventana: aquí, un círculo de 31 píxeles de diámetro (~1 km).
+focal = focal_utils.fracciones_focales(
+    cobertura, 31, forma="circular", clases=[3], nodata=0
+)
+plt.figure(figsize=(10, 8))
+plot_utils.graficar(focal["fraccion"].sel(clase=3), categorico=False, cmap="Greens")
+plt.title("Fracción de bosque en un radio de ~500 m")
+plt.show()
+
+# %%
+# 7. Muestreo en puntos
+# Para extraer la clase en muchas parcelas o puntos GPS no se usa un `sel()`
+# por punto: `muestrear` convierte todas las coordenadas a fila y columna de
+# una vez y lee cada zona del raster una sola vez. Aquí, 100 000 puntos al azar.
+xmin, ymin, xmax, ymax = cobertura.rio.bounds()
+generador = np.random.default_rng(0)
+x_puntos = generador.uniform(xmin, xmax, 100_000)
+y_puntos = generador.uniform(ymin, ymax, 100_000)
+clases_puntos = sampling_utils.muestrear(archivo_cobertura, (x_puntos, y_puntos))
+np.unique(clases_puntos[:, 0], return_counts=True)
 
 # %% [markdown]
 # ## 6. Análisis de terreno con xarray-spatial
@@ -194,47 +280,58 @@ print(f"Desviación estándar: {cobertura.std().values:.2f}")
 # %%
 archivo_dem = "data/raster/Copernicus_DSM_COG_10_S35_00_W072_00_DEM.tif.tif"
 
-dem = rxr.open_rasterio(archivo_cobertura).squeeze()
+dem = raster_utils.abrir_raster(archivo_cobertura).squeeze()
 
 # Visualizamos el DEM
 plt.figure(figsize=(12, 8))
-im = dem.plot(cmap="terrain", add_colorbar=False)
+im = plot_utils.graficar(dem, categorico=False, cmap="terrain", add_colorbar=False)
 plt.title("Modelo Digital de Elevación (Ejemplo)")
 plt.colorbar(im, label="Elevación (m)")
 plt.show()
 
 # %%
 # Antes de calcular algunos derivados, vamos a reproyectar el DEM ¿por qué?
-dem = dem.rio.reproject("EPSG:32719")
+# La reproyección es el paso más lento del cuaderno; `reproyectar_con_cache`
+# guarda el resultado en disco y, si volvemos a ejecutar la celda con el mismo
+# DEM y los mismos parámetros, lo reutiliza de inmediato (un "acierto" de caché).
+dem = cache_utils.reproyectar_con_cache(dem, "EPSG:32719")
+# %%
+# xarray-spatial ofrece una función por producto (`xrspatial.slope`,
+# `xrspatial.aspect`, `xrspatial.hillshade`), pero cada una recalcula los mismos
+# gradientes del DEM en una ventana de 3x3. `derivados_terreno` calcula esos
+# gradientes una sola vez por píxel y entrega todos los productos pedidos en la
+# misma pasada (y por bloques en paralelo si el DEM es un arreglo de dask).
+terreno = terrain_utils.derivados_terreno(dem, ["pendiente", "aspecto", "sombreado"])
+
 # %%
-# Calculamos la pendiente con xarray-spatial
-pendiente = xrspatial.slope(dem)
+# La pendiente (equivale a xrspatial.slope(dem))
+pendiente = terreno["pendiente"]
 
 # Visualizamos la pendiente
 plt.figure(figsize=(10, 8))
-im = pendiente.plot(cmap="YlOrRd", add_colorbar=False)
+im = plot_utils.graficar(pendiente, cmap="YlOrRd", add_colorbar=False)
 plt.title("Mapa de Pendientes")
 plt.colorbar(im, label="Pendiente (grados)")
 plt.show()
 
 # %%
-# Calculamos la orientación (aspecto)
-aspecto = xrspatial.aspect(dem)
+# La orientación o aspecto (equivale a xrspatial.aspect(dem))
+aspecto = terreno["aspecto"]
 
 # Visualizamos la orientación
 plt.figure(figsize=(10, 8))
-im = aspecto.plot(cmap="twilight", add_colorbar=False)
+im = plot_utils.graficar(aspecto, cmap="twilight", add_colorbar=False)
 plt.title("Mapa de Orientación")
 plt.colorbar(im, label="Orientación (grados)")
 plt.show()
 
 # %%
-# Calculamos el sombreado del relieve (hillshade)
-sombreado = xrspatial.hillshade(dem)
+# El sombreado del relieve (hillshade), con el sol en azimut 225° y altitud 25°
+sombreado = terreno["sombreado"]
 
 # Visualizamos el sombreado
 plt.figure(figsize=(10, 8))
-im = sombreado.plot(cmap="gray", add_colorbar=False)
+im = plot_utils.graficar(sombreado, cmap="gray", add_colorbar=False)
 plt.title("Sombreado del Relieve")
 plt.colorbar(im)
 plt.show()
@@ -242,12 +339,34 @@ plt.show()
 # Visualización combinada: DEM con sombreado
 fig, ax = plt.subplots(figsize=(12, 8))
 dem_data = cobertura.squeeze()
-dem_plot = dem_data.plot(cmap="terrain", alpha=0.6, ax=ax, add_colorbar=False)
-sombreado.plot.imshow(cmap="gray", alpha=0.4, ax=ax)
+dem_plot = plot_utils.graficar(
+    dem_data, ax=ax, categorico=False, cmap="terrain", alpha=0.6, add_colorbar=False
+)
+plot_utils.graficar(sombreado, ax=ax, imshow=True, cmap="gray", alpha=0.4)
 plt.title("DEM con Sombreado del Relieve")
 plt.colorbar(dem_plot, label="Elevación (m)")
 plt.show()
 
+# %%
+# Hidrología: para delimitar cuencas primero se rellenan las depresiones del
+# DEM (para que el agua siempre pueda llegar al borde), luego se calcula hacia
+# qué vecino escurre cada celda (D8), cuántas celdas drenan a cada una
+# (acumulación) y, con un umbral de acumulación, la red de cauces con su orden
+# de Strahler. Todo se calcula por teselas en paralelo con `hydro_utils`.
+relleno = hydro_utils.rellenar_depresiones(dem)
+direccion = hydro_utils.direccion_flujo(relleno, metodo="d8")
+acumulacion = hydro_utils.acumulacion_flujo(direccion)
+cauces = hydro_utils.extraer_cauces(direccion, acumulacion, umbral=5000)
+
+fig, ax = plt.subplots(1, 2, figsize=(16, 7))
+plot_utils.graficar(np.log10(acumulacion), ax=ax[0], categorico=False, cmap="Blues")
+ax[0].set_title("Acumulación de flujo (log10 de celdas)")
+plot_utils.graficar(
+    cauces.where(cauces > 0), ax=ax[1], categorico=False, cmap="viridis"
+)
+ax[1].set_title("Red de cauces (orden de Strahler)")
+plt.show()
+
 # %% [markdown]
 # ## 7. Guardando un raster
 #
@@ -264,10 +383,25 @@ raster_path = os.path.join(directorio_resultados, "raster_recortado.tif")
 # Asignamos el CRS del raster original
 raster_recortado.rio.write_crs(cobertura.rio.crs, inplace=True)
 
-# Guardamos el archivo
-raster_recortado.rio.to_raster(raster_path)
+# Guardamos el archivo como GeoTIFF optimizado para la nube (COG): con teselas
+# internas, compresión y vistas generales (overviews), que se leen mucho más
+# rápido que un GeoTIFF plano como el que escribe `.rio.to_raster(raster_path)`.
+cog_utils.escribir_cog(raster_recortado, raster_path)
 
 print(f"Raster guardado en: {raster_path}")
+print(cog_utils.validar_cog(raster_path))
+
+# %%
+# También podemos entregar las clases de cobertura como polígonos para un SIG.
+# `poligonizar` procesa el raster por teselas, une los polígonos que cruzan los
+# bordes entre teselas y va escribiendo el archivo a medida que avanza, por lo
+# que sirve incluso para un mapa nacional. `simplificar` (en unidades del CRS,
+# aquí grados) suaviza los bordes sin dejar huecos entre polígonos vecinos.
+vector_path = os.path.join("resultados", "vector", "cobertura_recortada.gpkg")
+os.makedirs(os.path.dirname(vector_path), exist_ok=True)
+print(
+    vector_utils.poligonizar(raster_path, vector_path, nodata=0, simplificar=0.0005)
+)
 
 # %% [markdown]
 # ## 8. Resumen y conceptos clave
@@ -287,7 +421,8 @@ print(f"Raster guardado en: {raster_path}")
 # ## Ejercicios
 #
 # 1. Descarga otro conjunto de datos raster (por ejemplo, un DEM de otra región de Chile) y realiza un análisis básico.
-# 2. Si trabajas con datos de cobertura de suelo, calcula el porcentaje de cada clase de cobertura en el área de estudio.
-# 3. Utiliza xarray-spatial para calcular otros productos derivados del DEM, como la curvatura o la rugosidad del terreno.
+# 2. Si trabajas con datos de cobertura de suelo, calcula el porcentaje de cada clase de cobertura en el área de estudio. Compara tu resultado con `raster_utils.area_por_clase(cobertura, nodata=0)`, que entrega el área real en hectáreas de cada clase (considerando la latitud cuando el raster está en coordenadas geográficas).
+# 3. Utiliza xarray-spatial para calcular otros productos derivados del DEM, como la curvatura o la rugosidad del terreno. Compara tus resultados con los productos `"curvatura"` y `"rugosidad"` de `terrain_utils.derivados_terreno`.
 # 4. Crea un mapa que combine la cobertura de suelo con el sombreado del relieve para visualizar mejor la relación entre el uso del suelo y la topografía.
 # 4. Crea un mapa que combine la cobertura de suelo con el sombreado del relieve para visualizar mejor la relación entre el uso del suelo y la topografía.
+# 5. Descarga la cobertura de MapBiomas de otro año para la misma zona y compárala con la de 2018 usando `change_utils.matriz_transicion(cobertura, cobertura_otro_anio, nodata=0)`: ¿cuántas hectáreas de Bosque pasaron a Plantación Forestal? Con `change_utils.raster_cambio` puedes mapear dónde ocurrieron esos cambios.
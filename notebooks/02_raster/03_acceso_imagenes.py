@@ -18,7 +18,6 @@
 import os
 
 import matplotlib.pyplot as plt
-import numpy as np
 import odc.stac
 import planetary_computer
 from pystac_client import Client
@@ -31,6 +30,9 @@ plt.style.use("ggplot")
 os.system("git clone https://github.com/alvaroparedesl/geomatica-aplicada.git")
 # %cd geomatica-aplicada
 
+# Funciones de apoyo del curso (carpeta utils del repositorio)
+from utils import cog_utils, plot_utils, stac_utils
+
 # %% [markdown]
 # ## 1. Introducción a Planetary Computer
 #
@@ -48,16 +50,20 @@ os.system("git clone https://github.com/alvaroparedesl/geomatica-aplicada.git")
 # * Integración con herramientas de análisis
 
 # %%
-# Conectamos al catálogo STAC de Planetary Computer
-catalog = Client.open(
-    "https://planetarycomputer.microsoft.com/api/stac/v1",
-    modifier=planetary_computer.sign_inplace,
-)
+# Conectamos al catálogo STAC de Planetary Computer. Sin conexión
+# (GEOMATICA_OFFLINE=1) basta con su URL: las búsquedas se leen de la caché
+url_catalogo = "https://planetarycomputer.microsoft.com/api/stac/v1"
+if stac_utils.OFFLINE:
+    catalog = url_catalogo
+else:
+    catalog = Client.open(url_catalogo, modifier=planetary_computer.sign_inplace)
 
 # %% [markdown]
 # ## 2. Búsqueda de Imágenes Sentinel-2
 #
 # Vamos a buscar imágenes Sentinel-2 para un área de interés en Chile.
+#
+# Usamos `stac_utils.buscar_con_cache`, que recibe los mismos parámetros que `catalog.search` y guarda los ítems encontrados en disco: al volver a ejecutar la celda con la misma consulta no se espera al servidor. Con la variable de entorno `GEOMATICA_OFFLINE=1` (o `offline=True`) las búsquedas se responden solo desde la caché, sin conexión.
 
 # %%
 # Definimos el área de interés
@@ -66,16 +72,15 @@ bbox = [-71.399460, -34.366111, -70.633850, -34.084512]
 # Definimos el período de tiempo
 time_range = "2023-01-01/2023-01-31"
 
-# Realizamos la búsqueda
-search = catalog.search(
+# Realizamos la búsqueda (o la leemos de la caché si ya se hizo hoy)
+items = stac_utils.buscar_con_cache(
+    catalog,
     collections=["sentinel-2-l2a"],
     bbox=bbox,
     datetime=time_range,
     query={"eo:cloud_cover": {"lt": 20}},  # Menos de 20% de nubes
 )
-
-# Convertimos los resultados a un DataFrame para visualización
-items = list(search.get_items())
+items = list(items)
 print(f"Encontradas {len(items)} imágenes")
 
 # Mostramos información de la primera imagen
@@ -85,6 +90,33 @@ print(f"Fecha: {item.datetime.strftime('%Y-%m-%d')}")
 print(f"Cobertura de nubes: {item.properties['eo:cloud_cover']}%")
 print(f"ID de la imagen: {item.id}")
 
+# %% [markdown]
+# En búsquedas más grandes (varios años o todo el país) puede haber miles de ítems y `list(search.get_items())` espera a descargar todas las páginas. `stac_utils.iterar_items` entrega los ítems a medida que llegan (pidiendo la página siguiente mientras se procesa la actual) y deja de pedir páginas cuando salimos del ciclo. Con `primeros_por_grupo` nos quedamos, por ejemplo, con las tres escenas más recientes con menos de 10% de nubes de cada tesela Sentinel-2, sin recorrer el resto de la búsqueda.
+
+# %%
+# Teselas Sentinel-2 (MGRS) de la búsqueda anterior
+teselas = {item.properties["s2:mgrs_tile"] for item in items}
+
+# Esta búsqueda se recorre en vivo (no pasa por la caché): sin conexión se omite
+if stac_utils.OFFLINE:
+    print("Modo sin conexión: se omite la búsqueda paginada")
+else:
+    recientes = stac_utils.primeros_por_grupo(
+        stac_utils.iterar_items(
+            catalog,
+            collections=["sentinel-2-l2a"],
+            bbox=bbox,
+            datetime="2020-01-01/2023-12-31",
+            sortby="-properties.datetime",
+        ),
+        n=3,
+        grupo="s2:mgrs_tile",
+        filtro=lambda item: item.properties["eo:cloud_cover"] < 10,
+        grupos=teselas,
+    )
+    for tesela, escenas in recientes.items():
+        print(tesela, [escena.datetime.strftime("%Y-%m-%d") for escena in escenas])
+
 # %% [markdown]
 # ## 3. Acceso y Visualización de Imágenes Sentinel-2
 #
@@ -106,14 +138,23 @@ print(f"ID de la imagen: {item.id}")
 # | B11   | 1610                 | 20            | SWIR 1      |
 # | B12   | 2190                 | 20            | SWIR 2      |
 
-# %%
-# Cargamos las bandas RGB (color verdadero)
-rgb_bands = ["B04", "B03", "B02"]  # Rojo, Verde, Azul
+# %% [markdown]
+# Vamos a ver la misma escena en color verdadero, en falso color y como NDVI. Las composiciones comparten bandas (B04 y B03 están en las dos primeras), así que en vez de llamar a `odc.stac.load` por cada una, `stac_utils.cargar_bandas` carga una sola vez la unión de las bandas y `stac_utils.vistas_composiciones` entrega cada composición como una vista de ese mismo conjunto: agregar una visualización no agrega lecturas.
 
-# Cargamos los datos usando ODC
-ds = odc.stac.load(
+# %%
+# Composiciones (rojo, verde, azul) e índices (a - b) / (a + b) que vamos a mostrar
+composiciones = {
+    "color_verdadero": ["B04", "B03", "B02"],  # Rojo, Verde, Azul
+    "falso_color_nir": ["B08", "B04", "B03"],  # NIR, Rojo, Verde
+}
+indices = {"ndvi": ["B08", "B04"]}
+print("Bandas a cargar:", stac_utils.planificar_bandas(composiciones, indices))
+
+# Cargamos los datos usando ODC (una sola vez para todas las composiciones)
+ds = stac_utils.cargar_bandas(
     items,
-    bands=rgb_bands,
+    composiciones,
+    indices,
     bbox=bbox,
     crs="EPSG:32719",  # UTM Zone 19S
     resolution=10,  # 10m resolución
@@ -123,48 +164,81 @@ ds = odc.stac.load(
 ds
 
 # %%
-# Seleccionamos una fecha específica
+# Seleccionamos una fecha específica. La selección sigue siendo perezosa: no
+# la cargamos completa en memoria, sino que cada figura la reduce por bloques
+# a la resolución de la pantalla
 fecha = ds.time[0]
-imagen = ds.sel(time=fecha)
-
-# Visualizamos la imagen RGB
-# 1. to_array(): convierte el Dataset a DataArray
-# 2. transpose(): reordena de (band,y,x) a (y,x,band) para visualización
-# 3. * 0.0001: factor de escala para convertir a reflectancia
-# 4. * 3.5: factor de mejora de brillo (ajustable). Otra alternativa: np.cbrt(0.6 * band)
-# 5. clip(): asegura valores entre 0 y 1
-rgb = np.clip(imagen.to_array().values.transpose(1, 2, 0) * 0.0001 * 3.5, 0, 1)
+vistas = stac_utils.vistas_composiciones(ds.sel(time=fecha), composiciones, indices)
+imagen = vistas["color_verdadero"]
+
+# Visualizamos la imagen RGB con plot_utils.graficar_rgb, que:
+# 1. reduce cada banda a la resolución de la figura (por bloques, sin cargar la imagen completa)
+# 2. multiplica por 0.0001 (escala): factor para convertir a reflectancia
+# 3. multiplica por 3.5 (ganancia): factor de mejora de brillo (ajustable)
+# 4. recorta entre 0 y 1 y convierte a enteros de 0 a 255 (uint8), bloque a bloque
+plt.figure(figsize=(15, 10))
+im = plot_utils.graficar_rgb(
+    imagen,
+    escala=0.0001,
+    ganancia=3.5,
+    titulo=f"Imagen Sentinel-2 RGB - Color verdadero ({fecha.values})",
+)
+plt.show()
 
+# %%
+# En vez de una ganancia fija, podemos estirar entre los percentiles 2 y 98 y
+# elegir el gamma automáticamente (ambos calculados sobre una muestra de píxeles)
 plt.figure(figsize=(15, 10))
-im = plt.imshow(rgb)
-plt.title(f"Imagen Sentinel-2 RGB - Color verdadero ({fecha.values})")
-plt.axis("off")
+im = plot_utils.graficar_rgb(
+    imagen,
+    percentiles=(2, 98),
+    gamma="auto",
+    titulo=f"Color verdadero con estiramiento 2-98% ({fecha.values})",
+)
 plt.show()
 
 # %%
-# Visualización en falso color (NIR)
-nir_bands = ["B08", "B04", "B03"]  # NIR, Rojo, Verde
+# Visualización en falso color (NIR): es una vista de las bandas ya cargadas
+imagen_nir = vistas["falso_color_nir"]
 
-# Cargamos los datos
-ds_nir = odc.stac.load(
-    items,
-    bands=nir_bands,
-    bbox=bbox,
-    crs="EPSG:32719",
-    resolution=10,
-    group_by="solar_day",
-    chunks={"x": 2048, "y": 2048},  # Tamaño de los chunks
+# Visualizamos la imagen en falso color
+plt.figure(figsize=(15, 10))
+im = plot_utils.graficar_rgb(
+    imagen_nir,
+    escala=0.0001,
+    ganancia=3.5,
+    titulo=f"Imagen Sentinel-2 - Falso color NIR ({fecha.values})",
 )
+plt.show()
 
-# Seleccionamos la misma fecha
-imagen_nir = ds_nir.sel(time=fecha)
+# %%
+# NDVI de la misma fecha, calculado sobre las mismas bandas y reducido a la
+# resolución de la figura
+plt.figure(figsize=(15, 10))
+plot_utils.graficar(
+    vistas["ndvi"], categorico=False, imshow=True, cmap="RdYlGn", vmin=-0.2, vmax=0.9
+)
+plt.title(f"NDVI Sentinel-2 ({fecha.values})")
+plt.axis("off")
+plt.show()
 
-# Visualizamos la imagen en falso color
-nir_rgb = np.clip(imagen_nir.to_array().values.transpose(1, 2, 0) * 0.0001 * 3.5, 0, 1)
+# %% [markdown]
+# ### Lectura directa de un COG por HTTP
+#
+# Cada banda de un ítem es un COG en la nube. Al leer una zona, GDAL pide por HTTP los rangos de bytes de las teselas internas que la cubren, a menudo en muchas solicitudes pequeñas y una tras otra. `cog_utils.leer_cog_http` calcula de antemano los rangos de todas las teselas de la ventana, une los vecinos en menos solicitudes y las pide en paralelo reutilizando las conexiones abiertas con el servidor. Al final informa cuántas solicitudes se hicieron, cuántos bytes se transfirieron y el caudal logrado.
+
+# %%
+# Banda roja (B04) de la primera imagen, recortada a nuestra área de interés
+b04, reporte = cog_utils.leer_cog_http(
+    item.assets["B04"].href, ventana=bbox, crs="EPSG:4326"
+)
+print(reporte)
 
 plt.figure(figsize=(15, 10))
-im = plt.imshow(nir_rgb)
-plt.title(f"Imagen Sentinel-2 - Falso color NIR ({fecha.values})")
+plot_utils.graficar(
+    b04.squeeze("band"), categorico=False, imshow=True, cmap="Reds_r", robust=True
+)
+plt.title(f"B04 leída por HTTP ({item.datetime.strftime('%Y-%m-%d')})")
 plt.axis("off")
 plt.show()
 
@@ -175,7 +249,8 @@ plt.show()
 
 # %%
 # Búsqueda de imágenes Landsat
-search_landsat = catalog.search(
+items_landsat = stac_utils.buscar_con_cache(
+    catalog,
     collections=["landsat-c2-l2"],
     bbox=bbox,
     datetime=time_range,
@@ -184,8 +259,7 @@ search_landsat = catalog.search(
         "platform": {"in": ["landsat-8", "landsat-9"]},
     },
 )
-
-items_landsat = list(search_landsat.get_items())
+items_landsat = list(items_landsat)
 print(f"Encontradas {len(items_landsat)} imágenes Landsat")
 
 info = items_landsat[0].assets["blue"].to_dict()["raster:bands"][0]
@@ -216,21 +290,15 @@ if len(items_landsat) > 0:
     fecha_landsat = ds_landsat.time[1]
     imagen_landsat = ds_landsat.sel(time=fecha_landsat)
 
-    # Visualizamos la imagen RGB de Landsat
-    rgb_landsat = np.clip(
-        (
-            imagen_landsat.to_array().values.transpose(1, 2, 0) * info["scale"]
-            + info["offset"]
-        )
-        * 3.5,
-        0,
-        1,
-    )
-
+    # Visualizamos la imagen RGB de Landsat (con su propia escala y desplazamiento)
     plt.figure(figsize=(15, 10))
-    im = plt.imshow(rgb_landsat)
-    plt.title(f"Imagen Landsat 8 RGB - Color verdadero ({fecha_landsat.values})")
-    plt.axis("off")
+    im = plot_utils.graficar_rgb(
+        imagen_landsat,
+        escala=info["scale"],
+        desplazamiento=info["offset"],
+        ganancia=3.5,
+        titulo=f"Imagen Landsat 8 RGB - Color verdadero ({fecha_landsat.values})",
+    )
     plt.show()
 
 # %% [markdown]
@@ -0,0 +1,6 @@
+"""Funciones de utilidad para los cuadernos del curso de Geomática Aplicada.
+
+Los módulos se importan de forma explícita desde los cuadernos, por ejemplo::
+
+    from utils import raster_utils
+"""
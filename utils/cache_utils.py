@@ -0,0 +1,423 @@
+"""Cachés en disco para resultados raster costosos de recalcular.
+
+Los archivos se guardan en ``DIRECTORIO_CACHE`` (configurable con la
+variable de entorno ``GEOMATICA_CACHE``), de modo que una carpeta compartida
+permite que otros analistas reutilicen los mismos resultados.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+import xarray as xr
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from . import raster_utils
+
+DIRECTORIO_CACHE = os.environ.get(
+    "GEOMATICA_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "geomatica-aplicada"),
+)
+
+# Tamaño máximo por defecto de cada caché, en gigabytes
+MAX_GB_CACHE = 5.0
+
+
+def _hash_raster(raster: xr.DataArray) -> str:
+    """Huella de un raster, incluida su georreferenciación.
+
+    Los píxeles solo se leen si el raster está en memoria. Un arreglo de
+    dask se identifica por su nombre, que ya resume el grafo que lo produce
+    (archivo de origen, fecha de modificación, chunks y operaciones), y por
+    la ruta, fecha y tamaño del archivo de origen si se conoce; así una
+    llamada repetida no vuelve a leer ni a descomprimir el raster completo.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    crs = raster.rio.crs
+    h.update(
+        json.dumps(
+            {
+                "forma": list(raster.shape),
+                "dims": list(raster.dims),
+                "dtype": str(raster.dtype),
+                "transform": list(raster.rio.transform())[:6],
+                "crs": crs.to_wkt() if crs is not None else None,
+                "nodata": repr(raster.rio.nodata),
+            }
+        ).encode()
+    )
+    datos = raster.data
+    if hasattr(datos, "dask"):
+        origen = raster.encoding.get("source")
+        if origen is not None and os.path.exists(origen):
+            estado = os.stat(origen)
+            h.update(
+                json.dumps(
+                    [os.path.abspath(origen), estado.st_mtime_ns, estado.st_size]
+                ).encode()
+            )
+        h.update(datos.name.encode())
+    else:
+        h.update(np.ascontiguousarray(datos).data)
+    return h.hexdigest()
+
+
+def _desalojar_lru(
+    directorio: str, max_bytes: float, extensiones: tuple, conservar: str | None = None
+) -> list:
+    """Elimina los archivos usados hace más tiempo hasta bajar de ``max_bytes``.
+
+    La fecha de modificación de cada archivo se actualiza en cada acierto,
+    por lo que funciona como marca de último uso (LRU). Los archivos de un
+    mismo resultado comparten el nombre base y se eliminan juntos; el
+    resultado ``conservar`` (recién escrito) nunca se elimina.
+    """
+    entradas = {}
+    reservado = 0
+    for nombre in os.listdir(directorio):
+        if not nombre.endswith(extensiones):
+            continue
+        ruta = os.path.join(directorio, nombre)
+        base = nombre.split(".", 1)[0]
+        estado = os.stat(ruta)
+        if base == conservar:
+            reservado += estado.st_size
+            continue
+        tamano, uso, rutas = entradas.get(base, (0, 0.0, []))
+        entradas[base] = (
+            tamano + estado.st_size,
+            max(uso, estado.st_mtime),
+            rutas + [ruta],
+        )
+
+    total = reservado + sum(tamano for tamano, _, _ in entradas.values())
+    eliminados = []
+    for base, (tamano, _, rutas) in sorted(entradas.items(), key=lambda e: e[1][1]):
+        if total <= max_bytes:
+            break
+        for ruta in rutas:
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+        total -= tamano
+        eliminados.append(base)
+    return eliminados
+
+
+def _grilla_destino(resolucion, extension):
+    """Transformación y forma de la grilla de destino, si se fija la extensión."""
+    if extension is None:
+        return None, None
+    if resolucion is None:
+        raise ValueError("para fijar la extensión también se requiere la resolución")
+    xmin, ymin, xmax, ymax = extension
+    res_x, res_y = (resolucion, resolucion) if np.isscalar(resolucion) else resolucion
+    transform = Affine(res_x, 0.0, xmin, 0.0, -abs(res_y), ymax)
+    forma = (math.ceil((ymax - ymin) / abs(res_y)), math.ceil((xmax - xmin) / res_x))
+    return transform, forma
+
+
+def reproyectar_con_cache(
+    raster: xr.DataArray,
+    crs_destino: str,
+    resolucion: float | tuple | None = None,
+    remuestreo: Resampling = Resampling.nearest,
+    extension: tuple | None = None,
+    directorio: str | None = None,
+    max_gb: float = MAX_GB_CACHE,
+    informar: bool = True,
+) -> xr.DataArray:
+    """Reproyecta un raster reutilizando resultados guardados en disco.
+
+    La clave de la caché combina la huella del raster de origen,
+    el CRS de destino, la resolución, el método de remuestreo y la
+    extensión. Si ya existe un resultado con esa clave se abre directamente
+    (acierto); si no, se reproyecta, se guarda como GeoTIFF en teselas y se
+    eliminan los resultados usados hace más tiempo hasta respetar
+    ``max_gb`` (fallo).
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Raster de origen con CRS.
+    crs_destino : str
+        CRS de destino, por ejemplo ``"EPSG:32719"``.
+    resolucion : float or tuple, optional
+        Resolución de destino en unidades del CRS de destino.
+    remuestreo : rasterio.enums.Resampling
+        Método de remuestreo (vecino más cercano por defecto).
+    extension : tuple, optional
+        ``(xmin, ymin, xmax, ymax)`` de destino; requiere ``resolucion``.
+    directorio : str, optional
+        Carpeta de la caché. Por defecto ``DIRECTORIO_CACHE/reproyeccion``.
+    max_gb : float
+        Tamaño máximo de la caché en gigabytes.
+    informar : bool
+        Si es ``True`` se imprime si hubo acierto o fallo.
+
+    Returns
+    -------
+    xarray.DataArray
+        Raster reproyectado, abierto de forma perezosa desde la caché. El
+        atributo ``cache`` indica ``"acierto"`` o ``"fallo"``.
+    """
+    if directorio is None:
+        directorio = os.path.join(DIRECTORIO_CACHE, "reproyeccion")
+    os.makedirs(directorio, exist_ok=True)
+
+    remuestreo = Resampling(remuestreo)
+    clave = hashlib.blake2b(
+        json.dumps(
+            {
+                "origen": _hash_raster(raster),
+                "crs": CRS.from_user_input(crs_destino).to_wkt(),
+                "resolucion": resolucion,
+                "remuestreo": remuestreo.name,
+                "extension": extension,
+            },
+            default=float,
+        ).encode(),
+        digest_size=20,
+    ).hexdigest()
+    ruta = os.path.join(directorio, f"{clave}.tif")
+
+    if os.path.exists(ruta):
+        os.utime(ruta)
+        estado = "acierto"
+    else:
+        transform, forma = _grilla_destino(resolucion, extension)
+        reproyectado = raster.rio.reproject(
+            crs_destino,
+            resolution=None if transform is not None else resolucion,
+            transform=transform,
+            shape=forma,
+            resampling=remuestreo,
+        )
+        # Se escribe en un archivo temporal y se renombra al final, para que
+        # otro proceso nunca lea un archivo a medio escribir
+        descriptor, temporal = tempfile.mkstemp(suffix=".tmp", dir=directorio)
+        os.close(descriptor)
+        try:
+            reproyectado.rio.to_raster(
+                temporal, driver="GTiff", tiled=True, compress="deflate"
+            )
+            os.replace(temporal, ruta)
+        finally:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+        _desalojar_lru(directorio, max_gb * 2**30, (".tif",), conservar=clave)
+        estado = "fallo"
+
+    if informar:
+        print(f"Caché de reproyección: {estado} ({clave[:12]})")
+
+    resultado = raster_utils.abrir_raster(ruta)
+    if "band" not in raster.dims:
+        resultado = resultado.squeeze("band", drop=True)
+    resultado.attrs["cache"] = estado
+    return resultado
+
+
+def _hash_archivo(ruta: str) -> str:
+    """Hash de los bytes de un archivo, leído por partes."""
+    h = hashlib.blake2b(digest_size=20)
+    with open(ruta, "rb") as archivo:
+        for parte in iter(lambda: archivo.read(2**24), b""):
+            h.update(parte)
+    return h.hexdigest()
+
+
+def _escribir_json(ruta: str, contenido: dict, directorio: str) -> None:
+    """Escribe ``contenido`` como JSON de forma atómica."""
+    descriptor, temporal = tempfile.mkstemp(suffix=".tmp", dir=directorio)
+    with os.fdopen(descriptor, "w") as archivo:
+        json.dump(contenido, archivo)
+    os.replace(temporal, ruta)
+
+
+def _decodificar_a_npy(ruta: str, destino: str, mb_por_lectura: float) -> dict:
+    """Decodifica todas las bandas de ``ruta`` en un ``.npy`` y describe su grilla.
+
+    El archivo ``.npy`` se crea con ``open_memmap`` y se llena por franjas
+    de filas alineadas con los bloques del GeoTIFF, de modo que nunca se
+    tiene el raster completo en memoria.
+    """
+    with rasterio.open(ruta) as src:
+        forma = (src.count, src.height, src.width)
+        dtype = np.dtype(src.dtypes[0])
+        salida = np.lib.format.open_memmap(destino, mode="w+", dtype=dtype, shape=forma)
+        alto_bloque = src.block_shapes[0][0]
+        filas = int(mb_por_lectura * 2**20 // (src.count * src.width * dtype.itemsize))
+        filas = max(alto_bloque, filas // alto_bloque * alto_bloque)
+        for fila0 in range(0, src.height, filas):
+            ventana = Window(0, fila0, src.width, min(filas, src.height - fila0))
+            salida[:, fila0 : fila0 + ventana.height] = src.read(window=ventana)
+        salida.flush()
+        del salida
+        return {
+            "forma": list(forma),
+            "dtype": dtype.str,
+            "crs": src.crs.to_wkt() if src.crs is not None else None,
+            "transform": list(src.transform)[:6],
+            "nodata": src.nodata,
+            "bandas": list(src.indexes),
+            "atributos": {
+                clave: valor
+                for clave, valor in src.tags().items()
+                if clave == "AREA_OR_POINT"
+            },
+        }
+
+
+def _raster_desde_npy(ruta_npy: str, meta: dict, mb_por_chunk) -> xr.DataArray:
+    """Abre un ``.npy`` de la caché como raster sin copiar sus datos."""
+    datos = np.load(ruta_npy, mmap_mode="r")
+    if mb_por_chunk is not None:
+        import dask.array as da
+
+        filas = int(mb_por_chunk * 2**20 // (datos.shape[2] * datos.itemsize))
+        datos = da.from_array(
+            datos, chunks=(1, max(1, filas), -1), lock=False, asarray=False
+        )
+
+    transform = Affine(*meta["transform"])
+    _, alto, ancho = meta["forma"]
+    raster = xr.DataArray(
+        datos,
+        dims=("band", "y", "x"),
+        coords={
+            "band": meta["bandas"],
+            "y": transform.f + (np.arange(alto) + 0.5) * transform.e,
+            "x": transform.c + (np.arange(ancho) + 0.5) * transform.a,
+        },
+        attrs=dict(meta["atributos"]),
+    )
+    # inplace=True evita que rioxarray copie los datos mapeados
+    if meta["crs"] is not None:
+        raster.rio.write_crs(CRS.from_wkt(meta["crs"]), inplace=True)
+    raster.rio.write_transform(transform, inplace=True)
+    if meta["nodata"] is not None:
+        raster.rio.write_nodata(meta["nodata"], encoded=False, inplace=True)
+    return raster
+
+
+def abrir_con_cache(
+    ruta: str,
+    mb_por_chunk: float | None = raster_utils.MB_POR_CHUNK,
+    directorio: str | None = None,
+    max_gb: float = MAX_GB_CACHE,
+    informar: bool = True,
+) -> xr.DataArray:
+    """Abre un raster desde una copia ya decodificada y mapeada en memoria.
+
+    La primera vez (fallo) el GeoTIFF comprimido se decodifica a un archivo
+    ``.npy`` sin comprimir, con un archivo ``.json`` al lado que guarda su
+    georreferenciación y la fecha, el tamaño y el hash del archivo de
+    origen. Las siguientes veces (acierto) el ``.npy`` se abre con
+    ``np.load(mmap_mode="r")``: no se copia ni se descomprime nada, y el
+    sistema operativo lee del disco solo las páginas que se usan.
+
+    Si la fecha de modificación del origen cambió, se compara su hash: si
+    el contenido es el mismo se reutiliza la copia, y si no, se vuelve a
+    decodificar. Los resultados usados hace más tiempo se eliminan hasta
+    respetar ``max_gb``.
+
+    Parameters
+    ----------
+    ruta : str
+        Ruta de un raster local (por ejemplo, la cobertura de MapBiomas).
+    mb_por_chunk : float, optional
+        Si se indica, el arreglo mapeado se envuelve en dask con chunks de
+        ese tamaño, igual que :func:`raster_utils.abrir_raster`. Con
+        ``None`` se devuelve el arreglo de NumPy mapeado (solo lectura).
+    directorio : str, optional
+        Carpeta de la caché. Por defecto ``DIRECTORIO_CACHE/decodificados``.
+    max_gb : float
+        Tamaño máximo de la caché en gigabytes.
+    informar : bool
+        Si es ``True`` se imprime si hubo acierto o fallo y cuánto tardó la
+        apertura, junto al tiempo de la decodificación original.
+
+    Returns
+    -------
+    xarray.DataArray
+        Raster con dimensiones ``("band", "y", "x")``. Los atributos
+        ``cache`` (``"acierto"`` o ``"fallo"``) y ``segundos_apertura``
+        registran cómo se abrió.
+    """
+    inicio = time.perf_counter()
+    if directorio is None:
+        directorio = os.path.join(DIRECTORIO_CACHE, "decodificados")
+    os.makedirs(directorio, exist_ok=True)
+
+    ruta = os.path.abspath(ruta)
+    clave = hashlib.blake2b(ruta.encode(), digest_size=20).hexdigest()
+    ruta_npy = os.path.join(directorio, f"{clave}.npy")
+    ruta_meta = os.path.join(directorio, f"{clave}.json")
+    estado_origen = os.stat(ruta)
+
+    meta = None
+    if os.path.exists(ruta_meta) and os.path.exists(ruta_npy):
+        with open(ruta_meta) as archivo:
+            meta = json.load(archivo)
+        origen = meta["origen"]
+        if (origen["mtime_ns"], origen["bytes"]) != (
+            estado_origen.st_mtime_ns,
+            estado_origen.st_size,
+        ):
+            # El archivo se modificó (o solo se tocó): decide el contenido
+            if origen["bytes"] == estado_origen.st_size and origen[
+                "hash"
+            ] == _hash_archivo(ruta):
+                origen["mtime_ns"] = estado_origen.st_mtime_ns
+                _escribir_json(ruta_meta, meta, directorio)
+            else:
+                meta = None
+
+    if meta is not None:
+        os.utime(ruta_npy)
+        os.utime(ruta_meta)
+        estado = "acierto"
+    else:
+        descriptor, temporal = tempfile.mkstemp(suffix=".tmp", dir=directorio)
+        os.close(descriptor)
+        try:
+            meta = _decodificar_a_npy(ruta, temporal, raster_utils.MB_POR_CHUNK)
+            os.replace(temporal, ruta_npy)
+        finally:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+        meta["origen"] = {
+            "ruta": ruta,
+            "mtime_ns": estado_origen.st_mtime_ns,
+            "bytes": estado_origen.st_size,
+            "hash": _hash_archivo(ruta),
+        }
+        meta["segundos_decodificacion"] = time.perf_counter() - inicio
+        # El .json se escribe al final: su presencia indica una entrada completa
+        _escribir_json(ruta_meta, meta, directorio)
+        _desalojar_lru(directorio, max_gb * 2**30, (".npy", ".json"), conservar=clave)
+        estado = "fallo"
+
+    raster = _raster_desde_npy(ruta_npy, meta, mb_por_chunk)
+    segundos = time.perf_counter() - inicio
+    if informar:
+        print(
+            f"Caché de raster decodificado: {estado} ({clave[:12]}), apertura en "
+            f"{segundos * 1000:.1f} ms (decodificar: "
+            f"{meta['segundos_decodificacion'] * 1000:.1f} ms)"
+        )
+    raster.attrs["cache"] = estado
+    raster.attrs["segundos_apertura"] = segundos
+    return raster
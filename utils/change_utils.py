@@ -0,0 +1,265 @@
+"""Matrices de transición entre coberturas de suelo de distintos años.
+
+Para comparar dos años de MapBiomas (por ejemplo, el de 2018 en
+``data/raster`` con otro más reciente) no se construye una máscara por cada
+par de clases: cada transición ``(clase_desde, clase_hasta)`` se codifica en
+un único entero por píxel y se cuentan todas a la vez con ``np.bincount``,
+chunk por chunk y en paralelo.
+"""
+
+from __future__ import annotations
+
+from itertools import pairwise
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from . import raster_utils
+from .raster_utils import (
+    _area_pixel_m2,
+    _combinar_conteos,
+    _combinar_en_arbol,
+    _como_banda_unica,
+    _conteo_clases_bloque,
+    _indices_de_clase,
+    _parciales_por_bloque,
+)
+
+
+def _alinear(coberturas: list) -> list:
+    """Verifica que las coberturas compartan grilla y las deja en ``(y, x)``."""
+    coberturas = [_como_banda_unica(c).transpose("y", "x") for c in coberturas]
+    referencia = coberturas[0]
+    for cobertura in coberturas[1:]:
+        if cobertura.shape != referencia.shape or not np.allclose(
+            list(cobertura.rio.transform())[:6], list(referencia.rio.transform())[:6]
+        ):
+            raise ValueError(
+                "las coberturas deben tener la misma grilla; reproyecta una "
+                "sobre la otra con .rio.reproject_match()"
+            )
+        if not np.issubdtype(cobertura.dtype, np.integer):
+            raise ValueError("las coberturas deben ser rasters de enteros")
+    return coberturas
+
+
+def _clases_comunes(coberturas: list, clases, nodata) -> np.ndarray:
+    """Códigos de clase ordenados, sin ``nodata``."""
+    if clases is None:
+        clases = np.concatenate([raster_utils.valores_unicos(c) for c in coberturas])
+    clases = np.unique(np.asarray(clases, dtype=np.int64))
+    if nodata is not None:
+        clases = clases[clases != nodata]
+    return clases
+
+
+def _apilar(coberturas: list):
+    """Apila las coberturas en un arreglo ``(año, y, x)`` con un chunk por año."""
+    datos = [c.data for c in coberturas]
+    if not any(hasattr(d, "dask") for d in datos):
+        return np.stack([np.asarray(d) for d in datos])
+
+    import dask.array as da
+
+    chunks = next(d.chunks for d in datos if hasattr(d, "dask"))
+    return da.stack([da.asarray(d).rechunk(chunks) for d in datos]).rechunk({0: -1})
+
+
+def _transiciones_bloque(bloque, ventana, pares, clases, area_filas):
+    """Conteos (y áreas) de cada transición para cada par de años de un bloque.
+
+    La transición de la clase ``i`` a la ``j`` se codifica como
+    ``i * (n + 1) + j``, con ``n`` clases; los píxeles que no pertenecen a
+    ninguna clase en alguno de los dos años van al último código, que se
+    descarta al contar.
+    """
+    n = clases.size
+    descartado = (n + 1) ** 2 - 1
+    indices = [_indices_de_clase(np.asarray(capa), clases) for capa in bloque]
+    resultados = []
+    for a, b in pares:
+        codigo = indices[a] * (n + 1) + indices[b]
+        codigo[(indices[a] == n) | (indices[b] == n)] = descartado
+        conteo, area = _conteo_clases_bloque(codigo, ventana, descartado, area_filas)
+        conteo = np.pad(conteo, (0, (n + 1) ** 2 - conteo.size))
+        if area is not None:
+            area = np.pad(area, (0, (n + 1) ** 2 - area.size))
+        resultados.append((conteo, area))
+    return resultados
+
+
+def _combinar_transiciones(a: list, b: list) -> list:
+    """Suma, par de años por par de años, los conteos de dos bloques."""
+    return [_combinar_conteos(x, y) for x, y in zip(a, b)]
+
+
+def matrices_transicion(
+    coberturas: dict,
+    pares: list | None = None,
+    clases=None,
+    nodata: int | None = None,
+    leyenda: dict | None = None,
+    unidades: str = "ha",
+    totales: bool = False,
+    scheduler: str | None = None,
+) -> dict:
+    """Calcula las matrices de transición de una serie de coberturas.
+
+    Todos los años se recorren en una sola pasada: cada chunk se lee una
+    vez por año y sus transiciones se cuentan con un ``np.bincount`` por par
+    de años, sin máscaras por clase. Si el CRS es geográfico, el área se
+    pondera por fila según la latitud (ver :func:`raster_utils.area_por_clase`).
+
+    Parameters
+    ----------
+    coberturas : dict
+        ``{año: raster}``; todos los rasters deben compartir la grilla.
+    pares : list of tuple, optional
+        Pares ``(año_desde, año_hasta)`` a comparar. Por defecto, cada año
+        con el siguiente.
+    clases : array-like, optional
+        Códigos de clase. Por defecto, todos los presentes (lo que requiere
+        una pasada adicional).
+    nodata : int, optional
+        Código que se excluye. Por defecto, el ``nodata`` del primer raster.
+    leyenda : dict, optional
+        ``{código: nombre}``. Por defecto, la leyenda de MapBiomas.
+    unidades : {"ha", "pixeles"}
+        Unidades de las celdas de la matriz.
+    totales : bool
+        Si es ``True`` se agregan la fila y la columna ``Total``.
+    scheduler : str, optional
+        Planificador de dask (con ``"processes"`` se aprovechan todos los
+        núcleos, porque ``np.bincount`` no libera el GIL).
+
+    Returns
+    -------
+    dict
+        ``{(año_desde, año_hasta): pandas.DataFrame}``, con las clases de
+        origen en las filas y las de destino en las columnas.
+    """
+    if unidades not in ("ha", "pixeles"):
+        raise ValueError("unidades debe ser 'ha' o 'pixeles'")
+    anios = list(coberturas)
+    if len(anios) < 2:
+        raise ValueError("se requieren al menos dos coberturas")
+    if pares is None:
+        pares = list(pairwise(anios))
+    if leyenda is None:
+        leyenda = raster_utils.LEYENDA_MAPBIOMAS
+
+    rasters = _alinear([coberturas[anio] for anio in anios])
+    if nodata is None:
+        nodata = rasters[0].rio.nodata
+    clases = _clases_comunes(rasters, clases, nodata)
+    posiciones = [(anios.index(a), anios.index(b)) for a, b in pares]
+
+    area_pixel = _area_pixel_m2(rasters[0]) if unidades == "ha" else 1.0
+    area_filas = area_pixel if np.ndim(area_pixel) else None
+    parciales = _parciales_por_bloque(
+        _apilar(rasters), _transiciones_bloque, posiciones, clases, area_filas
+    )
+    if len(parciales) == 1 and not hasattr(parciales[0], "dask"):
+        totales_pares = parciales[0]
+    else:
+        totales_pares = _combinar_en_arbol(parciales, _combinar_transiciones, scheduler)
+
+    n = clases.size
+    nombres = [leyenda.get(int(c), f"Clase {c}") for c in clases]
+    matrices = {}
+    for (a, b), (conteo, area) in zip(pares, totales_pares):
+        if unidades == "pixeles":
+            valores = conteo
+        elif area is None:
+            valores = conteo * float(area_pixel) / 10_000
+        else:
+            valores = area / 10_000
+        valores = valores.reshape(n + 1, n + 1)[:n, :n]
+        matriz = pd.DataFrame(
+            valores,
+            index=pd.Index(nombres, name=str(a)),
+            columns=pd.Index(nombres, name=str(b)),
+        )
+        if totales:
+            matriz["Total"] = matriz.sum(axis=1)
+            matriz.loc["Total"] = matriz.sum(axis=0)
+        matrices[(a, b)] = matriz
+    return matrices
+
+
+def matriz_transicion(
+    desde: xr.DataArray,
+    hasta: xr.DataArray,
+    clases=None,
+    nodata: int | None = None,
+    leyenda: dict | None = None,
+    unidades: str = "ha",
+    totales: bool = False,
+    scheduler: str | None = None,
+) -> pd.DataFrame:
+    """Matriz de transición entre dos coberturas (ver :func:`matrices_transicion`).
+
+    Returns
+    -------
+    pandas.DataFrame
+        Área (o píxeles) que pasó de cada clase de ``desde`` (filas) a cada
+        clase de ``hasta`` (columnas); la diagonal es el área sin cambio.
+    """
+    matrices = matrices_transicion(
+        {"desde": desde, "hasta": hasta},
+        clases=clases,
+        nodata=nodata,
+        leyenda=leyenda,
+        unidades=unidades,
+        totales=totales,
+        scheduler=scheduler,
+    )
+    return matrices[("desde", "hasta")]
+
+
+def raster_cambio(
+    desde: xr.DataArray,
+    hasta: xr.DataArray,
+    nodata: int | None = None,
+    base: int = 100,
+) -> xr.DataArray:
+    """Raster con la transición de cada píxel entre dos coberturas.
+
+    Cada píxel vale ``codigo_desde * base + codigo_hasta``: con la leyenda
+    de MapBiomas, ``309`` significa de Bosque (3) a Plantación Forestal (9).
+    Los píxeles sin cambio se pueden obtener con ``desde == hasta``. Es
+    perezoso si las coberturas son arreglos de dask.
+
+    Parameters
+    ----------
+    desde, hasta : xarray.DataArray
+        Coberturas con la misma grilla.
+    nodata : int, optional
+        Código sin dato. Por defecto, el ``nodata`` de ``desde``; los píxeles
+        sin dato en alguno de los dos años quedan con el máximo del tipo de
+        dato de salida, que se registra como ``nodata``.
+    base : int
+        Debe ser mayor que todos los códigos de clase (los de MapBiomas son
+        menores que 100).
+
+    Returns
+    -------
+    xarray.DataArray
+        Raster de enteros con los códigos de transición.
+    """
+    desde, hasta = _alinear([desde, hasta])
+    if nodata is None:
+        nodata = desde.rio.nodata
+    maximo = max(np.iinfo(desde.dtype).max, np.iinfo(hasta.dtype).max)
+    tipo = np.min_scalar_type(maximo * base + maximo + 1)
+
+    codigo = desde.astype(tipo) * base + hasta.astype(tipo)
+    sin_dato = np.iinfo(tipo).max
+    if nodata is not None:
+        codigo = codigo.where((desde != nodata) & (hasta != nodata), sin_dato)
+    codigo = codigo.astype(tipo).rename("cambio")
+    codigo.attrs = {"base": base}
+    if desde.rio.crs is not None:
+        codigo = codigo.rio.write_crs(desde.rio.crs)
+    return codigo.rio.write_transform(desde.rio.transform()).rio.write_nodata(sin_dato)
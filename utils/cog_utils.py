@@ -0,0 +1,609 @@
+"""Escritura y validación de GeoTIFF optimizados para la nube (COG).
+
+Un COG es un GeoTIFF con teselas internas, vistas generales (overviews) y
+una organización del archivo que permite leer solo las partes necesarias,
+ya sea desde el disco o por HTTP.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Self
+
+import numpy as np
+import rasterio
+import rasterio.abc
+import rasterio.shutil
+import rioxarray  # noqa: F401  (accesor .rio)
+import xarray as xr
+from rasterio.enums import Interleaving, Resampling
+from rasterio.warp import transform_bounds
+
+# Lado de las teselas internas y tamaño bajo el cual ya no se crean vistas
+TAMANO_TESELA = 512
+
+# Compresión y predictor por tipo de dato: diferencias horizontales (2) para
+# enteros y predictor de punto flotante (3) para reales
+PERFILES_COMPRESION = {
+    "i": ("DEFLATE", 2),
+    "u": ("DEFLATE", 2),
+    "f": ("DEFLATE", 3),
+}
+
+# Conexiones HTTP simultáneas (y reutilizadas) por servidor
+CONEXIONES_POR_HOST = 8
+
+# Rangos de bytes separados por menos de este hueco se piden juntos
+HUECO_MAX = 64 * 1024
+
+# Tamaño máximo de una solicitud combinada, en bytes
+MAX_BYTES_SOLICITUD = 16 * 2**20
+
+# Bytes mínimos de cada lectura del encabezado (lectura anticipada)
+LECTURA_MINIMA = 64 * 1024
+
+# Conexiones HTTP abiertas en cada proceso
+_CLIENTES_HTTP: dict = {}
+
+
+def _perfil_compresion(dtype) -> tuple[str, int]:
+    """Compresión y predictor recomendados para ``dtype``."""
+    return PERFILES_COMPRESION.get(np.dtype(dtype).kind, ("DEFLATE", 1))
+
+
+def _factores_vistas(alto: int, ancho: int, tamano_tesela: int) -> list[int]:
+    """Factores 2, 4, 8, ... hasta que la vista quepa en una tesela."""
+    factores = []
+    factor = 2
+    while max(alto, ancho) / (factor // 2) > tamano_tesela:
+        factores.append(factor)
+        factor *= 2
+    return factores
+
+
+def validar_cog(ruta: str) -> dict:
+    """Verifica que un archivo cumpla con la organización de un COG.
+
+    Sigue las reglas del script ``validate_cloud_optimized_geotiff.py`` de
+    GDAL: imagen y vistas en teselas, vistas internas si la imagen supera
+    una tesela, directorios (IFD) de la imagen principal antes que los de
+    las vistas, y datos de las vistas más pequeñas antes que los de la
+    imagen completa.
+
+    Returns
+    -------
+    dict
+        Claves ``valido`` (bool), ``errores`` y ``advertencias`` (listas de
+        mensajes).
+    """
+    errores = []
+    advertencias = []
+    with rasterio.open(ruta) as src:
+        if src.driver != "GTiff":
+            return {
+                "valido": False,
+                "errores": ["el archivo no es un GeoTIFF"],
+                "advertencias": [],
+            }
+        _, ancho_bloque = src.block_shapes[0]
+        grande = src.width > TAMANO_TESELA or src.height > TAMANO_TESELA
+        if grande and ancho_bloque == src.width and src.width > TAMANO_TESELA:
+            errores.append("la imagen supera 512 píxeles pero no está en teselas")
+        n_vistas = len(src.overviews(1))
+        if grande and n_vistas == 0:
+            advertencias.append("la imagen supera 512 píxeles y no tiene vistas")
+        ifd_principal = int(src.get_tag_item("IFD_OFFSET", "TIFF", bidx=1))
+        datos_principal = int(src.get_tag_item("BLOCK_OFFSET_0_0", "TIFF", bidx=1) or 0)
+        if src.tags(ns="IMAGE_STRUCTURE").get("LAYOUT") != "COG":
+            advertencias.append("GDAL no reconoce el archivo como LAYOUT=COG")
+
+    ifd_anterior = ifd_principal
+    datos_anterior = datos_principal
+    for nivel in range(n_vistas):
+        with rasterio.open(ruta, overview_level=nivel) as vista:
+            if vista.block_shapes[0][1] == vista.width > TAMANO_TESELA:
+                errores.append(f"la vista {nivel} no está en teselas")
+            ifd = int(vista.get_tag_item("IFD_OFFSET", "TIFF", bidx=1))
+            datos = int(vista.get_tag_item("BLOCK_OFFSET_0_0", "TIFF", bidx=1) or 0)
+        if ifd < ifd_anterior:
+            if nivel == 0:
+                errores.append(
+                    "el IFD de la imagen principal debe estar antes que los "
+                    "de las vistas"
+                )
+            else:
+                errores.append(f"el IFD de la vista {nivel} está fuera de orden")
+        if datos and datos_anterior and datos > datos_anterior:
+            errores.append(
+                f"los datos de la vista {nivel} deben estar antes que los de "
+                "las vistas de mayor resolución"
+            )
+        ifd_anterior, datos_anterior = ifd, datos
+
+    return {"valido": not errores, "errores": errores, "advertencias": advertencias}
+
+
+def escribir_cog(
+    raster: xr.DataArray,
+    ruta: str,
+    compresion: str | None = None,
+    predictor: int | None = None,
+    categorico: bool | None = None,
+    tamano_tesela: int = TAMANO_TESELA,
+    hilos: int | str = "ALL_CPUS",
+    validar: bool = True,
+) -> str:
+    """Guarda un raster como GeoTIFF optimizado para la nube (COG).
+
+    Reemplaza a ``raster.rio.to_raster(ruta)``, que escribe un archivo sin
+    teselas, sin compresión y sin vistas. El proceso tiene tres pasos:
+
+    1. El raster se escribe por bloques en un GeoTIFF temporal en teselas,
+       por lo que un arreglo de dask nunca se carga completo en memoria.
+    2. Se construyen las vistas generales con remuestreo por moda (clases)
+       o por promedio (valores continuos).
+    3. El driver COG de GDAL reorganiza el archivo y comprime las teselas en
+       paralelo con ``hilos`` hilos.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Raster con CRS (en memoria o respaldado por dask).
+    ruta : str
+        Archivo de salida.
+    compresion : str, optional
+        ``"DEFLATE"``, ``"LZW"``, ``"ZSTD"``, ... Por defecto según
+        ``PERFILES_COMPRESION``.
+    predictor : int, optional
+        1 (ninguno), 2 (horizontal) o 3 (punto flotante). Por defecto según
+        el tipo de dato.
+    categorico : bool, optional
+        Si las vistas se remuestrean por moda. Por defecto, ``True`` solo
+        para rasters de enteros de 8 bits (clases); los de 16 bits o más,
+        como un DEM o reflectancias, se promedian.
+    tamano_tesela : int
+        Lado de las teselas internas en píxeles.
+    hilos : int or str
+        Hilos para construir vistas y comprimir (``"ALL_CPUS"`` usa todos).
+    validar : bool
+        Si es ``True`` se verifica el resultado con :func:`validar_cog` y se
+        lanza ``ValueError`` si no cumple.
+
+    Returns
+    -------
+    str
+        La ruta del archivo escrito.
+    """
+    compresion_defecto, predictor_defecto = _perfil_compresion(raster.dtype)
+    compresion = (compresion or compresion_defecto).upper()
+    predictor = predictor_defecto if predictor is None else predictor
+    if categorico is None:
+        categorico = (
+            np.issubdtype(raster.dtype, np.integer) and raster.dtype.itemsize == 1
+        )
+    remuestreo = Resampling.mode if categorico else Resampling.average
+
+    directorio = os.path.dirname(os.path.abspath(ruta))
+    os.makedirs(directorio, exist_ok=True)
+    descriptor, temporal = tempfile.mkstemp(suffix=".tif", dir=directorio)
+    os.close(descriptor)
+    try:
+        with rasterio.Env(GDAL_NUM_THREADS=str(hilos)):
+            # 1. Escritura por bloques (compresión rápida, solo intermedia)
+            raster.rio.to_raster(
+                temporal,
+                driver="GTiff",
+                tiled=True,
+                blockxsize=tamano_tesela,
+                blockysize=tamano_tesela,
+                compress="DEFLATE",
+                zlevel=1,
+                bigtiff="IF_SAFER",
+                windowed=True,
+                lock=threading.Lock(),
+            )
+
+            # 2. Vistas generales dentro del archivo temporal
+            with rasterio.open(temporal, "r+") as dst:
+                factores = _factores_vistas(dst.height, dst.width, tamano_tesela)
+                if factores:
+                    dst.build_overviews(factores, remuestreo)
+
+            # 3. Reorganización como COG con compresión en paralelo
+            rasterio.shutil.copy(
+                temporal,
+                ruta,
+                driver="COG",
+                COMPRESS=compresion,
+                PREDICTOR=str(predictor),
+                BLOCKSIZE=str(tamano_tesela),
+                OVERVIEWS="FORCE_USE_EXISTING",
+                RESAMPLING=remuestreo.name.upper(),
+                NUM_THREADS=str(hilos),
+                BIGTIFF="IF_SAFER",
+            )
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+    if validar:
+        reporte = validar_cog(ruta)
+        if not reporte["valido"]:
+            raise ValueError(f"{ruta} no es un COG válido: {reporte['errores']}")
+    return ruta
+
+
+def _cliente_http(conexiones: int):
+    """Conjunto de conexiones HTTP reutilizables, uno por proceso.
+
+    ``urllib3.PoolManager`` mantiene un grupo de hasta ``conexiones``
+    conexiones abiertas (keep-alive) por servidor; con ``block=True`` nunca
+    abre más, de modo que el servidor no recibe ráfagas de conexiones
+    nuevas.
+    """
+    import urllib3
+
+    clave = (os.getpid(), conexiones)
+    cliente = _CLIENTES_HTTP.get(clave)
+    if cliente is None:
+        cliente = _CLIENTES_HTTP[clave] = urllib3.PoolManager(
+            maxsize=conexiones,
+            block=True,
+            retries=urllib3.Retry(total=3, backoff_factor=0.5),
+        )
+    return cliente
+
+
+def _combinar_rangos(inicios, tamanos, hueco_max: int, max_bytes: int) -> list:
+    """Agrupa rangos de bytes cercanos en menos solicitudes.
+
+    Dos rangos se piden juntos si entre ellos hay a lo sumo ``hueco_max``
+    bytes y la solicitud resultante no supera ``max_bytes``. Devuelve
+    ``(inicio, fin, posiciones)`` por solicitud, con ``fin`` exclusivo y las
+    posiciones de los rangos originales que cubre.
+    """
+    orden = sorted(range(len(inicios)), key=lambda i: inicios[i])
+    solicitudes = []
+    for i in orden:
+        inicio, fin = inicios[i], inicios[i] + tamanos[i]
+        if solicitudes:
+            inicio_actual, fin_actual, posiciones = solicitudes[-1]
+            if (
+                inicio - fin_actual <= hueco_max
+                and max(fin, fin_actual) - inicio_actual <= max_bytes
+            ):
+                solicitudes[-1] = (
+                    inicio_actual,
+                    max(fin, fin_actual),
+                    posiciones + [i],
+                )
+                continue
+        solicitudes.append((inicio, fin, [i]))
+    return solicitudes
+
+
+def _rangos_teselas(src, ventana, bandas) -> tuple[list, list]:
+    """Posición y tamaño en el archivo de las teselas que cubren ``ventana``.
+
+    Se leen de las etiquetas ``TileOffsets`` y ``TileByteCounts`` del
+    directorio (IFD) que GDAL ya interpretó. Las teselas vacías (sin datos
+    en el archivo) se omiten.
+    """
+    alto_bloque, ancho_bloque = src.block_shapes[0]
+    fila0 = max(0, int(ventana.row_off) // alto_bloque)
+    col0 = max(0, int(ventana.col_off) // ancho_bloque)
+    fila1 = min(
+        math.ceil((ventana.row_off + ventana.height) / alto_bloque),
+        math.ceil(src.height / alto_bloque),
+    )
+    col1 = min(
+        math.ceil((ventana.col_off + ventana.width) / ancho_bloque),
+        math.ceil(src.width / ancho_bloque),
+    )
+    planos = bandas if src.interleaving == Interleaving.band else [1]
+    inicios, tamanos = [], []
+    for banda in planos:
+        for fila in range(fila0, fila1):
+            for col in range(col0, col1):
+                inicio = src.get_tag_item(
+                    f"BLOCK_OFFSET_{col}_{fila}", "TIFF", bidx=banda
+                )
+                tamano = src.get_tag_item(
+                    f"BLOCK_SIZE_{col}_{fila}", "TIFF", bidx=banda
+                )
+                if inicio and tamano and int(tamano) > 0:
+                    # Los COG de GDAL guardan 4 bytes antes (tamaño) y 4
+                    # después (repetición del final) de cada tesela; GDAL
+                    # los lee junto con ella, más el tamaño de la siguiente
+                    inicios.append(max(0, int(inicio) - 4))
+                    tamanos.append(int(tamano) + 12)
+    return inicios, tamanos
+
+
+class _AbridorHTTP(rasterio.abc.MultiByteRangeResourceContainer):
+    """``opener`` de rasterio que lee un archivo remoto por rangos de bytes.
+
+    Guarda los segmentos ya descargados del archivo, que comparten todos los
+    manejadores (:class:`_ArchivoHTTP`) que abre GDAL, y cuenta las
+    solicitudes y los bytes transferidos en ``estadisticas``.
+    """
+
+    def __init__(self, url, cliente, hilos, hueco_max, max_bytes, estadisticas):
+        self.url = url
+        self.cliente = cliente
+        self.hilos = hilos
+        self.hueco_max = hueco_max
+        self.max_bytes = max_bytes
+        self.estadisticas = estadisticas
+        self.candado = threading.Lock()
+        self.segmentos = {}
+        self.tamano = None
+
+    def pedir(self, inicio: int, fin: int) -> bytes:
+        """Descarga los bytes ``[inicio, fin)`` con una solicitud ``Range``."""
+        respuesta = self.cliente.request(
+            "GET", self.url, headers={"Range": f"bytes={inicio}-{fin - 1}"}
+        )
+        if respuesta.status not in (200, 206):
+            raise OSError(f"HTTP {respuesta.status} al leer {self.url}")
+        datos = respuesta.data
+        rango = respuesta.headers.get("Content-Range", "")
+        with self.candado:
+            if self.tamano is None:
+                self.tamano = (
+                    int(rango.rsplit("/", 1)[1]) if "/" in rango else len(datos)
+                )
+            self.estadisticas["solicitudes"] += 1
+            self.estadisticas["bytes"] += len(datos)
+        if respuesta.status == 200:
+            datos = datos[inicio:fin]
+        with self.candado:
+            if len(datos) > len(self.segmentos.get(inicio, b"")):
+                self.segmentos[inicio] = datos
+        return datos
+
+    def precargar(self, inicios, tamanos) -> None:
+        """Descarga en paralelo los rangos que aún no están descargados.
+
+        Los rangos se combinan con :func:`_combinar_rangos` y cada solicitud
+        combinada ocupa un hilo (y una conexión) del grupo.
+        """
+        faltantes = [
+            (inicio, tamano)
+            for inicio, tamano in zip(inicios, tamanos)
+            if tamano > 0 and self.buscar(inicio, inicio + tamano) is None
+        ]
+        if not faltantes:
+            return
+        solicitudes = _combinar_rangos(
+            [inicio for inicio, _ in faltantes],
+            [tamano for _, tamano in faltantes],
+            self.hueco_max,
+            self.max_bytes,
+        )
+        with ThreadPoolExecutor(max_workers=self.hilos) as ejecutor:
+            list(ejecutor.map(lambda s: self.pedir(s[0], s[1]), solicitudes))
+
+    def buscar(self, inicio: int, fin: int) -> bytes | None:
+        """Bytes ``[inicio, fin)`` si ya están descargados.
+
+        El rango puede abarcar varios segmentos contiguos: GDAL une en una
+        sola lectura teselas vecinas que se descargaron por separado.
+        """
+        partes = []
+        posicion = inicio
+        with self.candado:
+            for comienzo in sorted(self.segmentos):
+                datos = self.segmentos[comienzo]
+                final = comienzo + len(datos)
+                if comienzo <= posicion < final:
+                    partes.append(
+                        datos[posicion - comienzo : min(fin, final) - comienzo]
+                    )
+                    posicion = min(fin, final)
+                    if posicion >= fin:
+                        return partes[0] if len(partes) == 1 else b"".join(partes)
+        return None
+
+    def open(self, path: str, mode: str = "r", **kwds) -> _ArchivoHTTP:
+        # GDAL también busca archivos auxiliares (.aux.xml, .ovr, ...), que
+        # no se piden al servidor
+        if path != self.url:
+            raise FileNotFoundError(path)
+        return _ArchivoHTTP(self)
+
+    def size(self, path: str | None = None) -> int:
+        if self.tamano is None:
+            self.pedir(0, LECTURA_MINIMA)
+        return self.tamano
+
+    def isfile(self, path: str) -> bool:
+        return path == self.url
+
+    def isdir(self, path: str) -> bool:
+        return False
+
+    def ls(self, path: str) -> list:
+        return []
+
+    def mtime(self, path: str) -> int:
+        return 0
+
+    def rm(self, path: str) -> None:
+        raise OSError("el archivo remoto es de solo lectura")
+
+
+class _ArchivoHTTP:
+    """Manejador de solo lectura que GDAL usa como archivo.
+
+    ``read`` se sirve desde los segmentos ya descargados o, si faltan (como
+    al leer el encabezado y los directorios), pide al menos
+    ``LECTURA_MINIMA`` bytes. GDAL entrega los rangos de varias teselas de
+    una vez a ``get_byte_ranges``, que descarga en paralelo los que faltan.
+    """
+
+    def __init__(self, abridor: _AbridorHTTP):
+        self.abridor = abridor
+        self.posicion = 0
+
+    def read(self, n: int = -1) -> bytes:
+        tamano = self.abridor.size()
+        fin = tamano if n is None or n < 0 else min(self.posicion + n, tamano)
+        if fin <= self.posicion:
+            return b""
+        datos = self.abridor.buscar(self.posicion, fin)
+        if datos is None:
+            hasta = min(max(fin, self.posicion + LECTURA_MINIMA), tamano)
+            datos = self.abridor.pedir(self.posicion, hasta)[: fin - self.posicion]
+        self.posicion += len(datos)
+        return datos
+
+    def get_byte_ranges(self, offsets, sizes) -> list:
+        self.abridor.precargar(offsets, sizes)
+        return [
+            self.abridor.buscar(inicio, inicio + tamano) or b""
+            for inicio, tamano in zip(offsets, sizes)
+        ]
+
+    def seek(self, posicion: int, desde: int = 0) -> int:
+        base = {0: 0, 1: self.posicion, 2: self.abridor.size()}[desde]
+        self.posicion = base + posicion
+        return self.posicion
+
+    def tell(self) -> int:
+        return self.posicion
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *excepcion) -> None:
+        self.close()
+
+
+def leer_cog_http(
+    url: str,
+    ventana=None,
+    bandas=None,
+    vista: int | None = None,
+    crs=None,
+    hilos: int = CONEXIONES_POR_HOST,
+    conexiones: int = CONEXIONES_POR_HOST,
+    hueco_max: int = HUECO_MAX,
+    max_bytes_solicitud: int = MAX_BYTES_SOLICITUD,
+    informar: bool = True,
+) -> tuple[xr.DataArray, dict]:
+    """Lee una ventana de un COG remoto con solicitudes HTTP concurrentes.
+
+    GDAL por sí solo (``/vsicurl/``) suele pedir las teselas de una ventana
+    en muchas solicitudes pequeñas y sucesivas. Aquí GDAL sigue
+    interpretando y descomprimiendo el archivo, pero las lecturas pasan por
+    un ``opener`` de rasterio que:
+
+    1. Descarga el encabezado y los directorios (IFD) en lecturas de al
+       menos ``LECTURA_MINIMA`` bytes.
+    2. Calcula, con los directorios, los rangos de bytes de todas las
+       teselas de la ventana y combina los vecinos (separados por menos de
+       ``hueco_max``) en menos solicitudes.
+    3. Pide esas solicitudes en paralelo con ``hilos`` hilos, sobre un
+       grupo acotado de conexiones reutilizadas por servidor; luego GDAL
+       lee las teselas desde memoria.
+
+    Parameters
+    ----------
+    url : str
+        URL del COG (por ejemplo ``item.assets["B04"].href``, ya firmada).
+    ventana : rasterio.windows.Window or tuple, optional
+        Ventana en píxeles o extensión ``(xmin, ymin, xmax, ymax)``. Se
+        recorta al archivo; por defecto, el archivo completo.
+    bandas : int or list of int, optional
+        Bandas (desde 1). Por defecto, todas.
+    vista : int, optional
+        Nivel de vista general (0 es la primera reducción a la mitad). Por
+        defecto, la resolución completa.
+    crs : optional
+        CRS de la extensión (por ejemplo ``"EPSG:4326"`` para el ``bbox``
+        de una búsqueda STAC). Por defecto, el del archivo.
+    hilos : int
+        Solicitudes simultáneas.
+    conexiones : int
+        Conexiones HTTP abiertas por servidor.
+    hueco_max : int
+        Bytes que se aceptan descargar de más para unir dos rangos.
+    max_bytes_solicitud : int
+        Tamaño máximo de una solicitud combinada.
+    informar : bool
+        Imprime el número de solicitudes, los bytes y el caudal logrado.
+
+    Returns
+    -------
+    tuple
+        El raster leído (``xarray.DataArray`` ``(band, y, x)`` con CRS) y
+        un dict con ``teselas`` (de la ventana), ``solicitudes``,
+        ``bytes``, ``segundos`` y ``mb_por_segundo``.
+    """
+    estadisticas = {"solicitudes": 0, "bytes": 0}
+    abridor = _AbridorHTTP(
+        url,
+        cliente=_cliente_http(conexiones),
+        hilos=hilos,
+        hueco_max=hueco_max,
+        max_bytes=max_bytes_solicitud,
+        estadisticas=estadisticas,
+    )
+    inicio = time.perf_counter()
+    with rasterio.open(
+        url, driver="GTiff", opener=abridor, overview_level=vista
+    ) as src:
+        completa = rasterio.windows.Window(0, 0, src.width, src.height)
+        if ventana is None:
+            ventana = completa
+        elif not isinstance(ventana, rasterio.windows.Window):
+            if crs is not None:
+                ventana = transform_bounds(crs, src.crs, *ventana)
+            ventana = rasterio.windows.from_bounds(*ventana, transform=src.transform)
+            ventana = ventana.round_offsets().round_lengths()
+        ventana = ventana.intersection(completa)
+        if bandas is None:
+            bandas = list(src.indexes)
+        bandas = [bandas] if np.isscalar(bandas) else list(bandas)
+        inicios, tamanos = _rangos_teselas(src, ventana, bandas)
+        estadisticas["teselas"] = len(inicios)
+        abridor.precargar(inicios, tamanos)
+        datos = src.read(bandas, window=ventana)
+        transform = src.window_transform(ventana)
+        crs = src.crs
+        nodata = src.nodata
+    segundos = time.perf_counter() - inicio
+    estadisticas["segundos"] = segundos
+    estadisticas["mb_por_segundo"] = estadisticas["bytes"] / 2**20 / max(segundos, 1e-9)
+
+    filas = np.arange(datos.shape[1]) + 0.5
+    columnas = np.arange(datos.shape[2]) + 0.5
+    resultado = xr.DataArray(
+        datos,
+        dims=("band", "y", "x"),
+        coords={
+            "band": bandas,
+            "y": transform.f + filas * transform.e,
+            "x": transform.c + columnas * transform.a,
+        },
+    )
+    resultado = resultado.rio.write_crs(crs).rio.write_transform(transform)
+    if nodata is not None:
+        resultado = resultado.rio.write_nodata(nodata)
+    if informar:
+        print(
+            f"HTTP: {estadisticas['solicitudes']} solicitudes para "
+            f"{estadisticas['teselas']} teselas, "
+            f"{estadisticas['bytes'] / 2**20:.1f} MB en {segundos:.2f} s "
+            f"({estadisticas['mb_por_segundo']:.1f} MB/s)"
+        )
+    return resultado, estadisticas
@@ -0,0 +1,375 @@
+"""Estadísticas focales (de ventana móvil) con imágenes integrales.
+
+Una convolución directa con una ventana de ``k x k`` cuesta ``k²``
+operaciones por píxel: con ventanas de 101x101 sobre la cobertura o el DEM de
+``01_datos_raster.py`` son más de 10.000. Con una imagen integral (tabla de
+sumas acumuladas) la suma de cualquier rectángulo se obtiene con cuatro
+lecturas, sin importar su tamaño; las fracciones de clase usan una imagen
+integral por clase.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+import xarray as xr
+from numba import njit
+
+from .raster_utils import (
+    LEYENDA_MAPBIOMAS,
+    _como_banda_unica,
+    _indices_de_clase,
+    valores_unicos,
+)
+
+FORMAS = ("rectangular", "circular")
+
+# Estadísticas de estadisticas_focales, en el orden en que las entrega el kernel
+ESTADISTICAS = ("media", "suma", "validos")
+
+
+def _radios(ventana) -> tuple[int, int]:
+    """Semiancho ``(filas, columnas)`` de una ventana de lados impares."""
+    alto, ancho = (ventana, ventana) if np.isscalar(ventana) else ventana
+    alto, ancho = int(alto), int(ancho)
+    if alto < 1 or ancho < 1 or alto % 2 == 0 or ancho % 2 == 0:
+        raise ValueError("los lados de la ventana deben ser enteros positivos impares")
+    return alto // 2, ancho // 2
+
+
+def _bandas(radios: tuple[int, int], forma: str) -> np.ndarray:
+    """Descompone la ventana en rectángulos ``(fila0, fila1, col0, col1)``.
+
+    Los índices son inclusivos y relativos a la esquina superior izquierda
+    de la ventana. Una ventana rectangular es un solo rectángulo; una
+    circular (elíptica si los lados difieren) se divide en franjas de filas
+    consecutivas con el mismo ancho, de modo que cuesta cuatro lecturas por
+    franja en lugar de una por píxel.
+    """
+    if forma not in FORMAS:
+        raise ValueError(f"forma debe ser una de {FORMAS}")
+    ry, rx = radios
+    if forma == "rectangular" or ry == 0:
+        return np.array([(0, 2 * ry, 0, 2 * rx)], dtype=np.int64)
+    dy = np.arange(-ry, ry + 1)
+    semianchos = np.floor(rx * np.sqrt(np.clip(1 - (dy / ry) ** 2, 0, 1)) + 1e-9)
+    bandas = []
+    inicio = 0
+    for fila in range(1, dy.size + 1):
+        if fila == dy.size or semianchos[fila] != semianchos[inicio]:
+            w = int(semianchos[inicio])
+            bandas.append((inicio, fila - 1, rx - w, rx + w))
+            inicio = fila
+    return np.array(bandas, dtype=np.int64)
+
+
+def _integral(valores: np.ndarray, dtype) -> np.ndarray:
+    """Imagen integral con una fila y una columna de ceros al inicio."""
+    integral = np.zeros((valores.shape[0] + 1, valores.shape[1] + 1), dtype=dtype)
+    np.cumsum(valores, axis=0, dtype=dtype, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
+
+
+@njit(cache=True, nogil=True)
+def _sumas_ventana(integral, bandas, alto, ancho):
+    """Suma de la ventana centrada en cada píxel del interior del bloque.
+
+    ``bandas`` es un arreglo ``(franjas, 4)`` con los rectángulos de la
+    ventana; cada uno cuesta cuatro lecturas de la imagen integral.
+    """
+    suma = np.zeros((alto, ancho), dtype=integral.dtype)
+    for y in range(alto):
+        for k in range(bandas.shape[0]):
+            f0, f1, c0, c1 = bandas[k, 0], bandas[k, 1], bandas[k, 2], bandas[k, 3]
+            for x in range(ancho):
+                suma[y, x] += (
+                    integral[y + f1 + 1, x + c1 + 1]
+                    - integral[y + f0, x + c1 + 1]
+                    - integral[y + f1 + 1, x + c0]
+                    + integral[y + f0, x + c0]
+                )
+    return suma
+
+
+def _tipo_conteo(bloque: np.ndarray):
+    """Entero suficiente para contar todos los píxeles del bloque."""
+    return np.int32 if bloque.size < 2**31 else np.int64
+
+
+def _focal_continuo_bloque(bloque, radios, bandas, posiciones):
+    """Estadísticas focales de un bloque con halo; ``NaN`` marca los inválidos.
+
+    Devuelve ``(estadísticas pedidas, filas, columnas)`` para el interior
+    del bloque. Antes de acumular se resta la media del bloque, para que la
+    imagen integral no pierda precisión con valores grandes (por ejemplo,
+    elevaciones).
+    """
+    ry, rx = radios
+    forma = (bloque.shape[0] - 2 * ry, bloque.shape[1] - 2 * rx)
+    validos = ~np.isnan(bloque)
+    desplazamiento = float(bloque[validos].mean()) if validos.any() else 0.0
+    valores = np.where(validos, bloque - desplazamiento, 0.0)
+
+    n = _sumas_ventana(_integral(validos, _tipo_conteo(bloque)), bandas, *forma)
+    suma = _sumas_ventana(_integral(valores, np.float64), bandas, *forma)
+    suma += n * desplazamiento
+    centro = validos[ry : ry + forma[0], rx : rx + forma[1]] & (n > 0)
+
+    salida = np.full((int((posiciones >= 0).sum()),) + forma, np.nan, np.float32)
+    p_media, p_suma, p_validos = posiciones
+    if p_media >= 0:
+        np.divide(suma, n, out=salida[p_media], where=centro, casting="unsafe")
+    if p_suma >= 0:
+        salida[p_suma][centro] = suma[centro]
+    if p_validos >= 0:
+        salida[p_validos] = n
+    return salida
+
+
+def _focal_clases_bloque(indices, n_clases, otras, radios, bandas):
+    """Fracción de cada clase y diversidad de Shannon en la ventana.
+
+    ``indices`` es la posición de cada píxel en la lista de clases (con
+    halo); ``n_clases`` marca los píxeles de otras clases válidas y
+    ``n_clases + 1`` los inválidos. Si ``otras`` es verdadero, las demás
+    clases cuentan juntas como una más para la diversidad. Se construye una
+    imagen integral por clase, de a una, para no tener todas en memoria.
+    Devuelve ``(n_clases + 2, filas, columnas)``: las fracciones, la
+    diversidad y el número de píxeles válidos.
+    """
+    ry, rx = radios
+    forma = (indices.shape[0] - 2 * ry, indices.shape[1] - 2 * rx)
+    tipo = _tipo_conteo(indices)
+    n = _sumas_ventana(_integral(indices <= n_clases, tipo), bandas, *forma)
+    centro = (indices[ry : ry + forma[0], rx : rx + forma[1]] <= n_clases) & (n > 0)
+
+    salida = np.full((n_clases + 2,) + forma, np.nan, dtype=np.float32)
+    diversidad = np.zeros(forma, dtype=np.float64)
+    fraccion = np.zeros(forma, dtype=np.float64)
+    for k in range(n_clases + 1 if otras else n_clases):
+        conteo = _sumas_ventana(_integral(indices == k, tipo), bandas, *forma)
+        fraccion[:] = 0.0
+        np.divide(conteo, n, out=fraccion, where=centro & (conteo > 0))
+        diversidad -= fraccion * np.log(np.where(fraccion > 0, fraccion, 1.0))
+        if k < n_clases:
+            salida[k][centro] = fraccion[centro]
+    salida[n_clases][centro] = diversidad[centro]
+    salida[n_clases + 1] = n
+    return salida
+
+
+def _aplicar_con_halo(datos, radios, relleno, funcion, n_capas, *args):
+    """Aplica ``funcion`` a cada bloque con un halo de ``radios`` píxeles.
+
+    Con dask, cada chunk se extiende con los píxeles de sus vecinos y los
+    chunks se procesan en paralelo; fuera del raster se rellena con
+    ``relleno`` (un valor inválido). Devuelve ``(n_capas, filas, columnas)``.
+    """
+    ry, rx = radios
+    # Una ventana más grande que el raster no cabe en el halo de dask: en ese
+    # caso se calcula en memoria
+    if hasattr(datos, "dask") and all(n >= r for n, r in zip(datos.shape, radios)):
+        import dask.array as da
+        from dask.array.overlap import ensure_minimum_chunksize
+
+        # El halo se toma de los chunks vecinos: ninguno puede ser más
+        # angosto que el radio de la ventana
+        datos = datos.rechunk(
+            tuple(
+                ensure_minimum_chunksize(r, chunks) if r else chunks
+                for r, chunks in zip(radios, datos.chunks)
+            )
+        )
+        con_halo = da.overlap.overlap(
+            datos, depth={0: ry, 1: rx}, boundary={0: relleno, 1: relleno}
+        )
+        return con_halo.map_blocks(
+            lambda bloque: funcion(bloque, *args),
+            new_axis=0,
+            chunks=((n_capas,),) + datos.chunks,
+            dtype=np.float32,
+            meta=np.empty((0, 0, 0), dtype=np.float32),
+        )
+    con_halo = np.pad(np.asarray(datos), ((ry, ry), (rx, rx)), constant_values=relleno)
+    return funcion(con_halo, *args)
+
+
+def estadisticas_focales(
+    raster: xr.DataArray,
+    ventana=3,
+    forma: str = "rectangular",
+    estadisticas: tuple | list = ("media",),
+    nodata: float | None = None,
+) -> xr.Dataset:
+    """Media, suma y número de píxeles válidos en una ventana móvil.
+
+    Cada chunk se lee con un halo de media ventana y se procesa con
+    imágenes integrales, por lo que el costo por píxel no depende del tamaño
+    de la ventana (en una ventana circular, solo del número de franjas en
+    que se divide).
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Raster de una banda (en memoria o con dask), por ejemplo un DEM.
+    ventana : int or tuple of int
+        Lado de la ventana en píxeles, o ``(filas, columnas)``; deben ser
+        impares (por ejemplo, ``101``).
+    forma : {"rectangular", "circular"}
+        Con ``"circular"`` se usan los píxeles cuyo centro cae dentro del
+        círculo (o elipse) inscrito en la ventana.
+    estadisticas : tuple of str
+        Cualquier combinación de ``ESTADISTICAS``.
+    nodata : float, optional
+        Valor que se ignora (además de ``NaN``). Por defecto
+        ``raster.rio.nodata``.
+
+    Returns
+    -------
+    xarray.Dataset
+        Una variable ``float32`` por estadística. Las medias y sumas usan
+        solo los píxeles válidos de la ventana (los que caen fuera del
+        raster no cuentan) y quedan en ``NaN`` en los píxeles sin dato.
+    """
+    estadisticas = list(dict.fromkeys(estadisticas))
+    desconocidas = set(estadisticas) - set(ESTADISTICAS)
+    if desconocidas:
+        raise ValueError(f"estadísticas desconocidas: {sorted(desconocidas)}")
+    radios = _radios(ventana)
+    bandas = _bandas(radios, forma)
+    raster = _como_banda_unica(raster).transpose("y", "x")
+    if nodata is None:
+        nodata = raster.rio.nodata
+
+    valores = raster.astype(np.float64)
+    if nodata is not None and not np.isnan(nodata):
+        valores = valores.where(raster != nodata)
+    posiciones = np.array(
+        [estadisticas.index(e) if e in estadisticas else -1 for e in ESTADISTICAS]
+    )
+    apilado = _aplicar_con_halo(
+        valores.data,
+        radios,
+        np.nan,
+        _focal_continuo_bloque,
+        len(estadisticas),
+        radios,
+        bandas,
+        posiciones,
+    )
+    return xr.Dataset(
+        {
+            estadistica: xr.DataArray(
+                apilado[k], dims=("y", "x"), coords=raster.coords
+            ).rio.write_nodata(np.nan, encoded=False)
+            for k, estadistica in enumerate(estadisticas)
+        }
+    )
+
+
+def fracciones_focales(
+    raster: xr.DataArray,
+    ventana=3,
+    forma: str = "rectangular",
+    clases=None,
+    nodata: int | None = None,
+    leyenda: dict | None = None,
+) -> xr.Dataset:
+    """Fracción de cada clase y diversidad de Shannon en una ventana móvil.
+
+    Es la versión focal de :func:`raster_utils.agregar_categorico`: en lugar
+    de celdas fijas, cada píxel recibe la composición de la ventana centrada
+    en él. Se usa una imagen integral por clase, así que consultar una
+    ventana de 101x101 cuesta lo mismo que una de 3x3.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Raster de enteros de una banda (en memoria o con dask).
+    ventana : int or tuple of int
+        Lado de la ventana en píxeles, o ``(filas, columnas)``; impares.
+    forma : {"rectangular", "circular"}
+        Forma de la ventana.
+    clases : array-like, optional
+        Códigos de clase de los que se entrega la fracción. Por defecto,
+        todos los presentes en el raster (lo que requiere una pasada
+        adicional). Los píxeles de las demás clases siguen siendo válidos y
+        cuentan juntos como una sola clase en la diversidad.
+    nodata : int, optional
+        Código que se excluye. Por defecto ``raster.rio.nodata``.
+    leyenda : dict, optional
+        ``{código: nombre}`` para la coordenada ``nombre``. Por defecto, la
+        leyenda de MapBiomas.
+
+    Returns
+    -------
+    xarray.Dataset
+        Con las variables ``fraccion`` (dimensión ``clase``, fracción de los
+        píxeles válidos de la ventana), ``diversidad`` (índice de Shannon,
+        en nats) y ``validos`` (píxeles válidos en la ventana). Los píxeles
+        sin dato quedan en ``NaN``.
+    """
+    raster = _como_banda_unica(raster).transpose("y", "x")
+    if not np.issubdtype(raster.dtype, np.integer):
+        raise ValueError("fracciones_focales requiere un raster de enteros")
+    radios = _radios(ventana)
+    bandas = _bandas(radios, forma)
+    if leyenda is None:
+        leyenda = LEYENDA_MAPBIOMAS
+    if nodata is None:
+        nodata = raster.rio.nodata
+    otras = clases is not None
+    if clases is None:
+        clases = valores_unicos(raster)
+    clases = np.unique(np.asarray(clases, dtype=np.int64))
+    if nodata is not None:
+        clases = clases[clases != nodata]
+    if clases.size == 0:
+        raise ValueError("el raster no tiene clases válidas")
+
+    n_clases = clases.size
+    tipo = np.min_scalar_type(n_clases + 1)
+
+    def _indices(bloque):
+        indices = _indices_de_clase(bloque, clases).astype(tipo)
+        if nodata is not None:
+            indices[bloque == nodata] = n_clases + 1
+        return indices
+
+    datos = raster.data
+    if hasattr(datos, "dask"):
+        indices = datos.map_blocks(_indices, dtype=tipo)
+    else:
+        indices = _indices(np.asarray(datos))
+    apilado = _aplicar_con_halo(
+        indices,
+        radios,
+        n_clases + 1,
+        _focal_clases_bloque,
+        n_clases + 2,
+        n_clases,
+        otras,
+        radios,
+        bandas,
+    )
+
+    coords = dict(raster.coords)
+    fraccion = xr.DataArray(
+        apilado[:n_clases],
+        dims=("clase", "y", "x"),
+        coords={**coords, "clase": clases},
+    )
+    resultado = xr.Dataset(
+        {
+            "fraccion": fraccion,
+            "diversidad": xr.DataArray(
+                apilado[n_clases], dims=("y", "x"), coords=coords
+            ),
+            "validos": xr.DataArray(
+                apilado[n_clases + 1], dims=("y", "x"), coords=coords
+            ),
+        }
+    )
+    return resultado.assign_coords(
+        nombre=("clase", [leyenda.get(int(c), f"Clase {c}") for c in clases])
+    )
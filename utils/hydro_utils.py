@@ -0,0 +1,991 @@
+"""Acondicionamiento hidrológico de DEMs y acumulación de flujo.
+
+Continúa la sección 6 de ``01_datos_raster.py`` para el trabajo con cuencas:
+relleno de depresiones, dirección de flujo (D8 y D-infinito), acumulación de
+flujo y extracción de cauces sobre el DEM reproyectado.
+
+Los DEMs grandes se procesan por teselas, cada una en un hilo con kernels
+compilados con numba, y los resultados de las teselas se concilian en sus
+bordes con un grafo pequeño (de cuencas o de celdas de borde), en lugar de
+recorrer el DEM completo celda por celda con recursión en Python.
+"""
+
+from __future__ import annotations
+
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+from numba import njit, types
+from numba.typed import Dict
+
+from .raster_utils import _como_banda_unica
+
+# Lado (en celdas) de las teselas que se procesan por separado
+LADO_TESELA = 1024
+
+# Desplazamientos de los 8 vecinos, en sentido antihorario desde el este
+DY = np.array([0, -1, -1, -1, 0, 1, 1, 1])
+DX = np.array([1, 1, 0, -1, -1, -1, 0, 1])
+
+# Códigos D8 de ESRI en el mismo orden (1 = este, 128 = noreste, 64 = norte...)
+CODIGOS_D8 = np.array([1, 128, 64, 32, 16, 8, 4, 2], dtype=np.uint8)
+
+# Código D8 de las celdas que vierten fuera del DEM y de las celdas sin dato
+SIN_DIRECCION = 0
+NODATA_D8 = 255
+
+# Estados internos de la dirección D8 (los valores 0 a 7 son una dirección)
+_LLANO = -1
+_SALIDA = -2
+_INVALIDO = -3
+
+# Etiqueta de las celdas que drenan al exterior del DEM
+_OCEANO = 1
+
+# Distancia inicial de las celdas de llano aún no alcanzadas
+_INFINITO = np.iinfo(np.int32).max
+
+METODOS = ("d8", "dinf")
+
+
+@njit(cache=True, nogil=True)
+def _inundar_tesela(z, validos):
+    """Rellena las depresiones de una tesela con priority-flood.
+
+    ``z`` (se modifica) es la tesela y ``validos`` su máscara con un halo de
+    una celda, donde el exterior del DEM es inválido. La inundación parte de
+    las celdas que tocan el exterior o el nodata (etiqueta ``_OCEANO``) y de
+    cada celda del perímetro de la tesela (una etiqueta propia), y cada
+    celda hereda la etiqueta de quien la inunda. Cuando se tocan dos
+    etiquetas se guarda la cota más baja por la que una se derrama en la
+    otra. Las celdas que quedan bajo la cota actual se procesan en una cola
+    simple, sin pasar por el montículo (Barnes et al., 2014).
+
+    Devuelve ``(etiquetas, claves, cotas, n_etiquetas)``, donde cada clave
+    codifica un par de etiquetas como ``a << 32 | b``.
+    """
+    alto, ancho = z.shape
+    etiquetas = np.zeros((alto, ancho), dtype=np.int32)
+    fifo = np.empty(alto * ancho, dtype=np.int64)
+    cabeza = 0
+    cola = 0
+    monticulo = [(0.0, 0, 0)]
+    monticulo.pop()
+    orden = 0
+    siguiente = _OCEANO + 1
+    for y in range(alto):
+        for x in range(ancho):
+            if not validos[y + 1, x + 1]:
+                continue
+            oceano = False
+            for k in range(8):
+                if not validos[y + 1 + DY[k], x + 1 + DX[k]]:
+                    oceano = True
+                    break
+            if oceano:
+                etiquetas[y, x] = _OCEANO
+            elif y == 0 or x == 0 or y == alto - 1 or x == ancho - 1:
+                etiquetas[y, x] = siguiente
+                siguiente += 1
+            else:
+                continue
+            heapq.heappush(monticulo, (z[y, x], orden, y * ancho + x))
+            orden += 1
+
+    aristas = Dict.empty(key_type=types.int64, value_type=types.float64)
+    while cabeza < cola or len(monticulo) > 0:
+        if cabeza < cola:
+            c = fifo[cabeza]
+            cabeza += 1
+        else:
+            c = heapq.heappop(monticulo)[2]
+        y = c // ancho
+        x = c - y * ancho
+        zc = z[y, x]
+        ec = etiquetas[y, x]
+        for k in range(8):
+            ny = y + DY[k]
+            nx = x + DX[k]
+            if ny < 0 or nx < 0 or ny >= alto or nx >= ancho:
+                continue
+            if not validos[ny + 1, nx + 1]:
+                continue
+            en = etiquetas[ny, nx]
+            if en == 0:
+                etiquetas[ny, nx] = ec
+                if z[ny, nx] <= zc:
+                    z[ny, nx] = zc
+                    fifo[cola] = ny * ancho + nx
+                    cola += 1
+                else:
+                    heapq.heappush(monticulo, (z[ny, nx], orden, ny * ancho + nx))
+                    orden += 1
+            elif en != ec:
+                clave = (np.int64(min(en, ec)) << 32) | np.int64(max(en, ec))
+                cota = max(zc, z[ny, nx])
+                if clave not in aristas or cota < aristas[clave]:
+                    aristas[clave] = cota
+
+    claves = np.empty(len(aristas), dtype=np.int64)
+    cotas = np.empty(len(aristas), dtype=np.float64)
+    i = 0
+    for clave, cota in aristas.items():
+        claves[i] = clave
+        cotas[i] = cota
+        i += 1
+    return etiquetas, claves, cotas, siguiente
+
+
+@njit(cache=True, nogil=True)
+def _cotas_derrame(n_etiquetas, inicio, vecinos, cotas):
+    """Cota a la que se derrama cada etiqueta hacia el exterior del DEM.
+
+    Es un priority-flood sobre el grafo de etiquetas (en formato CSR): la
+    cota de una etiqueta es el mínimo, entre todos los caminos hacia
+    ``_OCEANO``, de la arista más alta del camino.
+    """
+    derrame = np.full(n_etiquetas, np.inf)
+    derrame[0] = -np.inf
+    derrame[_OCEANO] = -np.inf
+    monticulo = [(-np.inf, _OCEANO)]
+    while len(monticulo) > 0:
+        cota, u = heapq.heappop(monticulo)
+        if cota > derrame[u]:
+            continue
+        for i in range(inicio[u], inicio[u + 1]):
+            v = vecinos[i]
+            candidata = max(cota, cotas[i])
+            if candidata < derrame[v]:
+                derrame[v] = candidata
+                heapq.heappush(monticulo, (candidata, v))
+    return derrame
+
+
+@njit(cache=True, nogil=True)
+def _d8_tesela(z, cx, cy):
+    """Dirección D8 de mayor pendiente de una tesela con halo de una celda.
+
+    Devuelve, para el interior, la dirección ``0..7`` hacia el vecino más
+    bajo (en pendiente), ``_LLANO`` si ningún vecino es más bajo,
+    ``_SALIDA`` si además toca el exterior o el nodata (vierte fuera del
+    DEM) e ``_INVALIDO`` en las celdas sin dato.
+    """
+    alto, ancho = z.shape[0] - 2, z.shape[1] - 2
+    diagonal = np.sqrt(cx * cx + cy * cy)
+    distancias = np.array([cx, diagonal, cy, diagonal, cx, diagonal, cy, diagonal])
+    salida = np.empty((alto, ancho), dtype=np.int8)
+    for y in range(alto):
+        for x in range(ancho):
+            z0 = z[y + 1, x + 1]
+            if np.isnan(z0):
+                salida[y, x] = _INVALIDO
+                continue
+            mejor = 0.0
+            direccion = _LLANO
+            borde = False
+            for k in range(8):
+                zn = z[y + 1 + DY[k], x + 1 + DX[k]]
+                if np.isnan(zn):
+                    borde = True
+                    continue
+                pendiente = (z0 - zn) / distancias[k]
+                if pendiente > mejor:
+                    mejor = pendiente
+                    direccion = k
+            if direccion == _LLANO and borde:
+                direccion = _SALIDA
+            salida[y, x] = direccion
+    return salida
+
+
+@njit(cache=True, nogil=True)
+def _distancia_llanos(z, direcciones, distancia, solo_halo):
+    """Distancia (en pasos) de cada celda de un llano a su borde de desagüe.
+
+    Los tres arreglos tienen un halo de una celda. Las celdas con dirección
+    o de salida tienen distancia 0; las de llano parten con un valor muy
+    grande. Se propaga (Dijkstra con pasos unitarios) desde las celdas con
+    distancia conocida, incluidas las del halo, a las celdas de llano
+    vecinas con la misma cota. Si el interior ya es consistente (``solo_halo``),
+    basta con propagar desde el halo. Devuelve la distancia del interior.
+    """
+    alto, ancho = z.shape
+    distancia = distancia.copy()
+    monticulo = [(0, 0)]
+    monticulo.pop()
+    for y in range(alto):
+        for x in range(ancho):
+            if solo_halo and 0 < y < alto - 1 and 0 < x < ancho - 1:
+                continue
+            if distancia[y, x] < 0 or distancia[y, x] == _INFINITO:
+                continue
+            for k in range(8):
+                ny = y + DY[k]
+                nx = x + DX[k]
+                if 1 <= ny < alto - 1 and 1 <= nx < ancho - 1:
+                    if direcciones[ny, nx] == _LLANO and z[ny, nx] == z[y, x]:
+                        heapq.heappush(
+                            monticulo, (np.int64(distancia[y, x]), y * ancho + x)
+                        )
+                        break
+    while len(monticulo) > 0:
+        d, c = heapq.heappop(monticulo)
+        y = c // ancho
+        x = c - y * ancho
+        if d > distancia[y, x]:
+            continue
+        for k in range(8):
+            ny = y + DY[k]
+            nx = x + DX[k]
+            if ny < 1 or nx < 1 or ny >= alto - 1 or nx >= ancho - 1:
+                continue
+            if direcciones[ny, nx] != _LLANO or z[ny, nx] != z[y, x]:
+                continue
+            if d + 1 < distancia[ny, nx]:
+                distancia[ny, nx] = d + 1
+                heapq.heappush(monticulo, (d + 1, ny * ancho + nx))
+    return distancia[1:-1, 1:-1]
+
+
+@njit(cache=True, nogil=True)
+def _d8_llanos(z, direcciones, distancia):
+    """Dirige cada celda de llano al vecino de igual cota más cercano al desagüe.
+
+    Los arreglos tienen un halo de una celda. Ante empates se prefieren los
+    vecinos cardinales. Devuelve las direcciones del interior.
+    """
+    alto, ancho = z.shape[0] - 2, z.shape[1] - 2
+    salida = direcciones[1:-1, 1:-1].copy()
+    orden = np.array([0, 2, 4, 6, 1, 3, 5, 7])
+    for y in range(1, alto + 1):
+        for x in range(1, ancho + 1):
+            if direcciones[y, x] != _LLANO:
+                continue
+            mejor = distancia[y, x]
+            for k in orden:
+                ny = y + DY[k]
+                nx = x + DX[k]
+                if z[ny, nx] != z[y, x] or distancia[ny, nx] < 0:
+                    continue
+                if distancia[ny, nx] < mejor:
+                    mejor = distancia[ny, nx]
+                    salida[y - 1, x - 1] = k
+    return salida
+
+
+@njit(cache=True, nogil=True)
+def _dinf_tesela(z, direcciones, cx, cy):
+    """Dirección D-infinito (Tarboton, 1997) de una tesela con halo.
+
+    Se evalúan las 8 facetas triangulares entre la celda, un vecino
+    cardinal y uno diagonal, y se elige la de mayor pendiente. El ángulo se
+    entrega en radianes, en sentido antihorario desde el este y en el
+    espacio de la grilla (las diagonales están a múltiplos de pi/4). Las
+    celdas sin pendiente hacia abajo (llanos) usan su dirección D8 ya
+    resuelta; las de salida quedan en ``-1`` y las inválidas en ``NaN``.
+    """
+    alto, ancho = z.shape[0] - 2, z.shape[1] - 2
+    # Por faceta: vecino cardinal (e1), vecino diagonal (e2), ac y af
+    e1y = np.array([0, -1, -1, 0, 0, 1, 1, 0])
+    e1x = np.array([1, 0, 0, -1, -1, 0, 0, 1])
+    e2y = np.array([-1, -1, -1, -1, 1, 1, 1, 1])
+    e2x = np.array([1, 1, -1, -1, -1, -1, 1, 1])
+    ac = np.array([0.0, 1.0, 1.0, 2.0, 2.0, 3.0, 3.0, 4.0])
+    af = np.array([1.0, -1.0, 1.0, -1.0, 1.0, -1.0, 1.0, -1.0])
+    r_max_x = np.arctan2(cy, cx)
+    r_max_y = np.arctan2(cx, cy)
+    salida = np.full((alto, ancho), np.nan, dtype=np.float32)
+    for y in range(alto):
+        for x in range(ancho):
+            e0 = z[y + 1, x + 1]
+            if np.isnan(e0):
+                continue
+            mejor_s = 0.0
+            mejor_angulo = -1.0
+            for f in range(8):
+                e1 = z[y + 1 + e1y[f], x + 1 + e1x[f]]
+                e2 = z[y + 1 + e2y[f], x + 1 + e2x[f]]
+                if np.isnan(e1) or np.isnan(e2) or (e1 >= e0 and e2 >= e0):
+                    continue
+                d1, d2 = (cx, cy) if e1y[f] == 0 else (cy, cx)
+                r_max = r_max_x if e1y[f] == 0 else r_max_y
+                s1 = (e0 - e1) / d1
+                s2 = (e1 - e2) / d2
+                r = np.arctan2(s2, s1)
+                s = np.sqrt(s1 * s1 + s2 * s2)
+                if r < 0:
+                    r = 0.0
+                    s = s1
+                elif r > r_max:
+                    r = r_max
+                    s = (e0 - e2) / np.sqrt(d1 * d1 + d2 * d2)
+                if s > mejor_s:
+                    mejor_s = s
+                    angulo = ac[f] * np.pi / 2 + af[f] * (r / r_max) * np.pi / 4
+                    mejor_angulo = angulo % (2 * np.pi)
+            if mejor_angulo < 0 and direcciones[y, x] >= 0:
+                mejor_angulo = direcciones[y, x] * np.pi / 4
+            salida[y, x] = mejor_angulo
+    return salida
+
+
+@njit(cache=True, nogil=True)
+def _acumular_tesela(direcciones, pesos):
+    """Acumulación D8 dentro de una tesela, sin mirar sus vecinas.
+
+    Recorre las celdas en orden topológico (cada una después de todas las
+    que le drenan). Devuelve ``(acumulacion, salida)``, donde ``salida`` es,
+    para cada celda, el índice (en la tesela) de la celda por la que su
+    flujo abandona la tesela, o ``-1`` si termina dentro de ella.
+    """
+    alto, ancho = direcciones.shape
+    n = alto * ancho
+    grado = np.zeros(n, dtype=np.int8)
+    destino = np.full(n, -1, dtype=np.int64)
+    for y in range(alto):
+        for x in range(ancho):
+            k = direcciones[y, x]
+            if k < 0:
+                continue
+            ny = y + DY[k]
+            nx = x + DX[k]
+            if 0 <= ny < alto and 0 <= nx < ancho:
+                destino[y * ancho + x] = ny * ancho + nx
+                grado[ny * ancho + nx] += 1
+            else:
+                destino[y * ancho + x] = -2
+
+    orden = np.empty(n, dtype=np.int64)
+    cola = 0
+    for c in range(n):
+        if grado[c] == 0:
+            orden[cola] = c
+            cola += 1
+    acumulacion = pesos.ravel().copy()
+    cabeza = 0
+    while cabeza < cola:
+        c = orden[cabeza]
+        cabeza += 1
+        d = destino[c]
+        if d >= 0:
+            acumulacion[d] += acumulacion[c]
+            grado[d] -= 1
+            if grado[d] == 0:
+                orden[cola] = d
+                cola += 1
+
+    salida = np.full(n, -1, dtype=np.int64)
+    for i in range(cola - 1, -1, -1):
+        c = orden[i]
+        d = destino[c]
+        if d >= 0:
+            salida[c] = salida[d]
+        elif d == -2:
+            salida[c] = c
+    return acumulacion.reshape(alto, ancho), salida
+
+
+@njit(cache=True, nogil=True)
+def _acumular_bosque(siguiente, valores):
+    """Suma ``valores`` aguas abajo en un bosque dado por ``siguiente``."""
+    n = siguiente.size
+    grado = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        if siguiente[i] >= 0:
+            grado[siguiente[i]] += 1
+    total = valores.copy()
+    pila = [i for i in range(n) if grado[i] == 0]
+    while len(pila) > 0:
+        i = pila.pop()
+        j = siguiente[i]
+        if j >= 0:
+            total[j] += total[i]
+            grado[j] -= 1
+            if grado[j] == 0:
+                pila.append(j)
+    return total
+
+
+@njit(cache=True, nogil=True)
+def _acumular_dinf(angulos, pesos):
+    """Acumulación D-infinito: cada celda reparte su flujo entre dos vecinos.
+
+    La proporción de cada vecino depende de la cercanía del ángulo a su
+    dirección (Tarboton, 1997). Se recorre la grilla en orden topológico.
+    """
+    alto, ancho = angulos.shape
+    n = alto * ancho
+    receptores = np.full((n, 2), -1, dtype=np.int64)
+    proporciones = np.zeros((n, 2))
+    grado = np.zeros(n, dtype=np.int8)
+    for y in range(alto):
+        for x in range(ancho):
+            angulo = angulos[y, x]
+            if not angulo >= 0:
+                continue
+            posicion = angulo / (np.pi / 4)
+            k = int(np.floor(posicion)) % 8
+            fraccion = posicion - np.floor(posicion)
+            # Los ángulos se guardan en float32: un ángulo justo sobre una
+            # dirección no debe mandar una fracción ínfima al vecino de al lado
+            if fraccion < 1e-5:
+                fraccion = 0.0
+            elif fraccion > 1 - 1e-5:
+                k = (k + 1) % 8
+                fraccion = 0.0
+            for j in range(2):
+                kk = k if j == 0 else (k + 1) % 8
+                p = 1 - fraccion if j == 0 else fraccion
+                ny = y + DY[kk]
+                nx = x + DX[kk]
+                if p <= 0 or ny < 0 or nx < 0 or ny >= alto or nx >= ancho:
+                    continue
+                if np.isnan(angulos[ny, nx]):
+                    continue
+                receptores[y * ancho + x, j] = ny * ancho + nx
+                proporciones[y * ancho + x, j] = p
+                grado[ny * ancho + nx] += 1
+
+    acumulacion = pesos.ravel().copy()
+    orden = np.empty(n, dtype=np.int64)
+    cola = 0
+    for c in range(n):
+        if grado[c] == 0:
+            orden[cola] = c
+            cola += 1
+    cabeza = 0
+    while cabeza < cola:
+        c = orden[cabeza]
+        cabeza += 1
+        for j in range(2):
+            d = receptores[c, j]
+            if d < 0:
+                continue
+            acumulacion[d] += acumulacion[c] * proporciones[c, j]
+            grado[d] -= 1
+            if grado[d] == 0:
+                orden[cola] = d
+                cola += 1
+    return acumulacion.reshape(alto, ancho)
+
+
+@njit(cache=True, nogil=True)
+def _orden_strahler(direcciones, cauce):
+    """Orden de Strahler de cada celda de cauce (0 fuera de los cauces)."""
+    alto, ancho = direcciones.shape
+    n = alto * ancho
+    grado = np.zeros(n, dtype=np.int8)
+    destino = np.full(n, -1, dtype=np.int64)
+    for y in range(alto):
+        for x in range(ancho):
+            k = direcciones[y, x]
+            if not cauce[y, x] or k < 0:
+                continue
+            ny = y + DY[k]
+            nx = x + DX[k]
+            if 0 <= ny < alto and 0 <= nx < ancho and cauce[ny, nx]:
+                destino[y * ancho + x] = ny * ancho + nx
+                grado[ny * ancho + nx] += 1
+
+    orden = np.zeros(n, dtype=np.uint8)
+    maximo = np.zeros(n, dtype=np.uint8)
+    veces = np.zeros(n, dtype=np.int8)
+    plano = cauce.ravel()
+    pila = [c for c in range(n) if plano[c] and grado[c] == 0]
+    while len(pila) > 0:
+        c = pila.pop()
+        if maximo[c] == 0:
+            orden[c] = 1
+        elif veces[c] >= 2:
+            orden[c] = maximo[c] + 1
+        else:
+            orden[c] = maximo[c]
+        d = destino[c]
+        if d < 0:
+            continue
+        if orden[c] > maximo[d]:
+            maximo[d] = orden[c]
+            veces[d] = 1
+        elif orden[c] == maximo[d]:
+            veces[d] += 1
+        grado[d] -= 1
+        if grado[d] == 0:
+            pila.append(d)
+    return orden.reshape(alto, ancho)
+
+
+def _teselas(alto: int, ancho: int, lado: int) -> list:
+    """Límites ``(fila0, fila1, col0, col1)`` de las teselas de la grilla."""
+    return [
+        (fila0, min(fila0 + lado, alto), col0, min(col0 + lado, ancho))
+        for fila0 in range(0, alto, lado)
+        for col0 in range(0, ancho, lado)
+    ]
+
+
+def _con_halo(arreglo: np.ndarray, tesela: tuple, relleno) -> np.ndarray:
+    """Copia de la tesela con un halo de una celda (``relleno`` fuera)."""
+    fila0, fila1, col0, col1 = tesela
+    alto, ancho = arreglo.shape
+    salida = np.full((fila1 - fila0 + 2, col1 - col0 + 2), relleno, arreglo.dtype)
+    a0, a1 = max(fila0 - 1, 0), min(fila1 + 1, alto)
+    b0, b1 = max(col0 - 1, 0), min(col1 + 1, ancho)
+    salida[a0 - fila0 + 1 : a1 - fila0 + 1, b0 - col0 + 1 : b1 - col0 + 1] = arreglo[
+        a0:a1, b0:b1
+    ]
+    return salida
+
+
+def _mapear(funcion, tareas: list, hilos: int | None) -> list:
+    """Aplica ``funcion`` a cada tarea en un grupo de hilos.
+
+    Los kernels de numba liberan el GIL, así que los hilos se ejecutan en
+    paralelo sin copiar las teselas a otros procesos.
+    """
+    hilos = hilos or os.cpu_count() or 1
+    if hilos == 1 or len(tareas) <= 1:
+        return [funcion(tarea) for tarea in tareas]
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        return list(ejecutor.map(funcion, tareas))
+
+
+def _como_dem(dem: xr.DataArray) -> tuple[xr.DataArray, np.ndarray]:
+    """DEM de una banda en ``(y, x)`` y sus valores ``float64`` con ``NaN``."""
+    dem = _como_banda_unica(dem).transpose("y", "x")
+    z = np.asarray(dem.values, dtype=np.float64)
+    if dem.rio.nodata is not None and not np.isnan(dem.rio.nodata):
+        z = np.where(z == dem.rio.nodata, np.nan, z)
+    return dem, z
+
+
+def _aristas_costuras(etiquetas, z, teselas) -> tuple[np.ndarray, ...]:
+    """Aristas entre etiquetas de teselas vecinas, a lo largo de sus costuras."""
+    alto, ancho = z.shape
+    filas = sorted({t[0] for t in teselas} - {0})
+    columnas = sorted({t[2] for t in teselas} - {0})
+    pares = []
+    for fila in filas:
+        for dx in (-1, 0, 1):
+            a = (slice(fila - 1, fila), slice(max(0, -dx), ancho - max(0, dx)))
+            b = (slice(fila, fila + 1), slice(max(0, dx), ancho - max(0, -dx)))
+            pares.append((a, b))
+    for col in columnas:
+        for dy in (-1, 0, 1):
+            a = (slice(max(0, -dy), alto - max(0, dy)), slice(col - 1, col))
+            b = (slice(max(0, dy), alto - max(0, -dy)), slice(col, col + 1))
+            pares.append((a, b))
+
+    origen, destino, cotas = [], [], []
+    for a, b in pares:
+        ea, eb = etiquetas[a].ravel(), etiquetas[b].ravel()
+        validas = (ea > 0) & (eb > 0) & (ea != eb)
+        origen.append(ea[validas])
+        destino.append(eb[validas])
+        cotas.append(np.maximum(z[a].ravel()[validas], z[b].ravel()[validas]))
+    if not origen:
+        vacio = np.empty(0, dtype=np.int64)
+        return vacio, vacio, np.empty(0)
+    return (
+        np.concatenate(origen).astype(np.int64),
+        np.concatenate(destino).astype(np.int64),
+        np.concatenate(cotas),
+    )
+
+
+def _rellenar(z: np.ndarray, lado: int, hilos: int | None) -> np.ndarray:
+    """Relleno de depresiones por teselas (Barnes, 2016).
+
+    Cada tesela se inunda por separado desde su perímetro, etiquetando las
+    celdas según la celda del perímetro (o el exterior del DEM) que las
+    inundó. Luego, en el grafo de etiquetas se calcula la cota de derrame de
+    cada una hacia el exterior, y cada celda se eleva a la cota de derrame
+    de su etiqueta.
+    """
+    alto, ancho = z.shape
+    validos = ~np.isnan(z)
+    teselas = _teselas(alto, ancho, lado)
+
+    def _procesar(tesela):
+        fila0, fila1, col0, col1 = tesela
+        relleno = z[fila0:fila1, col0:col1].copy()
+        resultado = _inundar_tesela(relleno, _con_halo(validos, tesela, False))
+        return (relleno,) + resultado
+
+    relleno = np.empty_like(z)
+    etiquetas = np.zeros((alto, ancho), dtype=np.int32)
+    origen, destino, cotas = [], [], []
+    base = _OCEANO + 1
+    for tesela, (parcial, locales, claves, cotas_tesela, n) in zip(
+        teselas, _mapear(_procesar, teselas, hilos)
+    ):
+        fila0, fila1, col0, col1 = tesela
+        # Etiquetas globales: el exterior conserva la suya y el resto se desplaza
+        desplazamiento = base - (_OCEANO + 1)
+        globales = np.where(locales > _OCEANO, locales + desplazamiento, locales)
+        relleno[fila0:fila1, col0:col1] = parcial
+        etiquetas[fila0:fila1, col0:col1] = globales
+        a, b = claves >> 32, claves & 0xFFFFFFFF
+        origen.append(np.where(a > _OCEANO, a + desplazamiento, a))
+        destino.append(np.where(b > _OCEANO, b + desplazamiento, b))
+        cotas.append(cotas_tesela)
+        base += n - (_OCEANO + 1)
+
+    a, b, c = _aristas_costuras(etiquetas, relleno, teselas)
+    origen = np.concatenate(origen + [a])
+    destino = np.concatenate(destino + [b])
+    cotas = np.concatenate(cotas + [c])
+
+    # Grafo no dirigido en formato CSR
+    u = np.concatenate([origen, destino])
+    v = np.concatenate([destino, origen])
+    w = np.concatenate([cotas, cotas])
+    orden = np.argsort(u, kind="stable")
+    inicio = np.searchsorted(u[orden], np.arange(base + 1))
+    derrame = _cotas_derrame(base, inicio, v[orden], w[orden])
+    return np.maximum(relleno, derrame[etiquetas])
+
+
+def _direcciones_d8(z: np.ndarray, cx, cy, lado: int, hilos: int | None):
+    """Direcciones D8 internas (``0..7`` o estados) con llanos resueltos.
+
+    Los llanos que cruzan teselas se resuelven por rondas: en cada ronda
+    las teselas con llanos propagan la distancia al desagüe usando como
+    halo la distancia de sus vecinas en la ronda anterior, hasta que
+    ninguna cambia.
+    """
+    alto, ancho = z.shape
+    teselas = _teselas(alto, ancho, lado)
+    locales = _mapear(
+        lambda t: _d8_tesela(_con_halo(z, t, np.nan), cx, cy), teselas, hilos
+    )
+    direcciones = np.empty((alto, ancho), dtype=np.int8)
+    for (fila0, fila1, col0, col1), parcial in zip(teselas, locales):
+        direcciones[fila0:fila1, col0:col1] = parcial
+
+    distancia = np.where(direcciones == _LLANO, _INFINITO, 0).astype(np.int32)
+    distancia[direcciones == _INVALIDO] = -1
+    con_llanos = {
+        i
+        for i, (fila0, fila1, col0, col1) in enumerate(teselas)
+        if (direcciones[fila0:fila1, col0:col1] == _LLANO).any()
+    }
+    por_fila = -(-ancho // lado)
+    pendientes = set(con_llanos)
+    solo_halo = False
+    while pendientes:
+        lista = sorted(pendientes)
+        nuevas = _mapear(
+            lambda i: _distancia_llanos(
+                _con_halo(z, teselas[i], np.nan),
+                _con_halo(direcciones, teselas[i], _INVALIDO),
+                _con_halo(distancia, teselas[i], -1),
+                solo_halo,
+            ),
+            lista,
+            hilos,
+        )
+        pendientes = set()
+        solo_halo = True
+        for i, nueva in zip(lista, nuevas):
+            fila0, fila1, col0, col1 = teselas[i]
+            if np.array_equal(nueva, distancia[fila0:fila1, col0:col1]):
+                continue
+            distancia[fila0:fila1, col0:col1] = nueva
+            fila, col = divmod(i, por_fila)
+            for df in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    vecina = (fila + df) * por_fila + (col + dc)
+                    if (df or dc) and 0 <= col + dc < por_fila and vecina in con_llanos:
+                        pendientes.add(vecina)
+
+    resueltas = _mapear(
+        lambda i: _d8_llanos(
+            _con_halo(z, teselas[i], np.nan),
+            _con_halo(direcciones, teselas[i], _INVALIDO),
+            _con_halo(distancia, teselas[i], -1),
+        ),
+        sorted(con_llanos),
+        hilos,
+    )
+    for i, parcial in zip(sorted(con_llanos), resueltas):
+        fila0, fila1, col0, col1 = teselas[i]
+        direcciones[fila0:fila1, col0:col1] = parcial
+    return direcciones
+
+
+def _acumular_d8(direcciones, pesos, lado: int, hilos: int | None) -> np.ndarray:
+    """Acumulación D8 por teselas con conciliación en sus bordes (Barnes, 2017).
+
+    Primero cada tesela acumula su propio flujo y registra por qué celda de
+    su perímetro sale cada celda. Con eso se arma un bosque pequeño sobre
+    las celdas de salida de todas las teselas, donde se calcula el flujo que
+    entra a cada tesela desde sus vecinas. Finalmente, cada tesela que
+    recibe flujo lo acumula aguas abajo y lo suma al de la primera pasada.
+    """
+    alto, ancho = direcciones.shape
+    teselas = _teselas(alto, ancho, lado)
+
+    def _procesar(tesela):
+        fila0, fila1, col0, col1 = tesela
+        return _acumular_tesela(
+            direcciones[fila0:fila1, col0:col1], pesos[fila0:fila1, col0:col1]
+        )
+
+    acumulacion = np.empty((alto, ancho), dtype=np.float64)
+    perimetros, salidas = [], []
+    for tesela, (parcial, salida) in zip(teselas, _mapear(_procesar, teselas, hilos)):
+        fila0, fila1, col0, col1 = tesela
+        acumulacion[fila0:fila1, col0:col1] = parcial
+        a, b = fila1 - fila0, col1 - col0
+        yy, xx = np.indices((a, b))
+        borde = ((yy == 0) | (xx == 0) | (yy == a - 1) | (xx == b - 1)).ravel()
+        local = np.flatnonzero(borde)
+        destino = salida[local]
+        perimetros.append((local // b + fila0) * ancho + local % b + col0)
+        salidas.append(
+            np.where(
+                destino >= 0, (destino // b + fila0) * ancho + destino % b + col0, -1
+            )
+        )
+    perimetro = np.concatenate(perimetros)
+    salida = np.concatenate(salidas)
+
+    # Celdas de salida: su flujo pasa a la celda vecina de otra tesela, y de
+    # ahí a la celda de salida de esa tesela
+    orden = np.argsort(perimetro)
+    perimetro, salida = perimetro[orden], salida[orden]
+    es_salida = salida == perimetro
+    celdas = perimetro[es_salida]
+    k = direcciones.ravel()[celdas]
+    receptor = celdas + DY[k] * ancho + DX[k]
+    nodo_receptor = np.searchsorted(perimetro, receptor)
+    salida_receptor = salida[nodo_receptor]
+    indice_salida = np.full(perimetro.size, -1, dtype=np.int64)
+    indice_salida[es_salida] = np.arange(celdas.size)
+    siguiente = np.where(
+        salida_receptor >= 0,
+        indice_salida[np.searchsorted(perimetro, np.maximum(salida_receptor, 0))],
+        -1,
+    )
+    flujo = _acumular_bosque(siguiente, acumulacion.ravel()[celdas])
+
+    entrante = np.zeros((alto, ancho), dtype=np.float64)
+    np.add.at(entrante.ravel(), receptor, flujo)
+    receptoras = [t for t in teselas if entrante[t[0] : t[1], t[2] : t[3]].any()]
+
+    def _propagar(tesela):
+        fila0, fila1, col0, col1 = tesela
+        return _acumular_tesela(
+            direcciones[fila0:fila1, col0:col1], entrante[fila0:fila1, col0:col1]
+        )[0]
+
+    for tesela, extra in zip(receptoras, _mapear(_propagar, receptoras, hilos)):
+        fila0, fila1, col0, col1 = tesela
+        acumulacion[fila0:fila1, col0:col1] += extra
+    return acumulacion
+
+
+def _georreferenciar(datos, dem: xr.DataArray, nombre: str, nodata, attrs: dict):
+    """Empaqueta ``datos`` con las coordenadas y el CRS de ``dem``."""
+    resultado = xr.DataArray(
+        datos, dims=("y", "x"), coords=dem.coords, name=nombre, attrs=attrs
+    )
+    return resultado.rio.write_nodata(nodata, encoded=False)
+
+
+def rellenar_depresiones(
+    dem: xr.DataArray,
+    lado_tesela: int = LADO_TESELA,
+    hilos: int | None = None,
+) -> xr.DataArray:
+    """Rellena las depresiones de un DEM con priority-flood por teselas.
+
+    Cada celda queda a la cota mínima que le permite drenar hacia el borde
+    del DEM (o hacia una celda sin dato) sin subir; las depresiones quedan
+    como llanos, que :func:`direccion_flujo` resuelve. El resultado es el
+    mismo que inundar el DEM completo de una vez, pero cada tesela se
+    inunda en paralelo y con su propio montículo; las teselas se concilian
+    con un grafo de sus cuencas internas (Barnes, 2016).
+
+    Parameters
+    ----------
+    dem : xarray.DataArray
+        DEM de una banda (se carga en memoria si es un arreglo de dask).
+    lado_tesela : int
+        Lado de las teselas en celdas.
+    hilos : int, optional
+        Número de hilos. Por defecto, todos los núcleos.
+
+    Returns
+    -------
+    xarray.DataArray
+        DEM rellenado (``float32``), con ``NaN`` en las celdas sin dato.
+    """
+    dem, z = _como_dem(dem)
+    relleno = _rellenar(z, int(lado_tesela), hilos).astype(np.float32)
+    return _georreferenciar(relleno, dem, "relleno", np.nan, dict(dem.attrs))
+
+
+def direccion_flujo(
+    dem: xr.DataArray,
+    metodo: str = "d8",
+    lado_tesela: int = LADO_TESELA,
+    hilos: int | None = None,
+) -> xr.DataArray:
+    """Dirección de flujo de un DEM rellenado.
+
+    La dirección D8 apunta al vecino con mayor pendiente hacia abajo. En
+    los llanos (por ejemplo, las depresiones rellenadas) cada celda apunta
+    al vecino de igual cota más cercano a un borde por donde el llano
+    desagua, de modo que todo el flujo llega al borde del DEM.
+
+    Parameters
+    ----------
+    dem : xarray.DataArray
+        DEM rellenado con :func:`rellenar_depresiones`, en un CRS proyectado.
+    metodo : {"d8", "dinf"}
+        ``"d8"``: códigos de ESRI (1 este, 2 sureste, 4 sur, 8 suroeste, 16
+        oeste, 32 noroeste, 64 norte, 128 noreste), ``0`` en las celdas que
+        vierten fuera del DEM y ``255`` sin dato. ``"dinf"``: ángulo
+        D-infinito de Tarboton en radianes (antihorario desde el este),
+        ``-1`` en las celdas que vierten fuera del DEM y ``NaN`` sin dato.
+    lado_tesela : int
+        Lado de las teselas en celdas.
+    hilos : int, optional
+        Número de hilos. Por defecto, todos los núcleos.
+
+    Returns
+    -------
+    xarray.DataArray
+        Direcciones, con el atributo ``metodo``.
+    """
+    if metodo not in METODOS:
+        raise ValueError(f"metodo debe ser uno de {METODOS}")
+    dem, z = _como_dem(dem)
+    cx, cy = (abs(r) for r in dem.rio.resolution())
+    lado = int(lado_tesela)
+    direcciones = _direcciones_d8(z, cx, cy, lado, hilos)
+
+    if metodo == "d8":
+        codigos = np.full(direcciones.shape, NODATA_D8, dtype=np.uint8)
+        validas = direcciones >= 0
+        codigos[validas] = CODIGOS_D8[direcciones[validas]]
+        codigos[direcciones == _SALIDA] = SIN_DIRECCION
+        return _georreferenciar(codigos, dem, "direccion", NODATA_D8, {"metodo": "d8"})
+
+    teselas = _teselas(*z.shape, lado)
+    parciales = _mapear(
+        lambda t: _dinf_tesela(
+            _con_halo(z, t, np.nan), direcciones[t[0] : t[1], t[2] : t[3]], cx, cy
+        ),
+        teselas,
+        hilos,
+    )
+    angulos = np.empty(z.shape, dtype=np.float32)
+    for (fila0, fila1, col0, col1), parcial in zip(teselas, parciales):
+        angulos[fila0:fila1, col0:col1] = parcial
+    return _georreferenciar(
+        angulos, dem, "direccion", np.nan, {"metodo": "dinf", "units": "radianes"}
+    )
+
+
+def _indices_d8(direccion: xr.DataArray) -> np.ndarray:
+    """Códigos D8 de ESRI a índices internos (``-1`` sin dirección)."""
+    tabla = np.full(256, -1, dtype=np.int8)
+    tabla[CODIGOS_D8] = np.arange(8)
+    return tabla[np.asarray(direccion.values, dtype=np.uint8)]
+
+
+def acumulacion_flujo(
+    direccion: xr.DataArray,
+    pesos: xr.DataArray | None = None,
+    lado_tesela: int = LADO_TESELA,
+    hilos: int | None = None,
+) -> xr.DataArray:
+    """Número de celdas (o suma de ``pesos``) que drena a cada celda.
+
+    Incluye a la propia celda. Con direcciones D8 se acumula por teselas en
+    paralelo y se concilian los bordes con un bosque de las celdas por donde
+    el flujo sale de cada tesela (Barnes, 2017). Con D-infinito el flujo se
+    reparte entre dos vecinos y se acumula en una pasada compilada sobre la
+    grilla completa.
+
+    Parameters
+    ----------
+    direccion : xarray.DataArray
+        Resultado de :func:`direccion_flujo`.
+    pesos : xarray.DataArray, optional
+        Aporte de cada celda (por ejemplo, precipitación). Por defecto, 1
+        por celda; multiplicando por el área de la celda se obtiene el área
+        aportante.
+    lado_tesela : int
+        Lado de las teselas en celdas (solo D8).
+    hilos : int, optional
+        Número de hilos. Por defecto, todos los núcleos.
+
+    Returns
+    -------
+    xarray.DataArray
+        Acumulación ``float64``, con ``NaN`` en las celdas sin dato.
+    """
+    direccion = _como_banda_unica(direccion).transpose("y", "x")
+    metodo = direccion.attrs.get("metodo", "d8")
+    if metodo == "d8":
+        invalidas = np.asarray(direccion.values) == NODATA_D8
+    else:
+        invalidas = np.isnan(np.asarray(direccion.values))
+    if pesos is None:
+        valores = np.where(invalidas, 0.0, 1.0)
+    else:
+        valores = np.asarray(
+            _como_banda_unica(pesos).transpose("y", "x").values, dtype=np.float64
+        )
+        valores = np.where(invalidas | np.isnan(valores), 0.0, valores)
+
+    if metodo == "d8":
+        acumulacion = _acumular_d8(
+            _indices_d8(direccion), valores, int(lado_tesela), hilos
+        )
+    else:
+        acumulacion = _acumular_dinf(np.asarray(direccion.values), valores)
+    acumulacion[invalidas] = np.nan
+    return _georreferenciar(
+        acumulacion, direccion, "acumulacion", np.nan, {"metodo": metodo}
+    )
+
+
+def extraer_cauces(
+    direccion: xr.DataArray,
+    acumulacion: xr.DataArray,
+    umbral: float,
+) -> xr.DataArray:
+    """Red de cauces: celdas con acumulación mayor o igual que ``umbral``.
+
+    Parameters
+    ----------
+    direccion : xarray.DataArray
+        Direcciones D8 de :func:`direccion_flujo`.
+    acumulacion : xarray.DataArray
+        Resultado de :func:`acumulacion_flujo` (con direcciones D8 o
+        D-infinito).
+    umbral : float
+        Acumulación mínima, en celdas (o en las unidades de ``pesos``). Por
+        ejemplo, para 1 km² de área aportante con celdas de 30 m,
+        ``1e6 / 30**2``.
+
+    Returns
+    -------
+    xarray.DataArray
+        Orden de Strahler (``uint8``) de cada celda de cauce; ``0`` fuera de
+        los cauces.
+    """
+    direccion = _como_banda_unica(direccion).transpose("y", "x")
+    if direccion.attrs.get("metodo", "d8") != "d8":
+        raise ValueError("extraer_cauces requiere direcciones D8")
+    acumulacion = _como_banda_unica(acumulacion).transpose("y", "x")
+    cauce = np.nan_to_num(np.asarray(acumulacion.values), nan=-np.inf) >= umbral
+    orden = _orden_strahler(_indices_d8(direccion), cauce)
+    return _georreferenciar(orden, direccion, "cauces", 0, {"umbral": umbral})
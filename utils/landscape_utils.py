@@ -0,0 +1,337 @@
+"""Métricas de paisaje a partir de parches de cobertura de suelo.
+
+Un parche es un conjunto conexo de píxeles de la misma clase, por ejemplo
+un fragmento de Bosque (3) o de Plantación Forestal (9) en la cobertura de
+MapBiomas. Los parches se etiquetan chunk por chunk y se unen a través de
+los bordes de los chunks, por lo que el raster nunca se carga completo.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from . import raster_utils
+from .raster_utils import _area_pixel_m2, _como_banda_unica, _parciales_por_bloque
+
+
+def _largos_bordes(raster: xr.DataArray) -> tuple[np.ndarray, np.ndarray]:
+    """Largo en metros de los bordes horizontales y verticales de los píxeles.
+
+    Devuelve ``(ancho_bordes, alto_filas)``: el ancho de un píxel en cada
+    uno de los ``alto + 1`` límites entre filas y la altura de un píxel de
+    cada fila. En un CRS geográfico se miden sobre el elipsoide (el ancho
+    disminuye con la latitud); en uno proyectado son constantes.
+    """
+    crs = raster.rio.crs
+    transform = raster.rio.transform()
+    alto = raster.rio.height
+    if not crs.is_geographic:
+        factor = crs.linear_units_factor[1]
+        return (
+            np.full(alto + 1, abs(transform.a) * factor),
+            np.full(alto, abs(transform.e) * factor),
+        )
+
+    from pyproj import CRS, Geod
+
+    elipsoide = CRS.from_user_input(crs.to_wkt()).ellipsoid
+    geod = Geod(a=elipsoide.semi_major_metre, b=elipsoide.semi_minor_metre)
+    latitudes = transform.f + transform.e * np.arange(alto + 1)
+    ceros = np.zeros(alto + 1)
+    _, _, ancho_bordes = geod.inv(ceros, latitudes, ceros + abs(transform.a), latitudes)
+    _, _, alto_filas = geod.inv(ceros[:-1], latitudes[:-1], ceros[:-1], latitudes[1:])
+    return np.asarray(ancho_bordes), np.asarray(alto_filas)
+
+
+def _parches_bloque(bloque, ventana, clases, conectividad, forma, nodata, largos):
+    """Etiqueta los parches de un chunk y calcula sus métricas parciales.
+
+    Las etiquetas son locales al chunk (1, 2, ...; 0 fuera de las clases).
+    El perímetro incluye los bordes interiores del chunk y los del límite
+    del raster; los bordes con los chunks vecinos se agregan al unirlos.
+    También se devuelven las filas y columnas extremas (valores y
+    etiquetas) para esa unión.
+    """
+    bloque = np.asarray(bloque)
+    fila0, fila1, col0, col1 = ventana
+    alto_total, ancho_total = forma
+    area_filas, ancho_bordes, alto_filas = largos
+
+    estructura = ndimage.generate_binary_structure(2, 1 if conectividad == 4 else 2)
+    etiquetas = np.zeros(bloque.shape, dtype=np.int32)
+    codigos = []
+    for codigo in clases:
+        mascara = bloque == codigo
+        locales, n = ndimage.label(mascara, structure=estructura)
+        etiquetas[mascara] = locales[mascara] + len(codigos)
+        codigos.extend([codigo] * n)
+    n = len(codigos)
+
+    # Largo de borde que aporta cada píxel: cada lado que limita con otro
+    # valor o con el límite del raster
+    perimetro = np.zeros(bloque.shape)
+    distinto = bloque[1:] != bloque[:-1]
+    largo = ancho_bordes[fila0 + 1 : fila1, None]
+    perimetro[:-1] += distinto * largo
+    perimetro[1:] += distinto * largo
+    if fila0 == 0:
+        perimetro[0] += ancho_bordes[0]
+    if fila1 == alto_total:
+        perimetro[-1] += ancho_bordes[alto_total]
+    distinto = bloque[:, 1:] != bloque[:, :-1]
+    largo = alto_filas[fila0:fila1, None]
+    perimetro[:, :-1] += distinto * largo
+    perimetro[:, 1:] += distinto * largo
+    if col0 == 0:
+        perimetro[:, 0] += alto_filas[fila0:fila1]
+    if col1 == ancho_total:
+        perimetro[:, -1] += alto_filas[fila0:fila1]
+
+    planas = etiquetas.ravel()
+    area = np.broadcast_to(area_filas[fila0:fila1, None], bloque.shape).ravel()
+    validos = np.ones(bloque.shape, dtype=bool) if nodata is None else bloque != nodata
+    return {
+        "codigos": np.asarray(codigos, dtype=np.int64),
+        "pixeles": np.bincount(planas, minlength=n + 1)[1:],
+        "area": np.bincount(planas, weights=area, minlength=n + 1)[1:],
+        "perimetro": np.bincount(planas, weights=perimetro.ravel(), minlength=n + 1)[
+            1:
+        ],
+        "area_paisaje": float(validos.sum(axis=1) @ area_filas[fila0:fila1]),
+        "bordes": {
+            "arriba": (bloque[0], etiquetas[0]),
+            "abajo": (bloque[-1], etiquetas[-1]),
+            "izquierda": (bloque[:, 0], etiquetas[:, 0]),
+            "derecha": (bloque[:, -1], etiquetas[:, -1]),
+        },
+    }
+
+
+def _costura(a, b, base_a, base_b, largo, conectividad, pares, extra):
+    """Une las etiquetas de dos chunks vecinos a lo largo de su borde común.
+
+    ``a`` y ``b`` son ``(valores, etiquetas)`` de las dos franjas enfrentadas
+    y ``largo`` es el largo del borde de cada par de píxeles. Se agregan a
+    ``pares`` las etiquetas globales que pertenecen al mismo parche y a
+    ``extra`` el perímetro que aporta el borde común cuando los valores
+    difieren.
+    """
+    valores_a, etiquetas_a = a
+    valores_b, etiquetas_b = b
+    igual = valores_a == valores_b
+    unidos = igual & (etiquetas_a > 0) & (etiquetas_b > 0)
+    pares.append((base_a + etiquetas_a[unidos], base_b + etiquetas_b[unidos]))
+    for etiquetas, base in ((etiquetas_a, base_a), (etiquetas_b, base_b)):
+        con_borde = ~igual & (etiquetas > 0)
+        extra.append(
+            (
+                base + etiquetas[con_borde],
+                np.broadcast_to(largo, igual.shape)[con_borde],
+            )
+        )
+    if conectividad == 8:
+        for i, j in (
+            (slice(None, -1), slice(1, None)),
+            (slice(1, None), slice(None, -1)),
+        ):
+            unidos = (
+                (valores_a[i] == valores_b[j])
+                & (etiquetas_a[i] > 0)
+                & (etiquetas_b[j] > 0)
+            )
+            pares.append(
+                (base_a + etiquetas_a[i][unidos], base_b + etiquetas_b[j][unidos])
+            )
+
+
+def metricas_parches(
+    raster: xr.DataArray,
+    clases=(3, 9),
+    conectividad: int = 8,
+    nodata: int | None = None,
+    leyenda: dict | None = None,
+    scheduler: str | None = None,
+) -> dict:
+    """Identifica los parches de las clases pedidas y calcula sus métricas.
+
+    Cada chunk se etiqueta por separado con ``scipy.ndimage.label`` (en
+    paralelo con dask); luego las etiquetas que se tocan a través de los
+    bordes entre chunks se unen con una búsqueda de componentes conexas
+    (unión-búsqueda) y las métricas parciales de cada chunk se suman por
+    parche. Solo se conservan en memoria las métricas por etiqueta y las
+    filas y columnas de borde de cada chunk.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Cobertura de suelo de una banda (en memoria o con dask) con CRS.
+    clases : sequence of int
+        Códigos cuyos parches se analizan. Por defecto, Bosque (3) y
+        Plantación Forestal (9) de MapBiomas.
+    conectividad : {4, 8}
+        Vecindad que define un parche: solo por los lados (4) o también por
+        las esquinas (8, la regla habitual en FRAGSTATS).
+    nodata : int, optional
+        Código fuera del paisaje. Por defecto ``raster.rio.nodata``.
+    leyenda : dict, optional
+        ``{código: nombre}``. Por defecto, la leyenda de MapBiomas.
+    scheduler : str, optional
+        Planificador de dask.
+
+    Returns
+    -------
+    dict
+        ``"parches"``: un ``pandas.DataFrame`` con una fila por parche
+        (``codigo``, ``clase``, ``pixeles``, ``area_ha``, ``perimetro_m``).
+        ``"clases"``: un ``pandas.DataFrame`` con una fila por clase con el
+        número de parches, el área total y media, el porcentaje del paisaje,
+        el borde total (``borde_m``), la densidad de borde (m/ha), la
+        densidad de parches (por 100 ha) y el índice del parche mayor (% del
+        paisaje). El paisaje es el área de los píxeles distintos de
+        ``nodata``; el borde incluye el límite del raster.
+    """
+    if conectividad not in (4, 8):
+        raise ValueError("conectividad debe ser 4 u 8")
+    raster = _como_banda_unica(raster).transpose("y", "x")
+    if not np.issubdtype(raster.dtype, np.integer):
+        raise ValueError("metricas_parches requiere un raster de enteros")
+    if leyenda is None:
+        leyenda = raster_utils.LEYENDA_MAPBIOMAS
+    if nodata is None:
+        nodata = raster.rio.nodata
+    clases = [int(c) for c in clases]
+
+    area_pixel = _area_pixel_m2(raster)
+    area_filas = np.broadcast_to(area_pixel, (raster.rio.height,))
+    largos = (area_filas, *_largos_bordes(raster))
+    datos = raster.data
+    parciales = _parciales_por_bloque(
+        datos, _parches_bloque, clases, conectividad, raster.shape, nodata, largos
+    )
+    if hasattr(datos, "dask"):
+        import dask
+
+        parciales = dask.compute(*parciales, scheduler=scheduler)
+        grilla = datos.numblocks
+        limites_filas = np.cumsum((0,) + datos.chunks[0])
+    else:
+        grilla = (1, 1)
+        limites_filas = np.array([0, raster.shape[0]])
+
+    # Etiqueta global = base del chunk + etiqueta local - 1
+    cantidades = [len(p["codigos"]) for p in parciales]
+    bases = np.concatenate([[0], np.cumsum(cantidades)[:-1]]) - 1
+    bloques = np.arange(len(parciales)).reshape(grilla)
+    ancho_bordes, alto_filas = largos[1:]
+    pares = []
+    extra = []
+    for i in range(grilla[0]):
+        for j in range(grilla[1]):
+            actual = parciales[bloques[i, j]]
+            base = bases[bloques[i, j]]
+            filas = slice(limites_filas[i], limites_filas[i + 1])
+            if j + 1 < grilla[1]:
+                vecino = bloques[i, j + 1]
+                _costura(
+                    actual["bordes"]["derecha"],
+                    parciales[vecino]["bordes"]["izquierda"],
+                    base,
+                    bases[vecino],
+                    alto_filas[filas],
+                    conectividad,
+                    pares,
+                    extra,
+                )
+            if i + 1 < grilla[0]:
+                vecino = bloques[i + 1, j]
+                _costura(
+                    actual["bordes"]["abajo"],
+                    parciales[vecino]["bordes"]["arriba"],
+                    base,
+                    bases[vecino],
+                    ancho_bordes[limites_filas[i + 1]],
+                    conectividad,
+                    pares,
+                    extra,
+                )
+            if conectividad == 8 and i + 1 < grilla[0]:
+                # Esquinas: diagonal con los chunks de abajo a la derecha y
+                # abajo a la izquierda
+                for dj, propio, ajeno in ((1, -1, 0), (-1, 0, -1)):
+                    if not 0 <= j + dj < grilla[1]:
+                        continue
+                    vecino = bloques[i + 1, j + dj]
+                    valores_a, etiquetas_a = actual["bordes"]["abajo"]
+                    valores_b, etiquetas_b = parciales[vecino]["bordes"]["arriba"]
+                    if (
+                        valores_a[propio] == valores_b[ajeno]
+                        and etiquetas_a[propio] > 0
+                        and etiquetas_b[ajeno] > 0
+                    ):
+                        pares.append(
+                            (
+                                np.array([base + etiquetas_a[propio]]),
+                                np.array([bases[vecino] + etiquetas_b[ajeno]]),
+                            )
+                        )
+
+    n = int(sum(cantidades))
+    codigos = np.concatenate([p["codigos"] for p in parciales])
+    origen = np.concatenate([a for a, _ in pares]) if pares else np.zeros(0, int)
+    destino = np.concatenate([b for _, b in pares]) if pares else np.zeros(0, int)
+    grafo = coo_matrix((np.ones(origen.size), (origen, destino)), shape=(n, n))
+    _, parche = connected_components(grafo, directed=False)
+
+    perimetro = np.concatenate([p["perimetro"] for p in parciales])
+    for etiquetas, largo in extra:
+        np.add.at(perimetro, etiquetas, largo)
+    n_parches = int(parche.max()) + 1 if n else 0
+    codigo_parche = np.zeros(n_parches, dtype=np.int64)
+    codigo_parche[parche] = codigos
+
+    tabla = pd.DataFrame(
+        {
+            "codigo": codigo_parche,
+            "clase": [leyenda.get(int(c), f"Clase {c}") for c in codigo_parche],
+            "pixeles": np.bincount(
+                parche,
+                weights=np.concatenate([p["pixeles"] for p in parciales]),
+                minlength=n_parches,
+            ).astype(np.int64),
+            "area_ha": np.bincount(
+                parche,
+                weights=np.concatenate([p["area"] for p in parciales]),
+                minlength=n_parches,
+            )
+            / 10_000,
+            "perimetro_m": np.bincount(parche, weights=perimetro, minlength=n_parches),
+        }
+    )
+    tabla.index.name = "parche"
+
+    paisaje_ha = sum(p["area_paisaje"] for p in parciales) / 10_000
+    por_clase = (
+        tabla.groupby("codigo")
+        .agg(
+            clase=("clase", "first"),
+            n_parches=("area_ha", "size"),
+            area_ha=("area_ha", "sum"),
+            area_media_ha=("area_ha", "mean"),
+            parche_mayor_ha=("area_ha", "max"),
+            borde_m=("perimetro_m", "sum"),
+        )
+        .reindex(clases)
+    )
+    por_clase["clase"] = [leyenda.get(c, f"Clase {c}") for c in clases]
+    por_clase = por_clase.fillna({"n_parches": 0, "area_ha": 0.0, "borde_m": 0.0})
+    por_clase["n_parches"] = por_clase["n_parches"].astype(np.int64)
+    por_clase["porcentaje_paisaje"] = 100 * por_clase["area_ha"] / paisaje_ha
+    por_clase["densidad_borde_m_ha"] = por_clase["borde_m"] / paisaje_ha
+    por_clase["densidad_parches_100ha"] = 100 * por_clase["n_parches"] / paisaje_ha
+    por_clase["indice_parche_mayor"] = 100 * por_clase["parche_mayor_ha"] / paisaje_ha
+    return {"parches": tabla, "clases": por_clase.reset_index()}
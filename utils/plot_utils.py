@@ -0,0 +1,370 @@
+"""Visualización de rasters grandes a resolución de pantalla.
+
+Graficar un raster con ``.plot()`` o ``imshow`` dibuja todos sus píxeles,
+aunque la figura solo pueda mostrar unos cientos de miles. Las funciones de
+este módulo reducen primero el raster a la resolución de la figura, de modo
+que el costo de graficar depende del tamaño de la figura y no del raster.
+"""
+
+from __future__ import annotations
+
+import math
+import warnings
+
+import matplotlib.pyplot as plt
+import numpy as np
+import rasterio
+import xarray as xr
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.windows import from_bounds
+
+from . import raster_utils
+
+# Número máximo de píxeles por banda de la muestra para percentiles y gamma
+MUESTRA_HISTOGRAMA = 2**18
+
+
+def tamano_pantalla(ax=None) -> tuple[int, int]:
+    """Tamaño ``(alto, ancho)`` en píxeles de un eje o de la figura actual."""
+    if ax is not None:
+        extension = ax.get_window_extent()
+        return max(1, int(extension.height)), max(1, int(extension.width))
+    figura = plt.gcf()
+    ancho, alto = figura.get_size_inches() * figura.dpi
+    return max(1, int(alto)), max(1, int(ancho))
+
+
+def _fuente_sin_modificar(raster: xr.DataArray) -> str | None:
+    """Archivo de origen del raster, si sus valores se leen tal cual de él.
+
+    Solo se acepta si el grafo de dask contiene únicamente la lectura del
+    archivo y selecciones (recortes, ``squeeze``); cualquier cálculo sobre
+    los valores descarta el archivo de origen.
+    """
+    fuente = raster.encoding.get("source")
+    datos = raster.data
+    if fuente is None or not hasattr(datos, "dask"):
+        return None
+    for capa in datos.dask.layers:
+        if "open_rasterio" not in capa and not capa.startswith("getitem"):
+            return None
+    return fuente
+
+
+def _leer_desde_vistas(raster, fuente, alto, ancho, categorico):
+    """Lee la zona del raster a ``(alto, ancho)`` usando las vistas del archivo.
+
+    GDAL elige la vista general (overview) más cercana a la resolución
+    pedida y solo lee sus bloques; si el archivo no tiene vistas, remuestrea
+    desde la resolución completa.
+    """
+    banda = int(raster["band"].values) if "band" in raster.coords else 1
+    remuestreo = Resampling.mode if categorico else Resampling.average
+    with rasterio.open(fuente) as src:
+        ventana = from_bounds(*raster.rio.bounds(), transform=src.transform)
+        ventana = ventana.round_offsets().round_lengths()
+        datos = src.read(
+            banda, window=ventana, out_shape=(alto, ancho), resampling=remuestreo
+        )
+        transform = src.window_transform(ventana) * Affine.scale(
+            ventana.width / ancho, ventana.height / alto
+        )
+        nodata = src.nodata
+    if np.issubdtype(raster.dtype, np.floating) and nodata is not None:
+        datos = np.where(datos == nodata, np.nan, datos).astype(raster.dtype)
+
+    filas = np.arange(alto) + 0.5
+    columnas = np.arange(ancho) + 0.5
+    resultado = xr.DataArray(
+        datos,
+        dims=("y", "x"),
+        coords={
+            "y": transform.f + filas * transform.e,
+            "x": transform.c + columnas * transform.a,
+        },
+        attrs=raster.attrs,
+        name=raster.name,
+    )
+    return resultado.rio.write_crs(raster.rio.crs).rio.write_transform(transform)
+
+
+def preparar_para_graficar(
+    raster: xr.DataArray,
+    alto_px: int | None = None,
+    ancho_px: int | None = None,
+    ax=None,
+    categorico: bool | None = None,
+) -> xr.DataArray:
+    """Reduce un raster a la resolución con que se va a mostrar.
+
+    Si el raster se lee directamente de un archivo, se usan las vistas
+    generales del archivo (ver :func:`cog_utils.escribir_cog`); si no, se
+    agrega en bloques con :func:`raster_utils.reducir_por_bloques`. Los
+    rasters categóricos usan la moda (la clase más frecuente) y los
+    continuos, el promedio.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Raster de una banda.
+    alto_px, ancho_px : int, optional
+        Tamaño de destino en píxeles. Por defecto, el tamaño de ``ax`` o de
+        la figura actual.
+    ax : matplotlib.axes.Axes, optional
+        Eje donde se va a graficar.
+    categorico : bool, optional
+        Si se reduce por moda en vez de por media. Por defecto, ``True``
+        solo para rasters de enteros de 8 bits (clases); un DEM o una banda
+        de reflectancia en ``int16``/``uint16`` se promedian.
+
+    Returns
+    -------
+    xarray.DataArray
+        Raster con a lo sumo ``alto_px`` x ``ancho_px`` píxeles.
+    """
+    if "band" in raster.dims and raster.sizes["band"] == 1:
+        raster = raster.squeeze("band")
+    if categorico is None:
+        categorico = (
+            np.issubdtype(raster.dtype, np.integer) and raster.dtype.itemsize == 1
+        )
+    if alto_px is None or ancho_px is None:
+        alto_pantalla, ancho_pantalla = tamano_pantalla(ax)
+        alto_px = alto_px or alto_pantalla
+        ancho_px = ancho_px or ancho_pantalla
+
+    alto, ancho = raster.sizes["y"], raster.sizes["x"]
+    factor = max(math.ceil(alto / alto_px), math.ceil(ancho / ancho_px))
+    if factor <= 1:
+        return raster
+
+    fuente = _fuente_sin_modificar(raster)
+    if fuente is not None and raster.ndim == 2:
+        return _leer_desde_vistas(
+            raster,
+            fuente,
+            max(1, alto // factor),
+            max(1, ancho // factor),
+            categorico,
+        )
+    nodata = raster.rio.nodata
+    if categorico:
+        return raster_utils.reducir_por_bloques(
+            raster, factor, "moda", nodata=nodata
+        ).compute()
+
+    # La media se calcula en float32 y sin los valores sin dato (un -32768
+    # promediado con el resto arruinaría la escala de colores)
+    valores = raster.astype(np.float32)
+    if nodata is not None and not np.isnan(nodata):
+        valores = valores.where(raster != nodata)
+    with warnings.catch_warnings():
+        # Los bloques sin ningún dato válido quedan en NaN
+        warnings.filterwarnings("ignore", "Mean of empty slice", RuntimeWarning)
+        return raster_utils.reducir_por_bloques(valores, factor, "media").compute()
+
+
+def graficar(
+    raster: xr.DataArray,
+    ax=None,
+    categorico: bool | None = None,
+    imshow: bool = False,
+    **kwargs,
+):
+    """Grafica un raster sin dibujar más píxeles de los que caben en pantalla.
+
+    Es un reemplazo de ``raster.plot(...)`` (o ``raster.plot.imshow(...)`` si
+    ``imshow=True``): acepta los mismos argumentos y devuelve el mismo
+    objeto, por ejemplo para usarlo con ``plt.colorbar``. Si se pasan
+    ``levels`` (una leyenda de clases) el raster se trata como categórico,
+    salvo que se indique ``categorico``.
+    """
+    if categorico is None and "levels" in kwargs:
+        categorico = True
+    reducido = preparar_para_graficar(raster, ax=ax, categorico=categorico)
+    if imshow:
+        return reducido.plot.imshow(ax=ax, **kwargs)
+    return reducido.plot(ax=ax, **kwargs)
+
+
+def _bandas_rgb(imagen) -> list:
+    """Las tres bandas (rojo, verde, azul) de un Dataset o de un DataArray."""
+    if isinstance(imagen, xr.Dataset):
+        bandas = [imagen[nombre] for nombre in imagen.data_vars]
+    else:
+        dims = [d for d in imagen.dims if d not in ("y", "x")]
+        if len(dims) != 1:
+            raise ValueError(
+                "la imagen debe tener una dimensión de bandas además de y, x"
+            )
+        bandas = [imagen.isel({dims[0]: i}) for i in range(imagen.sizes[dims[0]])]
+    bandas = [b.squeeze(drop=True) for b in bandas]
+    if len(bandas) != 3 or any(set(b.dims) != {"y", "x"} for b in bandas):
+        raise ValueError("se requieren tres bandas con dimensiones y, x")
+    return [b.transpose("y", "x") for b in bandas]
+
+
+def _limites_percentiles(muestra, percentiles, por_banda):
+    """Pendiente e intercepto que llevan los percentiles de la muestra a 0 y 1."""
+    bajo, alto = np.nanpercentile(
+        muestra, percentiles, axis=(1, 2) if por_banda else None
+    )
+    bajo = np.broadcast_to(bajo, (3,)).astype(np.float32)
+    alto = np.broadcast_to(alto, (3,)).astype(np.float32)
+    pendiente = 1 / np.maximum(alto - bajo, np.finfo(np.float32).tiny)
+    return pendiente, -bajo * pendiente
+
+
+def _gamma_automatico(muestra, pendiente, intercepto) -> np.float32:
+    """Exponente que deja la mediana de la muestra estirada en gris medio."""
+    estirada = muestra * pendiente[:, None, None] + intercepto[:, None, None]
+    mediana = np.nanmedian(np.clip(estirada, 0, 1))
+    return np.float32(np.log(0.5) / np.log(np.clip(mediana, 0.01, 0.99)))
+
+
+def _a_uint8(bloque, pendiente, intercepto, exponente):
+    """Lleva un bloque ``(3, filas, columnas)`` a RGB ``uint8`` en ``float32``.
+
+    Los píxeles sin dato (``NaN``) quedan en negro.
+    """
+    valores = bloque * pendiente[:, None, None] + intercepto[:, None, None]
+    np.clip(valores, 0, 1, out=valores)
+    if exponente != 1:
+        np.power(valores, exponente, out=valores)
+    valores *= 255
+    np.nan_to_num(valores, copy=False, nan=0.0)
+    return np.rint(valores, out=valores).astype(np.uint8)
+
+
+def componer_rgb(
+    imagen,
+    alto_px: int | None = None,
+    ancho_px: int | None = None,
+    ax=None,
+    escala: float = 1.0,
+    desplazamiento: float = 0.0,
+    ganancia: float = 1.0,
+    percentiles: tuple | None = None,
+    por_banda: bool = False,
+    gamma: float | str = 1.0,
+    nodata=None,
+) -> xr.DataArray:
+    """Composición RGB ``uint8`` lista para ``imshow``, con memoria acotada.
+
+    En vez de ``np.clip(imagen.to_array().values.transpose(1, 2, 0) * 0.0001
+    * 3.5, 0, 1)``, que carga el cubo completo y crea varias copias
+    ``float64`` de su tamaño, cada banda se reduce primero (por bloques, con
+    dask) a la resolución de la figura en ``float32``. La escala, la
+    ganancia, el recorte y el gamma se aplican luego bloque a bloque, y cada
+    bloque pasa directamente a ``uint8``. Los percentiles y el gamma
+    automático se calculan sobre una muestra de a lo sumo
+    ``MUESTRA_HISTOGRAMA`` píxeles.
+
+    Parameters
+    ----------
+    imagen : xarray.Dataset or xarray.DataArray
+        Tres bandas en orden rojo, verde, azul: un Dataset de tres variables
+        (como las vistas de :func:`stac_utils.vistas_composiciones`) o un
+        DataArray con una dimensión de bandas.
+    alto_px, ancho_px : int, optional
+        Tamaño de destino en píxeles. Por defecto, el tamaño de ``ax`` o de
+        la figura actual.
+    ax : matplotlib.axes.Axes, optional
+        Eje donde se va a graficar.
+    escala, desplazamiento : float
+        Conversión a reflectancia, ``valor * escala + desplazamiento``
+        (``0.0001`` y ``0`` en Sentinel-2; ``0.0000275`` y ``-0.2`` en
+        Landsat Colección 2).
+    ganancia : float
+        Factor de brillo: la reflectancia ``1 / ganancia`` queda en blanco.
+        Se ignora si se indican ``percentiles``.
+    percentiles : tuple, optional
+        Estiramiento lineal entre dos percentiles, por ejemplo ``(2, 98)``.
+    por_banda : bool
+        Calcula los percentiles de cada banda por separado (realza el
+        contraste, pero altera el balance de color).
+    gamma : float or "auto"
+        Corrección gamma; con ``"auto"`` se elige de modo que la mediana de
+        la imagen quede en gris medio.
+    nodata : optional
+        Valor sin dato, que queda en negro. Por defecto, el de cada banda.
+
+    Returns
+    -------
+    xarray.DataArray
+        Arreglo ``(y, x, banda)`` ``uint8`` con coordenadas, para
+        ``plt.imshow`` o ``.plot.imshow()``.
+    """
+    bandas = _bandas_rgb(imagen)
+    if alto_px is None or ancho_px is None:
+        alto_pantalla, ancho_pantalla = tamano_pantalla(ax)
+        alto_px = alto_px or alto_pantalla
+        ancho_px = ancho_px or ancho_pantalla
+    alto, ancho = bandas[0].shape
+    factor = max(1, math.ceil(alto / alto_px), math.ceil(ancho / ancho_px))
+
+    # Reducción a la resolución de pantalla en float32, ignorando el nodata
+    with warnings.catch_warnings():
+        # Los bloques sin ningún dato válido quedan en NaN (negro)
+        warnings.filterwarnings("ignore", "Mean of empty slice", RuntimeWarning)
+        reducidas = []
+        for banda in bandas:
+            sin_dato = banda.rio.nodata if nodata is None else nodata
+            valores = banda.astype(np.float32)
+            if sin_dato is not None and not np.isnan(sin_dato):
+                valores = valores.where(banda != sin_dato)
+            reducidas.append(raster_utils.reducir_por_bloques(valores, factor, "media"))
+        pila = xr.concat(reducidas, dim="banda", coords="minimal", compat="override")
+        if hasattr(pila.data, "dask"):
+            pila = pila.chunk({"banda": 3}).persist()
+
+    muestra = None
+    if percentiles is not None or gamma == "auto":
+        paso = math.sqrt(pila.sizes["y"] * pila.sizes["x"] / MUESTRA_HISTOGRAMA)
+        paso = max(1, math.ceil(paso))
+        muestra = np.asarray(pila.data[:, ::paso, ::paso])
+    if percentiles is None:
+        pendiente = np.full(3, escala * ganancia, dtype=np.float32)
+        intercepto = np.full(3, desplazamiento * ganancia, dtype=np.float32)
+    else:
+        pendiente, intercepto = _limites_percentiles(muestra, percentiles, por_banda)
+    if gamma == "auto":
+        exponente = _gamma_automatico(muestra, pendiente, intercepto)
+    else:
+        exponente = np.float32(1 / gamma)
+
+    datos = pila.data
+    if hasattr(datos, "dask"):
+        rgb = datos.map_blocks(
+            _a_uint8,
+            dtype=np.uint8,
+            pendiente=pendiente,
+            intercepto=intercepto,
+            exponente=exponente,
+        ).compute()
+    else:
+        rgb = _a_uint8(np.asarray(datos), pendiente, intercepto, exponente)
+    resultado = xr.DataArray(
+        rgb, dims=("banda", "y", "x"), coords={"y": pila["y"], "x": pila["x"]}
+    )
+    return resultado.transpose("y", "x", "banda")
+
+
+def graficar_rgb(imagen, ax=None, titulo: str | None = None, **kwargs):
+    """Grafica una composición RGB con :func:`componer_rgb`.
+
+    ``kwargs`` se pasan a :func:`componer_rgb` (``escala``, ``ganancia``,
+    ``percentiles``, ``gamma``, ...). Devuelve la imagen de ``imshow``.
+    """
+    ax = ax or plt.gca()
+    rgb = componer_rgb(imagen, ax=ax, **kwargs)
+    x, y = rgb["x"].values, rgb["y"].values
+    medio_x = abs(x[1] - x[0]) / 2 if x.size > 1 else 0.5
+    medio_y = abs(y[1] - y[0]) / 2 if y.size > 1 else 0.5
+    extension = (x[0] - medio_x, x[-1] + medio_x, y[-1] - medio_y, y[0] + medio_y)
+    imagen_ax = ax.imshow(rgb.values, extent=extension)
+    if titulo is not None:
+        ax.set_title(titulo)
+    ax.set_axis_off()
+    return imagen_ax
@@ -0,0 +1,182 @@
+"""Rasters de distancia (proximidad) a clases de cobertura.
+
+Responde preguntas como "¿a qué distancia está cada píxel del cuerpo de
+agua más cercano (clase 33)?" o "¿y de la infraestructura (clase 24)?"
+sobre la cobertura de ``01_datos_raster.py``.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+import xarray as xr
+from numba import njit
+
+from . import raster_utils
+from .landscape_utils import _largos_bordes
+from .raster_utils import _como_banda_unica
+
+
+@njit(cache=True, nogil=True)
+def _distancia_columnas(mascara, posiciones):
+    """Distancia vertical de cada píxel al objetivo más cercano de su columna.
+
+    ``posiciones`` es la coordenada (en metros o unidades del mapa) del
+    centro de cada fila. Se recorre cada columna hacia abajo y hacia arriba
+    guardando el último objetivo visto; sin objetivos, la distancia es
+    infinita.
+    """
+    filas, columnas = mascara.shape
+    salida = np.empty((filas, columnas), dtype=np.float64)
+    for x in range(columnas):
+        ultimo = -1
+        for y in range(filas):
+            if mascara[y, x]:
+                ultimo = y
+            salida[y, x] = posiciones[y] - posiciones[ultimo] if ultimo >= 0 else np.inf
+        ultimo = -1
+        for y in range(filas - 1, -1, -1):
+            if mascara[y, x]:
+                ultimo = y
+            if ultimo >= 0:
+                salida[y, x] = min(salida[y, x], posiciones[ultimo] - posiciones[y])
+    return salida
+
+
+@njit(cache=True, nogil=True)
+def _distancia_filas(vertical, ancho_pixel):
+    """Distancia euclidiana exacta combinando las distancias verticales por fila.
+
+    Para cada fila calcula ``min_q ((x - q) * ancho)² + vertical[q]²`` con la
+    envolvente inferior de parábolas de Felzenszwalb y Huttenlocher, en
+    tiempo lineal. ``ancho_pixel`` es el ancho del píxel de cada fila.
+    """
+    filas, columnas = vertical.shape
+    salida = np.empty((filas, columnas), dtype=np.float32)
+    v = np.empty(columnas, dtype=np.int64)
+    z = np.empty(columnas + 1, dtype=np.float64)
+    f = np.empty(columnas, dtype=np.float64)
+    for y in range(filas):
+        escala = ancho_pixel[y] * ancho_pixel[y]
+        for q in range(columnas):
+            f[q] = vertical[y, q] * vertical[y, q] / escala
+        k = -1
+        for q in range(columnas):
+            if f[q] == np.inf:
+                continue
+            if k < 0:
+                k = 0
+                v[0] = q
+                z[0] = -np.inf
+                z[1] = np.inf
+                continue
+            s = ((f[q] + q * q) - (f[v[k]] + v[k] * v[k])) / (2 * q - 2 * v[k])
+            while s <= z[k]:
+                k -= 1
+                s = ((f[q] + q * q) - (f[v[k]] + v[k] * v[k])) / (2 * q - 2 * v[k])
+            k += 1
+            v[k] = q
+            z[k] = s
+            z[k + 1] = np.inf
+        if k < 0:
+            salida[y, :] = np.inf
+            continue
+        j = 0
+        for q in range(columnas):
+            while z[j + 1] < q:
+                j += 1
+            d = (q - v[j]) * (q - v[j]) + f[v[j]]
+            salida[y, q] = np.sqrt(d * escala)
+    return salida
+
+
+def _geometria_filas(raster: xr.DataArray) -> tuple[np.ndarray, np.ndarray]:
+    """Posición del centro de cada fila y ancho del píxel de cada fila.
+
+    En un CRS proyectado se usan las unidades del mapa; en uno geográfico,
+    metros medidos sobre el elipsoide.
+    """
+    transform = raster.rio.transform()
+    alto = raster.rio.height
+    if raster.rio.crs is None or not raster.rio.crs.is_geographic:
+        return (
+            np.arange(alto) * abs(transform.e),
+            np.full(alto, abs(transform.a)),
+        )
+    ancho_bordes, alto_filas = _largos_bordes(raster)
+    posiciones = np.cumsum(alto_filas) - alto_filas / 2
+    return posiciones, (ancho_bordes[:-1] + ancho_bordes[1:]) / 2
+
+
+def distancia_a_clases(
+    raster: xr.DataArray,
+    clases,
+    nodata: int | None = None,
+    mb_por_chunk: float = raster_utils.MB_POR_CHUNK,
+) -> xr.DataArray:
+    """Distancia euclidiana de cada píxel al píxel más cercano de ``clases``.
+
+    La transformada de distancia exacta es separable y se calcula en dos
+    pasadas: primero, por columnas, la distancia vertical al objetivo más
+    cercano de cada columna; luego, por filas, la combinación exacta de esas
+    distancias (envolvente de parábolas). Con dask, entre ambas pasadas el
+    arreglo se reorganiza en chunks de columnas completas y después de filas
+    completas, por lo que el resultado es idéntico al del arreglo completo
+    (``scipy.ndimage.distance_transform_edt``) con memoria acotada por chunk
+    y en paralelo.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Cobertura de una banda (en memoria o con dask).
+    clases : int or sequence of int
+        Códigos objetivo, por ejemplo ``33`` (agua) o ``[24]``
+        (infraestructura).
+    nodata : int, optional
+        Los píxeles con este código quedan en ``NaN`` (pero la distancia se
+        mide a través de ellos). Por defecto ``raster.rio.nodata``.
+    mb_por_chunk : float
+        Tamaño aproximado de los chunks de cada pasada, en megabytes.
+
+    Returns
+    -------
+    xarray.DataArray
+        Distancias ``float32`` en unidades del mapa (en metros si el CRS es
+        geográfico, con el ancho del píxel de cada fila según su latitud).
+        Si no hay ningún píxel objetivo, todas las distancias son ``inf``.
+    """
+    raster = _como_banda_unica(raster).transpose("y", "x")
+    if nodata is None:
+        nodata = raster.rio.nodata
+    clases = np.atleast_1d(np.asarray(clases))
+    posiciones, ancho_pixel = _geometria_filas(raster)
+    alto, ancho = raster.shape
+
+    datos = raster.data
+    if hasattr(datos, "dask"):
+        import dask.array as da
+
+        mascara = da.isin(datos, clases)
+        columnas = max(1, int(mb_por_chunk * 2**20 // (alto * 8)))
+        vertical = mascara.rechunk((alto, columnas)).map_blocks(
+            _distancia_columnas, posiciones, dtype=np.float64
+        )
+        filas = max(1, int(mb_por_chunk * 2**20 // (ancho * 8)))
+        vertical = vertical.rechunk((filas, ancho))
+        anchos = da.from_array(ancho_pixel, chunks=vertical.chunks[0])
+        distancia = da.map_blocks(
+            lambda v, a: _distancia_filas(v, a[:, 0]),
+            vertical,
+            anchos[:, None],
+            dtype=np.float32,
+        ).rechunk(datos.chunks)
+    else:
+        mascara = np.isin(np.asarray(datos), clases)
+        vertical = _distancia_columnas(mascara, posiciones)
+        distancia = _distancia_filas(vertical, ancho_pixel)
+
+    resultado = raster.copy(data=distancia).rename("distancia")
+    geografico = raster.rio.crs is not None and raster.rio.crs.is_geographic
+    resultado.attrs = {"units": "m" if geografico else "unidades del mapa"}
+    if nodata is not None:
+        resultado = resultado.where(raster != nodata)
+    return resultado.rio.write_nodata(np.nan, encoded=False)
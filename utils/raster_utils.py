@@ -0,0 +1,1071 @@
+"""Utilidades para datos raster.
+
+Funciones de apoyo para los cuadernos de ``notebooks/02_raster``. Todas
+devuelven objetos ``xarray.DataArray`` georreferenciados con ``rioxarray``
+para que puedan encadenarse con el resto del flujo de trabajo del curso.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import rasterio
+import rioxarray as rxr
+import xarray as xr
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+# Parámetros por defecto de la colina simulada en 01_datos_raster.py
+ALTURA_COLINA = 100.0
+PENDIENTE_COLINA = 1.5
+RUIDO_DEM = 5.0
+
+# Tamaño objetivo de cada chunk al abrir rasters de forma perezosa
+MB_POR_CHUNK = 64
+
+# Máximo de rasters abiertos que cada proceso mantiene a la vez
+MAX_RASTERS_ABIERTOS = 16
+
+# Conexiones a rasters abiertas en cada proceso de trabajo (orden LRU)
+_RASTERS_ABIERTOS: OrderedDict = OrderedDict()
+
+# Leyenda de MapBiomas Chile (nivel 2), ver https://chile.mapbiomas.org/codigos-de-la-leyenda/
+LEYENDA_MAPBIOMAS = {
+    3: "Bosque",
+    9: "Plantación Forestal",
+    11: "Humedal",
+    12: "Pastizal",
+    21: "Mosaico de agricultura y pastura",
+    23: "Arenas, Playas y Dunas",
+    24: "Infraestructura",
+    25: "Otra área sin vegetación",
+    27: "No observado",
+    29: "Afloramiento rocoso",
+    33: "Río, lago u océano",
+    34: "Hielo y nieve",
+    61: "Salar",
+    66: "Matorral",
+}
+
+
+def _bloque_dem(
+    fila0: int,
+    fila1: int,
+    col0: int,
+    col1: int,
+    colinas: list[dict],
+    crestas: list[dict],
+    ruido: float,
+    nivel_base: float,
+    semilla: int | None,
+    dtype,
+) -> np.ndarray:
+    """Calcula el DEM sintético para el bloque ``[fila0:fila1, col0:col1]``."""
+    i = np.arange(fila0, fila1, dtype=np.float64)[:, None]
+    j = np.arange(col0, col1, dtype=np.float64)[None, :]
+    forma = (fila1 - fila0, col1 - col0)
+
+    # Cada componente es una superficie; el relieve es su envolvente superior
+    datos = np.full(forma, -np.inf if (colinas or crestas) else 0.0)
+    for colina in colinas:
+        dist = np.hypot(i - colina["fila"], j - colina["columna"])
+        np.maximum(datos, colina["altura"] - dist * colina["pendiente"], out=datos)
+    for cresta in crestas:
+        # Distancia perpendicular a la línea de cresta (ángulo desde el este,
+        # en sentido antihorario)
+        angulo = np.deg2rad(cresta.get("angulo", 0.0))
+        dist = np.abs(
+            (i - cresta["fila"]) * np.cos(angulo)
+            + (j - cresta["columna"]) * np.sin(angulo)
+        )
+        np.maximum(datos, cresta["altura"] - dist * cresta["pendiente"], out=datos)
+
+    if ruido > 0:
+        # Semilla derivada de la posición del bloque: el resultado no depende
+        # del orden en que dask calcule los bloques
+        rng = np.random.default_rng(
+            None if semilla is None else [semilla, fila0, col0]
+        )
+        datos += rng.normal(0.0, ruido, forma)
+
+    np.maximum(datos, nivel_base, out=datos)
+    return datos.astype(dtype, copy=False)
+
+
+def generar_dem_sintetico(
+    filas: int = 100,
+    columnas: int = 100,
+    resolucion: float = 1.0,
+    origen: tuple[float, float] = (300000.0, 6250000.0),
+    crs: str | None = "EPSG:32719",
+    colinas: list[dict] | None = None,
+    crestas: list[dict] | None = None,
+    ruido: float = RUIDO_DEM,
+    nivel_base: float = 0.0,
+    semilla: int | None = None,
+    chunks: int | tuple | str | None = None,
+    dtype: str = "float64",
+) -> xr.DataArray:
+    """Genera un modelo digital de elevación (DEM) sintético.
+
+    Es la versión vectorizada del DEM simulado de la sección 3 de
+    ``01_datos_raster.py``: en lugar de recorrer cada píxel, calcula bloques
+    completos con NumPy. Con ``chunks`` el resultado es un arreglo de dask
+    que se genera bloque a bloque, por lo que se pueden crear grillas de
+    50 000 x 50 000 sin cargarlas completas en memoria.
+
+    Parameters
+    ----------
+    filas, columnas : int
+        Tamaño de la grilla en píxeles.
+    resolucion : float
+        Tamaño del píxel en unidades del CRS.
+    origen : tuple of float
+        Coordenadas ``(x, y)`` de la esquina superior izquierda.
+    crs : str, optional
+        Sistema de referencia que se asigna al raster.
+    colinas : list of dict, optional
+        Colinas cónicas con las claves ``fila``, ``columna``, ``altura`` y
+        ``pendiente`` (en píxeles). Por defecto, una colina centrada igual a
+        la del cuaderno.
+    crestas : list of dict, optional
+        Cordones lineales con las claves ``fila``, ``columna`` (un punto de la
+        cresta), ``angulo`` (grados desde el este), ``altura`` y ``pendiente``.
+    ruido : float
+        Desviación estándar del ruido gaussiano que se suma a la superficie.
+    nivel_base : float
+        Los valores bajo este nivel se igualan a él (nivel del mar).
+    semilla : int, optional
+        Semilla del generador aleatorio. Con la misma semilla y los mismos
+        ``chunks`` el resultado es reproducible.
+    chunks : int, tuple or str, optional
+        Tamaño de los bloques de dask. Si es ``None`` se calcula con NumPy.
+    dtype : str
+        Tipo de dato del resultado.
+
+    Returns
+    -------
+    xarray.DataArray
+        DEM con dimensiones ``("y", "x")``, CRS y transformación afín.
+    """
+    if filas <= 0 or columnas <= 0:
+        raise ValueError("filas y columnas deben ser positivos")
+
+    if colinas is None:
+        colinas = [
+            {
+                "fila": filas / 2,
+                "columna": columnas / 2,
+                "altura": ALTURA_COLINA,
+                "pendiente": PENDIENTE_COLINA,
+            }
+        ]
+    colinas = list(colinas)
+    crestas = list(crestas or [])
+    parametros = dict(
+        colinas=colinas,
+        crestas=crestas,
+        ruido=ruido,
+        nivel_base=nivel_base,
+        semilla=semilla,
+        dtype=np.dtype(dtype),
+    )
+
+    if chunks is None:
+        datos = _bloque_dem(0, filas, 0, columnas, **parametros)
+    else:
+        import dask.array as da
+
+        bloques = da.core.normalize_chunks(
+            chunks, (filas, columnas), dtype=np.dtype(dtype)
+        )
+
+        def _generar(block_info=None):
+            (fila0, fila1), (col0, col1) = block_info[None]["array-location"]
+            return _bloque_dem(fila0, fila1, col0, col1, **parametros)
+
+        datos = da.map_blocks(
+            _generar,
+            chunks=bloques,
+            dtype=dtype,
+            meta=np.empty((0, 0), dtype=dtype),
+        )
+
+    x0, y0 = origen
+    transform = Affine(resolucion, 0.0, x0, 0.0, -resolucion, y0)
+    dem = xr.DataArray(
+        data=datos,
+        dims=["y", "x"],
+        coords={
+            "y": y0 - (np.arange(filas) + 0.5) * resolucion,
+            "x": x0 + (np.arange(columnas) + 0.5) * resolucion,
+        },
+        name="elevacion",
+        attrs={"units": "m"},
+    )
+    dem = dem.rio.write_transform(transform)
+    if crs is not None:
+        dem = dem.rio.write_crs(crs)
+    return dem
+
+
+def chunks_alineados(ruta: str, mb_por_chunk: float = MB_POR_CHUNK) -> dict:
+    """Calcula chunks de dask alineados con los bloques internos de un GeoTIFF.
+
+    Los GeoTIFF se guardan en bloques (teselas o franjas de filas) que GDAL
+    decodifica completos. Si un chunk corta un bloque, ese bloque se lee y
+    descomprime dos veces; por eso los chunks se eligen como múltiplos enteros
+    del bloque interno, con un tamaño cercano a ``mb_por_chunk``.
+
+    Parameters
+    ----------
+    ruta : str
+        Ruta o URL del raster.
+    mb_por_chunk : float
+        Tamaño aproximado de cada chunk en megabytes.
+
+    Returns
+    -------
+    dict
+        Chunks para ``rioxarray.open_rasterio`` con las claves ``band``, ``y``
+        y ``x``.
+    """
+    with rasterio.open(ruta) as src:
+        alto_bloque, ancho_bloque = src.block_shapes[0]
+        bytes_pixel = np.dtype(src.dtypes[0]).itemsize
+        alto, ancho = src.height, src.width
+
+    pixeles = max(1, int(mb_por_chunk * 2**20 // bytes_pixel))
+    # Primero el ancho (las franjas ocupan todo el ancho), luego el alto
+    n_x = max(1, int(math.sqrt(pixeles) // ancho_bloque))
+    ancho_chunk = min(ancho, n_x * ancho_bloque)
+    n_y = max(1, pixeles // (ancho_chunk * alto_bloque))
+    alto_chunk = min(alto, n_y * alto_bloque)
+    return {"band": 1, "y": alto_chunk, "x": ancho_chunk}
+
+
+def abrir_raster(
+    ruta: str,
+    mb_por_chunk: float = MB_POR_CHUNK,
+    enmascarar: bool = False,
+) -> xr.DataArray:
+    """Abre un raster de forma perezosa con chunks alineados a sus bloques.
+
+    A diferencia de ``rxr.open_rasterio(ruta)``, no lee los píxeles: devuelve
+    un arreglo de dask y cada operación posterior (recorte, estadísticas,
+    gráficos) se mantiene perezosa hasta que se pide el resultado con
+    ``.compute()``, ``.values`` o ``float(...)``.
+
+    Parameters
+    ----------
+    ruta : str
+        Ruta o URL del raster (por ejemplo, la cobertura de MapBiomas).
+    mb_por_chunk : float
+        Tamaño aproximado de cada chunk en megabytes.
+    enmascarar : bool
+        Si es ``True``, los valores nodata se convierten en ``NaN`` (el
+        resultado pasa a ser de punto flotante). Para rasters categóricos
+        conviene dejarlo en ``False`` y conservar el tipo entero.
+
+    Returns
+    -------
+    xarray.DataArray
+        Raster con dimensiones ``("band", "y", "x")`` respaldado por dask.
+    """
+    return rxr.open_rasterio(
+        ruta,
+        chunks=chunks_alineados(ruta, mb_por_chunk),
+        masked=enmascarar,
+        cache=False,
+        lock=False,
+    )
+
+
+def abrir_por_proceso(ruta: str):
+    """Abre ``ruta`` una sola vez por proceso y reutiliza la conexión.
+
+    La comparten las funciones que leen muchas ventanas de un mismo archivo
+    desde procesos de trabajo (estadísticas zonales, muestreo,
+    poligonización). La clave incluye el PID para que un proceso hijo creado
+    con ``fork`` no reutilice la conexión heredada de su padre. Se mantienen
+    a lo sumo ``MAX_RASTERS_ABIERTOS`` conexiones: al superarlo se cierra la
+    usada hace más tiempo.
+    """
+    pid = os.getpid()
+    clave = (pid, ruta)
+    src = _RASTERS_ABIERTOS.get(clave)
+    if src is None or src.closed:
+        src = _RASTERS_ABIERTOS[clave] = rasterio.open(ruta)
+    _RASTERS_ABIERTOS.move_to_end(clave)
+    while len(_RASTERS_ABIERTOS) > MAX_RASTERS_ABIERTOS:
+        (pid_viejo, _), viejo = _RASTERS_ABIERTOS.popitem(last=False)
+        # Las conexiones heredadas por fork pertenecen al proceso padre
+        if pid_viejo == pid:
+            viejo.close()
+    return src
+
+
+def valores_unicos(raster: xr.DataArray) -> np.ndarray:
+    """Valores distintos de un raster, calculados chunk a chunk.
+
+    Equivale a ``np.unique(raster.values)`` pero sin cargar el raster
+    completo: cada chunk aporta sus valores únicos y luego se combinan.
+    """
+    datos = raster.data
+    if not hasattr(datos, "dask"):
+        return np.unique(datos)
+
+    import dask.array as da
+
+    return da.unique(datos).compute()
+
+
+def _parciales_por_bloque(datos, funcion, *args) -> list:
+    """Aplica ``funcion(bloque, ventana, *args)`` a cada chunk de ``datos``.
+
+    ``ventana`` es la tupla ``(fila0, fila1, col0, col1)`` del bloque en las
+    dos últimas dimensiones del arreglo. Con arreglos de dask devuelve una
+    lista de objetos ``dask.delayed``; con arreglos de NumPy, una lista con
+    un único resultado ya calculado.
+    """
+    if not hasattr(datos, "dask"):
+        alto, ancho = datos.shape[-2:]
+        return [funcion(np.asarray(datos), (0, alto, 0, ancho), *args)]
+
+    import dask
+
+    filas = np.cumsum((0,) + datos.chunks[-2])
+    columnas = np.cumsum((0,) + datos.chunks[-1])
+    parciales = []
+    for indice, bloque in np.ndenumerate(datos.to_delayed()):
+        i, j = indice[-2:]
+        ventana = (filas[i], filas[i + 1], columnas[j], columnas[j + 1])
+        parciales.append(dask.delayed(funcion)(bloque, ventana, *args))
+    return parciales
+
+
+def _combinar_en_arbol(parciales: list, combinar, scheduler: str | None = None):
+    """Combina resultados parciales de a pares y calcula el total.
+
+    La combinación en árbol mantiene la profundidad del grafo en
+    ``log2(n)`` y permite que dask combine pares en paralelo. ``scheduler``
+    se pasa a ``dask.compute`` (``"threads"``, ``"processes"``, ...).
+    """
+    import dask
+
+    while len(parciales) > 1:
+        pares = [
+            dask.delayed(combinar)(parciales[k], parciales[k + 1])
+            for k in range(0, len(parciales) - 1, 2)
+        ]
+        if len(parciales) % 2:
+            pares.append(parciales[-1])
+        parciales = pares
+    (total,) = dask.compute(parciales[0], scheduler=scheduler)
+    return total
+
+
+def _estadisticas_bloque(bloque, ventana, nodata, max_distintos):
+    """Estadísticas parciales (conteo, media, M2, extremos) de un bloque."""
+    datos = np.asarray(bloque).ravel()
+    validos = np.ones(datos.shape, dtype=bool)
+    if np.issubdtype(datos.dtype, np.floating):
+        validos &= ~np.isnan(datos)
+    if nodata is not None and not np.isnan(nodata):
+        validos &= datos != nodata
+    valores = datos if validos.all() else datos[validos]
+
+    parcial = {
+        "conteo": int(valores.size),
+        "nodata": int(datos.size - valores.size),
+        "minimo": np.inf,
+        "maximo": -np.inf,
+        "media": 0.0,
+        "m2": 0.0,
+        "valores": np.empty(0, dtype=datos.dtype),
+    }
+    if valores.size == 0:
+        return parcial
+
+    if datos.dtype.kind == "u" and datos.dtype.itemsize <= 2:
+        # Enteros pequeños: todo se obtiene del histograma, sin temporales
+        # de punto flotante del tamaño del bloque
+        histograma = np.bincount(valores)
+        clases = np.flatnonzero(histograma)
+        frecuencias = histograma[clases]
+        media = float(np.dot(clases, frecuencias)) / valores.size
+        m2 = float(np.dot(frecuencias, (clases - media) ** 2))
+        parcial.update(
+            minimo=float(clases[0]),
+            maximo=float(clases[-1]),
+            media=media,
+            m2=m2,
+            valores=clases.astype(datos.dtype),
+        )
+        return parcial
+
+    valores64 = valores.astype(np.float64)
+    media = float(valores64.mean())
+    parcial.update(
+        minimo=float(valores64.min()),
+        maximo=float(valores64.max()),
+        media=media,
+        m2=float(np.square(valores64 - media).sum()),
+    )
+    if max_distintos:
+        distintos = np.unique(valores)
+        parcial["valores"] = distintos if distintos.size <= max_distintos else None
+    return parcial
+
+
+def _combinar_estadisticas(a: dict, b: dict, max_distintos=None) -> dict:
+    """Une dos resultados parciales con la fórmula de Chan (Welford en paralelo)."""
+    n = a["conteo"] + b["conteo"]
+    if n == 0:
+        media, m2 = 0.0, 0.0
+    else:
+        delta = b["media"] - a["media"]
+        media = a["media"] + delta * b["conteo"] / n
+        m2 = a["m2"] + b["m2"] + delta**2 * a["conteo"] * b["conteo"] / n
+
+    if a["valores"] is None or b["valores"] is None:
+        valores = None
+    else:
+        valores = np.union1d(a["valores"], b["valores"])
+        if max_distintos and valores.size > max_distintos:
+            valores = None
+
+    return {
+        "conteo": n,
+        "nodata": a["nodata"] + b["nodata"],
+        "minimo": min(a["minimo"], b["minimo"]),
+        "maximo": max(a["maximo"], b["maximo"]),
+        "media": media,
+        "m2": m2,
+        "valores": valores,
+    }
+
+
+def estadisticas_raster(
+    raster: xr.DataArray,
+    nodata: float | None = None,
+    max_distintos: int | None = 10000,
+) -> dict:
+    """Calcula las estadísticas básicas de un raster en una sola pasada.
+
+    ``min()``, ``max()``, ``mean()``, ``std()`` y ``np.unique`` recorren cada
+    uno el raster completo. Esta función lee cada chunk una sola vez y, en
+    paralelo, obtiene su conteo, extremos, media y suma de cuadrados de las
+    desviaciones (M2), los píxeles sin dato y sus valores distintos. Luego
+    combina los resultados parciales con la fórmula de Chan, por lo que
+    funciona con rasters más grandes que la memoria.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Raster en memoria o respaldado por dask (ver :func:`abrir_raster`).
+    nodata : float, optional
+        Valor sin dato. Por defecto se usa ``raster.rio.nodata``; los ``NaN``
+        siempre se consideran sin dato.
+    max_distintos : int, optional
+        Máximo de valores distintos que se registran. Si se supera (por
+        ejemplo, en un DEM continuo), ``valores`` es ``None``. Con ``None`` o
+        ``0`` no se calculan los valores distintos.
+
+    Returns
+    -------
+    dict
+        Claves ``conteo``, ``nodata``, ``minimo``, ``maximo``, ``media``,
+        ``varianza``, ``desviacion`` (poblacional, igual que ``.std()``) y
+        ``valores`` (arreglo ordenado de valores distintos o ``None``).
+    """
+    if nodata is None:
+        nodata = raster.rio.nodata
+
+    parciales = _parciales_por_bloque(
+        raster.data, _estadisticas_bloque, nodata, max_distintos
+    )
+    if len(parciales) == 1 and not hasattr(parciales[0], "dask"):
+        total = parciales[0]
+    else:
+        total = _combinar_en_arbol(
+            parciales,
+            lambda a, b: _combinar_estadisticas(a, b, max_distintos),
+        )
+
+    if total["conteo"] == 0:
+        total.update(minimo=np.nan, maximo=np.nan, media=np.nan)
+        varianza = np.nan
+    else:
+        varianza = total["m2"] / total["conteo"]
+    if not max_distintos:
+        total["valores"] = None
+
+    return {
+        "conteo": total["conteo"],
+        "nodata": total["nodata"],
+        "minimo": total["minimo"],
+        "maximo": total["maximo"],
+        "media": total["media"],
+        "varianza": varianza,
+        "desviacion": float(np.sqrt(varianza)),
+        "valores": total["valores"],
+    }
+
+
+def _area_filas_geograficas(transform: Affine, alto: int, crs) -> np.ndarray:
+    """Área en m² de un píxel de cada fila de un raster en coordenadas geográficas.
+
+    Usa el área exacta de una franja del elipsoide entre dos latitudes, por lo
+    que el resultado es válido para cualquier latitud.
+    """
+    from pyproj import CRS
+
+    elipsoide = CRS.from_user_input(crs.to_wkt()).ellipsoid
+    a = elipsoide.semi_major_metre
+    b = elipsoide.semi_minor_metre
+    e = np.sqrt(1.0 - (b / a) ** 2)
+
+    def _area_desde_ecuador(lat):
+        seno = np.sin(np.deg2rad(lat))
+        if e == 0:
+            return b**2 * seno
+        return (b**2 / 2) * (
+            seno / (1 - (e * seno) ** 2)
+            + np.log((1 + e * seno) / (1 - e * seno)) / (2 * e)
+        )
+
+    bordes = transform.f + transform.e * np.arange(alto + 1)
+    ancho_rad = np.deg2rad(abs(transform.a))
+    return ancho_rad * np.abs(np.diff(_area_desde_ecuador(bordes)))
+
+
+def _conteo_clases_bloque(bloque, ventana, nodata, area_filas):
+    """Píxeles (y área, si varía por fila) de cada código en un bloque."""
+    fila0, fila1 = ventana[:2]
+    codigos = np.asarray(bloque).reshape(fila1 - fila0, -1)
+    validos = None if nodata is None else codigos != nodata
+    valores = codigos.ravel() if validos is None else codigos[validos]
+    if valores.size == 0:
+        return np.zeros(0, np.int64), None
+    if valores.min() < 0:
+        raise ValueError("los códigos de clase deben ser enteros no negativos")
+    n_codigos = int(valores.max()) + 1
+
+    if area_filas is None:
+        return np.bincount(valores, minlength=n_codigos), None
+
+    # Un único bincount sobre (fila, clase presente) entrega los píxeles de
+    # cada clase por fila; el área se obtiene ponderando cada fila por su
+    # área de píxel. Los códigos se renumeran antes para que la tabla tenga
+    # solo las clases presentes y no una columna por código hasta el máximo
+    presentes, clases = np.unique(valores, return_inverse=True)
+    filas = np.broadcast_to(
+        np.arange(codigos.shape[0], dtype=np.int64)[:, None], codigos.shape
+    )
+    filas = filas.ravel() if validos is None else filas[validos]
+    por_fila = np.bincount(
+        filas * presentes.size + clases, minlength=codigos.shape[0] * presentes.size
+    ).reshape(-1, presentes.size)
+    conteos = np.zeros(n_codigos, np.int64)
+    areas = np.zeros(n_codigos)
+    conteos[presentes] = por_fila.sum(axis=0)
+    areas[presentes] = area_filas[fila0:fila1] @ por_fila
+    return conteos, areas
+
+
+def _combinar_conteos(a, b):
+    """Suma conteos (y áreas) parciales de distinto largo."""
+
+    def _sumar(x, y):
+        if x is None or y is None:
+            return x if y is None else y
+        largo = max(x.size, y.size)
+        return np.pad(x, (0, largo - x.size)) + np.pad(y, (0, largo - y.size))
+
+    return _sumar(a[0], b[0]), _sumar(a[1], b[1])
+
+
+def _area_pixel_m2(raster: xr.DataArray):
+    """Área del píxel en m²: escalar si es proyectado, vector por fila si es geográfico."""
+    crs = raster.rio.crs
+    if crs is None:
+        raise ValueError("el raster no tiene CRS; asígnalo con .rio.write_crs()")
+    transform = raster.rio.transform()
+    if crs.is_geographic:
+        return _area_filas_geograficas(transform, raster.rio.height, crs)
+    factor = crs.linear_units_factor[1]
+    return abs(transform.a * transform.e - transform.b * transform.d) * factor**2
+
+
+def _como_banda_unica(raster: xr.DataArray) -> xr.DataArray:
+    """Quita la dimensión ``band`` si el raster tiene una sola banda."""
+    if "band" in raster.dims:
+        if raster.sizes["band"] != 1:
+            raise ValueError("se esperaba un raster de una sola banda")
+        raster = raster.squeeze("band", drop=True)
+    return raster
+
+
+def area_por_clase(
+    raster: xr.DataArray,
+    leyenda: dict | None = None,
+    nodata: int | None = None,
+    scheduler: str | None = None,
+) -> pd.DataFrame:
+    """Calcula el área de cada clase de un raster de cobertura de suelo.
+
+    Recorre el raster una sola vez: en cada chunk cuenta los píxeles de todos
+    los códigos con un único ``np.bincount`` (sin una máscara por clase) y
+    luego suma los conteos de todos los chunks. Si el raster está en
+    coordenadas geográficas, el área del píxel se calcula por fila según la
+    latitud sobre el elipsoide del CRS; si está proyectado, es constante.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Raster categórico de enteros no negativos y una sola banda.
+    leyenda : dict, optional
+        Diccionario ``{código: nombre}``. Por defecto, la leyenda de MapBiomas.
+    nodata : int, optional
+        Código que se excluye del cálculo. Por defecto ``raster.rio.nodata``.
+    scheduler : str, optional
+        Planificador de dask. ``np.bincount`` no libera el GIL, por lo que
+        con ``"processes"`` se aprovechan todos los núcleos.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Una fila por clase con las columnas ``codigo``, ``clase``,
+        ``pixeles``, ``area_ha`` y ``porcentaje``.
+    """
+    raster = _como_banda_unica(raster)
+    if not np.issubdtype(raster.dtype, np.integer):
+        raise ValueError("area_por_clase requiere un raster de enteros")
+    if leyenda is None:
+        leyenda = LEYENDA_MAPBIOMAS
+    if nodata is None:
+        nodata = raster.rio.nodata
+
+    area_pixel = _area_pixel_m2(raster)
+    area_filas = area_pixel if np.ndim(area_pixel) else None
+
+    parciales = _parciales_por_bloque(
+        raster.data, _conteo_clases_bloque, nodata, area_filas
+    )
+    if len(parciales) == 1 and not hasattr(parciales[0], "dask"):
+        conteo, area = parciales[0]
+    else:
+        conteo, area = _combinar_en_arbol(parciales, _combinar_conteos, scheduler)
+
+    if area is None:
+        area = conteo * float(area_pixel)
+    codigos = np.flatnonzero(conteo)
+    if nodata is not None:
+        codigos = codigos[codigos != nodata]
+    area_ha = area[codigos] / 10_000
+    return pd.DataFrame(
+        {
+            "codigo": codigos,
+            "clase": [leyenda.get(int(c), f"Clase {c}") for c in codigos],
+            "pixeles": conteo[codigos],
+            "area_ha": area_ha,
+            "porcentaje": 100 * area_ha / area_ha.sum(),
+        }
+    )
+
+
+def _moda(bloques: np.ndarray, axis: tuple, nodata=None) -> np.ndarray:
+    """Valor más frecuente de ``bloques`` a lo largo de los ejes ``axis``.
+
+    Vectorizada: ordena los valores de cada ventana y busca la racha más
+    larga de valores iguales. ``NaN`` y ``nodata`` solo ganan si la ventana
+    no tiene otros valores; los empates se resuelven por el menor valor.
+    """
+    axis = tuple(a % bloques.ndim for a in np.atleast_1d(axis))
+    ventanas = np.moveaxis(bloques, axis, range(-len(axis), 0))
+    ventanas = ventanas.reshape(ventanas.shape[: -len(axis)] + (-1,))
+    ordenados = np.sort(ventanas, axis=-1)
+
+    posiciones = np.arange(ordenados.shape[-1])
+    nueva_racha = np.ones(ordenados.shape, dtype=bool)
+    nueva_racha[..., 1:] = ordenados[..., 1:] != ordenados[..., :-1]
+    inicio = np.where(nueva_racha, posiciones, 0)
+    np.maximum.accumulate(inicio, axis=-1, out=inicio)
+    largo = posiciones - inicio
+    if nodata is not None:
+        largo[ordenados == nodata] = -1
+    fin = largo.argmax(axis=-1)
+    return np.take_along_axis(ordenados, fin[..., None], axis=-1)[..., 0]
+
+
+def reducir_por_bloques(
+    raster: xr.DataArray,
+    factor: int,
+    metodo: str = "media",
+    nodata=None,
+) -> xr.DataArray:
+    """Agrega un raster en bloques de ``factor`` x ``factor`` píxeles.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Raster con dimensiones ``y`` y ``x`` (en memoria o con dask).
+    factor : int
+        Número de píxeles por lado que se agrupan en cada píxel de salida.
+        Las filas y columnas sobrantes del borde se descartan.
+    metodo : {"media", "moda"}
+        ``"media"`` para datos continuos (ignora ``NaN``) y ``"moda"`` (clase
+        más frecuente) para datos categóricos como la cobertura de suelo.
+    nodata : optional
+        Valor que la moda ignora salvo que el bloque no tenga otros valores.
+
+    Returns
+    -------
+    xarray.DataArray
+        Raster agregado, con coordenadas y transformación actualizadas.
+    """
+    if metodo not in ("media", "moda"):
+        raise ValueError("metodo debe ser 'media' o 'moda'")
+    factor = int(factor)
+    if factor <= 1:
+        return raster
+
+    eje_y, eje_x = raster.get_axis_num("y"), raster.get_axis_num("x")
+    if metodo == "moda":
+
+        def reductor(bloques, axis=None):
+            # dask llama al reductor sin ejes para inferir el tipo de salida
+            return bloques if axis is None else _moda(bloques, axis, nodata)
+
+    elif np.issubdtype(raster.dtype, np.floating):
+        reductor = np.nanmean
+    else:
+        reductor = np.mean
+
+    datos = raster.data
+    if hasattr(datos, "dask"):
+        import dask.array as da
+
+        # Cada chunk debe contener un número entero de bloques
+        datos = datos.rechunk(
+            {
+                eje: max(factor, datos.chunksize[eje] // factor * factor)
+                for eje in (eje_y, eje_x)
+            }
+        )
+        reducido = da.coarsen(
+            reductor, datos, {eje_y: factor, eje_x: factor}, trim_excess=True
+        )
+    else:
+        alto = datos.shape[eje_y] // factor * factor
+        ancho = datos.shape[eje_x] // factor * factor
+        recorte = [slice(None)] * datos.ndim
+        recorte[eje_y], recorte[eje_x] = slice(0, alto), slice(0, ancho)
+        recortado = np.asarray(datos)[tuple(recorte)]
+        forma = list(recortado.shape)
+        forma[eje_x : eje_x + 1] = [ancho // factor, factor]
+        forma[eje_y : eje_y + 1] = [alto // factor, factor]
+        reducido = reductor(recortado.reshape(forma), axis=(eje_y + 1, eje_x + 2))
+
+    resultado = xr.DataArray(
+        reducido,
+        dims=raster.dims,
+        coords=_coordenadas_reducidas(raster, factor),
+        attrs=raster.attrs,
+        name=raster.name,
+    )
+    return _georreferenciar_reducido(resultado, raster, factor)
+
+
+def _coordenadas_reducidas(raster: xr.DataArray, factor: int) -> dict:
+    """Coordenadas de ``raster`` agregado en bloques de ``factor`` píxeles."""
+
+    def _coordenada(nombre):
+        valores = raster[nombre].values
+        n = len(valores) // factor
+        return valores[: n * factor].reshape(n, factor).mean(axis=1)
+
+    coords = {
+        nombre: coord
+        for nombre, coord in raster.coords.items()
+        if "y" not in coord.dims and "x" not in coord.dims
+    }
+    coords["y"] = _coordenada("y")
+    coords["x"] = _coordenada("x")
+    return coords
+
+
+def _georreferenciar_reducido(resultado, raster: xr.DataArray, factor: int):
+    """Copia el CRS de ``raster`` y escala su transformación por ``factor``."""
+    if raster.rio.crs is not None:
+        resultado = resultado.rio.write_crs(raster.rio.crs)
+    return resultado.rio.write_transform(
+        raster.rio.transform() * Affine.scale(factor, factor)
+    )
+
+
+def _indices_de_clase(bloque: np.ndarray, clases: np.ndarray) -> np.ndarray:
+    """Posición de cada píxel en ``clases``; ``len(clases)`` si no está."""
+    n_clases = clases.size
+    if bloque.dtype.kind in "ub" and bloque.dtype.itemsize <= 2:
+        # Tabla de consulta: un acceso por píxel, sin búsqueda
+        tabla = np.full(2 ** (8 * bloque.dtype.itemsize), n_clases, dtype=np.intp)
+        validas = clases[(clases >= 0) & (clases < tabla.size)]
+        tabla[validas] = np.searchsorted(clases, validas)
+        return tabla[bloque]
+    indices = np.searchsorted(clases, bloque)
+    np.minimum(indices, n_clases - 1, out=indices)
+    indices[clases[indices] != bloque] = n_clases
+    return indices
+
+
+def _conteo_por_celda(bloque: np.ndarray, clases: np.ndarray, factor: int):
+    """Conteo de cada clase en cada celda de ``factor`` x ``factor`` píxeles.
+
+    Todas las clases se cuentan con un único ``np.bincount`` sobre el índice
+    combinado ``(celda, clase)``; los píxeles que no pertenecen a ``clases``
+    (por ejemplo, nodata) van a una casilla extra que se descarta. Devuelve
+    un arreglo ``(clases, filas, columnas)``.
+    """
+    alto, ancho = bloque.shape[0] // factor, bloque.shape[1] // factor
+    n_clases = clases.size
+    indices = _indices_de_clase(bloque, clases)
+    celdas = (np.arange(bloque.shape[0]) // factor)[:, None] * ancho + (
+        np.arange(bloque.shape[1]) // factor
+    )[None, :]
+    combinado = celdas * (n_clases + 1) + indices
+    conteo = np.bincount(combinado.ravel(), minlength=alto * ancho * (n_clases + 1))
+    conteo = conteo.reshape(alto, ancho, n_clases + 1)[..., :n_clases]
+    return np.moveaxis(conteo, -1, 0).astype(np.int32)
+
+
+def agregar_categorico(
+    raster: xr.DataArray,
+    factor: int,
+    clases=None,
+    nodata: int | None = None,
+    leyenda: dict | None = None,
+) -> xr.Dataset:
+    """Agrega un raster categórico en bloques de ``factor`` x ``factor`` píxeles.
+
+    Remuestrear la cobertura de suelo con un promedio mezcla códigos de clase
+    sin sentido. Esta función cuenta, con un único ``np.bincount`` por chunk,
+    cuántos píxeles de cada clase caen en cada celda de salida, y a partir de
+    esos conteos entrega la moda, la fracción de cada clase y la diversidad.
+    Con un arreglo de dask los chunks se procesan en paralelo.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Raster de enteros de una banda (en memoria o con dask).
+    factor : int
+        Número de píxeles por lado de cada celda de salida. Las filas y
+        columnas sobrantes del borde se descartan.
+    clases : array-like, optional
+        Códigos de clase a considerar. Por defecto, todos los presentes en
+        el raster (lo que requiere una pasada adicional).
+    nodata : int, optional
+        Código que se excluye. Por defecto ``raster.rio.nodata``.
+    leyenda : dict, optional
+        ``{código: nombre}`` para la coordenada ``nombre``. Por defecto, la
+        leyenda de MapBiomas.
+
+    Returns
+    -------
+    xarray.Dataset
+        Con las variables ``moda`` (clase más frecuente; los empates se
+        resuelven por el menor código y las celdas sin píxeles válidos quedan
+        con ``nodata``), ``fraccion`` (dimensión ``clase``, fracción de los
+        píxeles válidos de la celda), ``diversidad`` (índice de Shannon, en
+        nats) y ``validos`` (número de píxeles válidos).
+    """
+    raster = _como_banda_unica(raster)
+    if not np.issubdtype(raster.dtype, np.integer):
+        raise ValueError("agregar_categorico requiere un raster de enteros")
+    factor = int(factor)
+    if factor < 1:
+        raise ValueError("factor debe ser un entero positivo")
+    if leyenda is None:
+        leyenda = LEYENDA_MAPBIOMAS
+    if nodata is None:
+        nodata = raster.rio.nodata
+    if clases is None:
+        clases = valores_unicos(raster)
+    clases = np.unique(np.asarray(clases, dtype=np.int64))
+    if nodata is not None:
+        clases = clases[clases != nodata]
+    if clases.size == 0:
+        raise ValueError("el raster no tiene clases válidas")
+
+    eje_y, eje_x = raster.get_axis_num("y"), raster.get_axis_num("x")
+    if (eje_y, eje_x) != (0, 1):
+        raster = raster.transpose("y", "x")
+    alto = raster.sizes["y"] // factor * factor
+    ancho = raster.sizes["x"] // factor * factor
+    datos = raster.data[:alto, :ancho]
+
+    if hasattr(datos, "dask"):
+        # Cada chunk debe contener un número entero de celdas
+        datos = datos.rechunk(
+            tuple(max(factor, tamano // factor * factor) for tamano in datos.chunksize)
+        )
+        conteo = datos.map_blocks(
+            _conteo_por_celda,
+            clases,
+            factor,
+            new_axis=0,
+            chunks=((clases.size,),)
+            + tuple(tuple(c // factor for c in eje) for eje in datos.chunks),
+            dtype=np.int32,
+            meta=np.empty((0, 0, 0), dtype=np.int32),
+        )
+    else:
+        conteo = _conteo_por_celda(np.asarray(datos), clases, factor)
+
+    coords = _coordenadas_reducidas(raster, factor)
+    conteo = xr.DataArray(
+        conteo,
+        dims=("clase", "y", "x"),
+        coords={"clase": clases, "y": coords["y"], "x": coords["x"]},
+    )
+    validos = conteo.sum("clase")
+    fraccion = (conteo / validos.where(validos > 0)).astype(np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        diversidad = -(fraccion * np.log(fraccion.where(fraccion > 0))).sum("clase")
+    indice_moda = conteo.argmax("clase")
+    moda = xr.apply_ufunc(
+        lambda i: clases.astype(raster.dtype)[i],
+        indice_moda,
+        dask="parallelized",
+        output_dtypes=[raster.dtype],
+    )
+    if nodata is not None:
+        moda = moda.where(validos > 0, nodata).astype(raster.dtype)
+
+    resultado = xr.Dataset(
+        {
+            "moda": moda,
+            "fraccion": fraccion,
+            "diversidad": diversidad.where(validos > 0).astype(np.float32),
+            "validos": validos,
+        }
+    )
+    resultado = resultado.assign_coords(
+        nombre=("clase", [leyenda.get(int(c), f"Clase {c}") for c in clases])
+    )
+    resultado["moda"] = resultado["moda"].rio.write_nodata(nodata)
+    return _georreferenciar_reducido(resultado, raster, factor)
+
+
+def _crs_distinto(a, b) -> bool:
+    """Indica si dos definiciones de CRS son distintas."""
+    return rasterio.crs.CRS.from_user_input(a) != rasterio.crs.CRS.from_user_input(b)
+
+
+def ventana_de_limites(src, limites: tuple, crs=None) -> Window:
+    """Ventana de píxeles de ``src`` que cubre los ``limites`` dados.
+
+    Los límites ``(xmin, ymin, xmax, ymax)`` pueden venir en otro ``crs``;
+    en ese caso se transforman (densificando los bordes) al CRS del raster.
+    La ventana se expande a píxeles completos y se recorta a la extensión
+    del raster.
+    """
+    if crs is not None and src.crs is not None and _crs_distinto(crs, src.crs):
+        limites = transform_bounds(crs, src.crs, *limites, densify_pts=21)
+    ventana = from_bounds(*limites, transform=src.transform)
+    fila0 = max(0, math.floor(ventana.row_off))
+    col0 = max(0, math.floor(ventana.col_off))
+    fila1 = min(src.height, math.ceil(ventana.row_off + ventana.height))
+    col1 = min(src.width, math.ceil(ventana.col_off + ventana.width))
+    if fila1 <= fila0 or col1 <= col0:
+        raise ValueError("los límites no intersectan el raster")
+    return Window(col0, fila0, col1 - col0, fila1 - fila0)
+
+
+def leer_ventana(
+    ruta: str,
+    limites: tuple | None = None,
+    geometria=None,
+    crs=None,
+    crs_salida=None,
+    resolucion: float | tuple | None = None,
+    remuestreo: Resampling = Resampling.nearest,
+    enmascarar: bool = False,
+) -> xr.DataArray:
+    """Lee desde el disco solo la zona de un raster que cubre un área de interés.
+
+    A diferencia de abrir el raster completo y luego usar ``rio.clip_box``,
+    los límites (o la geometría) se traducen a una ventana de píxeles y GDAL
+    lee únicamente los bloques del archivo que la intersectan; extraer un
+    área pequeña de un mosaico de varios gigabytes cuesta milisegundos.
+
+    Parameters
+    ----------
+    ruta : str
+        Ruta o URL del raster.
+    limites : tuple, optional
+        ``(xmin, ymin, xmax, ymax)`` del área de interés.
+    geometria : shapely geometry, geopandas.GeoSeries or GeoDataFrame, optional
+        Polígono del área de interés. Se lee la ventana de su caja envolvente
+        y los píxeles fuera del polígono quedan como sin dato.
+    crs : optional
+        CRS de ``limites`` o ``geometria``. Por defecto, el del raster (o el
+        de la ``GeoSeries``).
+    crs_salida : optional
+        Si se indica, la ventana leída se reproyecta a este CRS y se recorta
+        de nuevo al área de interés (si se dieron ``limites`` en otro CRS, a
+        su caja envolvente en ``crs_salida``).
+    resolucion : float or tuple, optional
+        Resolución de salida al reproyectar.
+    remuestreo : rasterio.enums.Resampling
+        Método de remuestreo al reproyectar.
+    enmascarar : bool
+        Si es ``True``, los valores sin dato se convierten en ``NaN``.
+
+    Returns
+    -------
+    xarray.DataArray
+        El área de interés, ya cargada en memoria.
+    """
+    if (limites is None) == (geometria is None):
+        raise ValueError("indica limites o geometria (solo uno de los dos)")
+
+    geometrias = None
+    if geometria is not None:
+        if hasattr(geometria, "crs"):
+            crs = crs or geometria.crs
+            geometrias = list(geometria.geometry)
+        else:
+            geometrias = [geometria]
+        import shapely
+
+        limites = tuple(shapely.total_bounds(geometrias))
+
+    with rasterio.open(ruta) as src:
+        crs = crs or src.crs
+        ventana = ventana_de_limites(src, limites, crs)
+
+    # open_rasterio sin chunks no lee datos: isel_window + load lee solo la
+    # ventana (y GDAL, solo los bloques que la intersectan)
+    recorte = rxr.open_rasterio(ruta, masked=enmascarar, cache=False)
+    recorte = recorte.rio.isel_window(ventana).load()
+
+    if crs_salida is not None and _crs_distinto(crs_salida, recorte.rio.crs):
+        recorte = recorte.rio.reproject(
+            crs_salida, resolution=resolucion, resampling=remuestreo
+        )
+        if geometrias is None:
+            if _crs_distinto(crs, crs_salida):
+                limites = transform_bounds(crs, crs_salida, *limites, densify_pts=21)
+            recorte = recorte.rio.clip_box(*limites)
+
+    if geometrias is not None:
+        recorte = recorte.rio.clip(geometrias, crs=crs, drop=True)
+    return recorte
@@ -0,0 +1,244 @@
+"""Muestreo de rasters en puntos.
+
+Extrae, por ejemplo, la clase de cobertura o la elevación en parcelas de
+terreno o en los puntos de un track GPS (``Point`` de Shapely como los de
+``notebooks/01_vector``), sin una llamada a ``sel()`` por punto: las
+coordenadas se transforman y se convierten a fila y columna en bloque, los
+puntos se agrupan por la zona del raster en que caen y cada zona se lee una
+sola vez.
+"""
+
+from __future__ import annotations
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from pyproj import Transformer
+
+from .raster_utils import abrir_por_proceso
+
+# Lado mínimo (en píxeles) de las celdas que agrupan los puntos en una lectura;
+# se redondea a un múltiplo de los bloques internos del archivo
+LADO_CELDA = 512
+
+METODOS = ("cercano", "bilineal")
+
+
+def _coordenadas(puntos, crs, crs_raster) -> tuple[np.ndarray, np.ndarray]:
+    """Coordenadas ``x, y`` de los puntos en el CRS del raster.
+
+    Acepta una capa de GeoPandas, una secuencia de ``Point`` de Shapely, un
+    arreglo ``(n, 2)`` o una tupla ``(x, y)``. La transformación de CRS se
+    hace con una sola llamada vectorizada de ``pyproj``.
+    """
+    if isinstance(puntos, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        crs = puntos.crs if crs is None else crs
+        puntos = puntos.geometry.values
+    if isinstance(puntos, tuple) and len(puntos) == 2:
+        x, y = (np.asarray(c, dtype=np.float64) for c in puntos)
+    else:
+        arreglo = np.asarray(puntos)
+        if arreglo.dtype == object or arreglo.ndim == 1:
+            geometrias = np.asarray(puntos, dtype=object)
+            x, y = shapely.get_x(geometrias), shapely.get_y(geometrias)
+        elif arreglo.ndim == 2 and arreglo.shape[1] == 2:
+            x, y = arreglo[:, 0].astype(np.float64), arreglo[:, 1].astype(np.float64)
+        else:
+            raise ValueError(
+                "los puntos deben ser geometrías, (x, y) o un arreglo (n, 2)"
+            )
+
+    if crs is not None and crs_raster is not None:
+        crs = rasterio.crs.CRS.from_user_input(crs)
+        if crs != crs_raster:
+            transformador = Transformer.from_crs(crs, crs_raster, always_xy=True)
+            x, y = transformador.transform(x, y)
+    return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+
+def _lado_celda(src) -> tuple[int, int]:
+    """Alto y ancho de las celdas de lectura, alineados a los bloques internos."""
+    alto_bloque, ancho_bloque = src.block_shapes[0]
+    return (
+        max(1, -(-LADO_CELDA // alto_bloque)) * alto_bloque,
+        max(1, -(-LADO_CELDA // ancho_bloque)) * ancho_bloque,
+    )
+
+
+def _muestrear_celda(ruta, bandas, filas, columnas, metodo, nodata):
+    """Valores de los puntos de una celda, leyendo su ventana una sola vez.
+
+    ``filas`` y ``columnas`` son posiciones fraccionarias de píxel dentro
+    del raster. Devuelve un arreglo ``(puntos, bandas)``: del tipo del
+    raster con el método ``"cercano"`` y ``float64`` (con ``NaN`` donde no
+    hay vecinos válidos) con ``"bilineal"``.
+    """
+    src = abrir_por_proceso(ruta)
+    if metodo == "cercano":
+        fila = np.floor(filas).astype(np.int64)
+        col = np.floor(columnas).astype(np.int64)
+        fila0, col0 = fila.min(), col.min()
+        ventana = rasterio.windows.Window(
+            col0, fila0, col.max() - col0 + 1, fila.max() - fila0 + 1
+        )
+        datos = src.read(bandas, window=ventana)
+        return datos[:, fila - fila0, col - col0].T
+
+    # Vecino superior izquierdo y pesos de los cuatro vecinos (centros de píxel)
+    fy, fx = filas - 0.5, columnas - 0.5
+    fila = np.floor(fy).astype(np.int64)
+    col = np.floor(fx).astype(np.int64)
+    dy, dx = fy - fila, fx - col
+    ultima_fila, ultima_col = src.height - 1, src.width - 1
+    vecinos_filas = [np.clip(fila, 0, ultima_fila), np.clip(fila + 1, 0, ultima_fila)]
+    vecinos_cols = [np.clip(col, 0, ultima_col), np.clip(col + 1, 0, ultima_col)]
+    fila0, col0 = vecinos_filas[0].min(), vecinos_cols[0].min()
+    ventana = rasterio.windows.Window(
+        col0,
+        fila0,
+        vecinos_cols[1].max() - col0 + 1,
+        vecinos_filas[1].max() - fila0 + 1,
+    )
+    datos = src.read(bandas, window=ventana).astype(np.float64)
+
+    suma = np.zeros((len(bandas), filas.size))
+    pesos = np.zeros((len(bandas), filas.size))
+    for i, peso_y in ((0, 1 - dy), (1, dy)):
+        for j, peso_x in ((0, 1 - dx), (1, dx)):
+            valores = datos[:, vecinos_filas[i] - fila0, vecinos_cols[j] - col0]
+            validos = ~np.isnan(valores)
+            if nodata is not None:
+                validos &= valores != nodata
+            peso = np.where(validos, peso_y * peso_x, 0.0)
+            suma += np.where(validos, valores, 0.0) * peso
+            pesos += peso
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(pesos > 0, suma / pesos, np.nan).T
+
+
+def muestrear(
+    ruta: str,
+    puntos,
+    bandas=None,
+    metodo: str = "cercano",
+    crs=None,
+    nodata: float | None = None,
+    relleno: float | None = None,
+    procesos: int | None = None,
+) -> np.ndarray:
+    """Valores de un raster en millones de puntos.
+
+    Las coordenadas se llevan al CRS del raster y a posiciones de píxel con
+    la transformación afín, todo en bloque. Los puntos se ordenan por la
+    celda del raster en que caen (celdas alineadas a los bloques internos
+    del archivo) y cada celda se lee una sola vez, con la ventana justa que
+    cubre sus puntos; las celdas se reparten entre procesos.
+
+    Parameters
+    ----------
+    ruta : str
+        Ruta del raster (cada proceso abre su propia conexión).
+    puntos : geopandas.GeoDataFrame, sequence of Point, array or tuple
+        Puntos a muestrear: una capa o secuencia de ``Point`` de Shapely,
+        un arreglo ``(n, 2)`` de coordenadas o una tupla ``(x, y)``.
+    bandas : int or list of int, optional
+        Bandas que se muestrean (desde 1). Por defecto, todas.
+    metodo : {"cercano", "bilineal"}
+        Valor del píxel que contiene al punto, o interpolación bilineal
+        entre los cuatro centros de píxel más cercanos (para rasters
+        continuos como un DEM). En la bilineal los vecinos sin dato se
+        ignoran y se reparten sus pesos entre los demás.
+    crs : optional
+        CRS de las coordenadas. Por defecto, el de la capa de GeoPandas; si
+        no se conoce, se asume el del raster.
+    nodata : float, optional
+        Valor sin dato. Por defecto, el del raster.
+    relleno : float, optional
+        Valor para los puntos fuera del raster (o sin vecinos válidos). Por
+        defecto ``nodata`` o, si el raster no tiene, ``NaN``. Los rasters de
+        enteros conservan su tipo salvo que el relleno no se pueda
+        representar en él (``NaN``, decimales o fuera de rango); en ese caso
+        se entregan como ``float64``.
+    procesos : int, optional
+        Número de procesos. Por defecto, todos los núcleos; con ``1`` se
+        calcula en el proceso actual.
+
+    Returns
+    -------
+    numpy.ndarray
+        Arreglo ``(puntos, bandas)`` en el mismo orden que ``puntos``, por
+        ejemplo para ``capa["cobertura"] = muestrear(ruta, capa)[:, 0]``.
+    """
+    if metodo not in METODOS:
+        raise ValueError(f"metodo debe ser uno de {METODOS}")
+    with rasterio.open(ruta) as src:
+        crs_raster = src.crs
+        transform = src.transform
+        alto, ancho = src.height, src.width
+        tipo = np.dtype(src.dtypes[0])
+        lado_y, lado_x = _lado_celda(src)
+        if bandas is None:
+            bandas = list(src.indexes)
+        if nodata is None:
+            nodata = src.nodata
+    bandas = [bandas] if np.isscalar(bandas) else list(bandas)
+    if relleno is None:
+        relleno = np.nan if nodata is None else nodata
+    if metodo == "bilineal":
+        tipo = np.dtype(np.float64)
+    elif np.issubdtype(tipo, np.integer):
+        # rasterio entrega el nodata como float: un relleno entero que cabe
+        # en el tipo del raster no obliga a pasar a float64
+        limites = np.iinfo(tipo)
+        if (
+            np.isfinite(relleno)
+            and float(relleno).is_integer()
+            and limites.min <= relleno <= limites.max
+        ):
+            relleno = tipo.type(relleno)
+        else:
+            tipo = np.result_type(tipo, np.float64)
+    elif not np.can_cast(np.min_scalar_type(relleno), tipo):
+        tipo = np.result_type(tipo, np.float64)
+
+    x, y = _coordenadas(puntos, crs, crs_raster)
+    columnas, filas = ~transform * (x, y)
+    dentro = (filas >= 0) & (filas < alto) & (columnas >= 0) & (columnas < ancho)
+    posiciones = np.flatnonzero(dentro)
+    filas, columnas = filas[posiciones], columnas[posiciones]
+
+    # Agrupa los puntos por celda de lectura
+    ancla_y, ancla_x = filas, columnas
+    if metodo == "bilineal":
+        ancla_y = np.clip(filas - 0.5, 0, alto - 1)
+        ancla_x = np.clip(columnas - 0.5, 0, ancho - 1)
+    celdas = (ancla_y // lado_y).astype(np.int64) * (-(-ancho // lado_x)) + (
+        ancla_x // lado_x
+    ).astype(np.int64)
+    orden = np.argsort(celdas, kind="stable")
+    _, inicios = np.unique(celdas[orden], return_index=True)
+    grupos = np.split(orden, inicios[1:]) if orden.size else []
+    tareas = [
+        (ruta, bandas, filas[grupo], columnas[grupo], metodo, nodata)
+        for grupo in grupos
+    ]
+
+    procesos = procesos or os.cpu_count() or 1
+    if procesos == 1 or len(tareas) <= 1:
+        resultados = [_muestrear_celda(*tarea) for tarea in tareas]
+    else:
+        with ProcessPoolExecutor(max_workers=procesos) as ejecutor:
+            resultados = list(
+                ejecutor.map(_muestrear_celda, *zip(*tareas), chunksize=16)
+            )
+
+    salida = np.full((x.size, len(bandas)), relleno, dtype=tipo)
+    for grupo, valores in zip(grupos, resultados):
+        salida[posiciones[grupo]] = valores
+    if metodo == "bilineal" and not np.isnan(relleno):
+        salida[np.isnan(salida)] = relleno
+    return salida
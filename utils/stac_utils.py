@@ -0,0 +1,416 @@
+"""Búsquedas en catálogos STAC: caché en disco e iteración por páginas.
+
+Las búsquedas de ``notebooks/02_raster/03_acceso_imagenes.py`` (Sentinel-2 y
+Landsat en Planetary Computer) se repiten en cada ejecución con la misma
+extensión, fechas y filtro de nubosidad. Aquí se guardan los ítems
+encontrados como JSON en ``DIRECTORIO_STAC``, de modo que las siguientes
+ejecuciones no esperan al servidor y pueden correr sin conexión. Para
+búsquedas de varios años o de todo el país, ``iterar_items`` entrega los
+ítems a medida que llegan las páginas y permite detenerse antes. Al
+cargar las imágenes, ``cargar_bandas`` lee una sola vez las bandas que
+comparten varias composiciones.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pystac
+import xarray as xr
+from pystac_client.item_search import ItemSearch
+
+from .cache_utils import DIRECTORIO_CACHE, _desalojar_lru, _escribir_json
+
+DIRECTORIO_STAC = os.path.join(DIRECTORIO_CACHE, "stac")
+
+# Vigencia por defecto de una búsqueda guardada, en segundos (un día)
+TTL_BUSQUEDAS = 24 * 3600
+
+# Tamaño máximo por defecto de la caché de búsquedas, en megabytes
+MAX_MB_BUSQUEDAS = 200.0
+
+# Con GEOMATICA_OFFLINE=1 las búsquedas se responden solo desde la caché
+OFFLINE = os.environ.get("GEOMATICA_OFFLINE", "0") == "1"
+
+
+def _url_catalogo(catalogo) -> str:
+    """URL raíz de un ``pystac_client.Client`` (o la URL entregada)."""
+    url = catalogo if isinstance(catalogo, str) else catalogo.get_self_href()
+    if url is None:
+        raise ValueError("el catálogo no tiene URL; ábralo con Client.open(url)")
+    return url.rstrip("/")
+
+
+def _normalizar_consulta(url: str, filtros: dict, max_items: int | None) -> dict:
+    """Consulta canónica: colecciones, bbox, fechas y filtros.
+
+    Los parámetros se formatean igual que los envía ``pystac_client`` (por
+    ejemplo, ``"2023-01/2023-03"`` pasa a un intervalo ISO 8601 completo) y
+    luego se ordenan, de modo que dos búsquedas equivalentes comparten la
+    misma clave aunque se escriban distinto.
+    """
+    parametros = ItemSearch(url + "/search", **filtros).get_parameters()
+    consulta = {"catalogo": url, "max_items": max_items}
+    for nombre, valor in parametros.items():
+        if nombre == "collections":
+            valor = sorted(valor)
+        elif nombre == "bbox":
+            valor = [round(float(c), 6) for c in valor]
+        consulta[nombre] = valor
+    return json.loads(json.dumps(consulta, sort_keys=True))
+
+
+def _clave(consulta: dict) -> str:
+    """Hash de la consulta canónica."""
+    texto = json.dumps(consulta, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(texto.encode(), digest_size=20).hexdigest()
+
+
+def buscar_con_cache(
+    catalogo,
+    collections=None,
+    bbox=None,
+    datetime=None,
+    query=None,
+    max_items: int | None = None,
+    ttl: float | None = TTL_BUSQUEDAS,
+    offline: bool | None = None,
+    modificador=None,
+    directorio: str | None = None,
+    max_mb: float = MAX_MB_BUSQUEDAS,
+    informar: bool = True,
+    **otros,
+) -> pystac.ItemCollection:
+    """Busca ítems en un catálogo STAC reutilizando resultados guardados.
+
+    La clave de la caché es la consulta normalizada (URL del catálogo,
+    colecciones, bbox, fechas, filtros ``query`` y demás parámetros). Si
+    existe una búsqueda guardada con esa clave y con menos de ``ttl``
+    segundos, se devuelve sin contactar al servidor (acierto); si no, se
+    busca, se guardan los ítems como JSON y se eliminan las búsquedas usadas
+    hace más tiempo hasta respetar ``max_mb`` (fallo).
+
+    Los ítems se guardan sin firmar: las firmas de Planetary Computer
+    vencen en pocas horas, así que el modificador del catálogo (por ejemplo
+    ``planetary_computer.sign_inplace``) se aplica de nuevo en cada lectura.
+
+    Parameters
+    ----------
+    catalogo : pystac_client.Client or str
+        Catálogo abierto con ``Client.open``. Sin conexión basta con su URL.
+    collections, bbox, datetime, query, max_items
+        Parámetros de ``Client.search``. Los demás (``intersects``,
+        ``filter``, ``sortby``, ...) se pasan con ``**otros``.
+    ttl : float, optional
+        Vigencia de una búsqueda guardada, en segundos. ``None``: no vence.
+    offline : bool, optional
+        Responde solo desde la caché, sin importar su antigüedad, y falla si
+        la búsqueda no está guardada. Por defecto, ``OFFLINE`` (variable de
+        entorno ``GEOMATICA_OFFLINE=1``).
+    modificador : callable, optional
+        Se aplica a los ítems devueltos. Por defecto, el del catálogo.
+    directorio : str, optional
+        Carpeta de la caché. Por defecto ``DIRECTORIO_STAC``; una copia de
+        esa carpeta sirve como catálogo local de reemplazo.
+    max_mb : float
+        Tamaño máximo de la caché, en megabytes.
+    informar : bool
+        Imprime si hubo acierto o fallo y cuántos ítems se encontraron.
+
+    Returns
+    -------
+    pystac.ItemCollection
+        Los ítems encontrados (``list(...)`` entrega una lista de
+        ``pystac.Item`` como ``search.get_items()``).
+    """
+    directorio = directorio or DIRECTORIO_STAC
+    offline = OFFLINE if offline is None else offline
+    if modificador is None and not isinstance(catalogo, str):
+        modificador = getattr(catalogo, "modifier", None)
+
+    filtros = {
+        "collections": collections,
+        "bbox": bbox,
+        "datetime": datetime,
+        "query": query,
+        **otros,
+    }
+    filtros = {k: v for k, v in filtros.items() if v is not None}
+    url = _url_catalogo(catalogo)
+    consulta = _normalizar_consulta(url, filtros, max_items)
+    clave = _clave(consulta)
+    ruta = os.path.join(directorio, f"{clave}.json")
+
+    guardada = None
+    if os.path.exists(ruta):
+        with open(ruta) as archivo:
+            guardada = json.load(archivo)
+        vencida = ttl is not None and time.time() - guardada["creada"] > ttl
+        if vencida and not offline:
+            guardada = None
+
+    if guardada is not None:
+        estado = "acierto"
+        os.utime(ruta)
+    elif offline:
+        raise FileNotFoundError(
+            f"la búsqueda no está en la caché ({clave[:12]}) y se pidió offline"
+        )
+    else:
+        if isinstance(catalogo, str):
+            raise ValueError("para buscar en el servidor se requiere un Client")
+        estado = "fallo"
+        busqueda = catalogo.search(**filtros, max_items=max_items)
+        busqueda.modifier = None
+        guardada = {
+            "consulta": consulta,
+            "creada": time.time(),
+            "items": busqueda.item_collection_as_dict(),
+        }
+        os.makedirs(directorio, exist_ok=True)
+        _escribir_json(ruta, guardada, directorio)
+        _desalojar_lru(directorio, max_mb * 2**20, (".json",), conservar=clave)
+
+    items = pystac.ItemCollection.from_dict(guardada["items"], preserve_dict=False)
+    if modificador is not None:
+        modificador(items)
+    if informar:
+        antiguedad = (time.time() - guardada["creada"]) / 3600
+        print(
+            f"Caché STAC: {estado} ({clave[:12]}), {len(items)} ítems, "
+            f"guardada hace {antiguedad:.1f} h"
+        )
+    return items
+
+
+def iterar_items(
+    catalogo,
+    collections=None,
+    bbox=None,
+    datetime=None,
+    query=None,
+    items_por_pagina: int = 100,
+    **otros,
+) -> Iterator[pystac.Item]:
+    """Entrega los ítems de una búsqueda a medida que llegan sus páginas.
+
+    A diferencia de ``list(search.get_items())``, no espera a tener todas
+    las páginas: mientras se procesan los ítems de una página, la siguiente
+    se pide al servidor en un hilo aparte. Al salir del ciclo (``break``) no
+    se piden más páginas, de modo que una búsqueda de varios años y miles
+    de escenas puede terminar apenas se tiene lo necesario (ver
+    ``primeros_por_grupo``).
+
+    Parameters
+    ----------
+    catalogo : pystac_client.Client
+        Catálogo abierto con ``Client.open``; su modificador (por ejemplo
+        ``planetary_computer.sign_inplace``) se aplica a cada página.
+    collections, bbox, datetime, query
+        Parámetros de ``Client.search``. Los demás (``intersects``,
+        ``sortby``, ``max_items``, ...) se pasan con ``**otros``.
+    items_por_pagina : int
+        Tamaño de cada página (parámetro ``limit`` de la API).
+
+    Yields
+    ------
+    pystac.Item
+        Los ítems en el orden en que los entrega el servidor.
+    """
+    argumentos = {
+        "collections": collections,
+        "bbox": bbox,
+        "datetime": datetime,
+        "query": query,
+        **otros,
+    }
+    argumentos = {k: v for k, v in argumentos.items() if v is not None}
+    if isinstance(catalogo, str):
+        raise ValueError(
+            "para iterar una búsqueda se requiere un Client (no hay caché offline)"
+        )
+    busqueda = catalogo.search(limit=items_por_pagina, **argumentos)
+    paginas = busqueda.pages_as_dicts()
+
+    ejecutor = ThreadPoolExecutor(max_workers=1)
+    try:
+        siguiente = ejecutor.submit(next, paginas, None)
+        while True:
+            pagina = siguiente.result()
+            if pagina is None:
+                return
+            siguiente = ejecutor.submit(next, paginas, None)
+            for item in pagina["features"]:
+                yield pystac.Item.from_dict(item, root=catalogo, preserve_dict=False)
+    finally:
+        ejecutor.shutdown(wait=False, cancel_futures=True)
+
+
+def primeros_por_grupo(
+    items,
+    n: int,
+    grupo="s2:mgrs_tile",
+    filtro=None,
+    grupos=None,
+) -> dict:
+    """Primeros ``n`` ítems de cada grupo que cumplen ``filtro``.
+
+    Recorre ``items`` (por ejemplo, el iterador de ``iterar_items``) y deja
+    de pedir ítems apenas cada grupo de ``grupos`` tiene ``n``; sin
+    ``grupos`` se recorren todos, pero se siguen guardando solo ``n`` por
+    grupo. Sirve para pedidos como "las primeras tres escenas con menos de
+    10 % de nubes de cada tesela".
+
+    Parameters
+    ----------
+    items : iterable of pystac.Item
+        Ítems en el orden deseado (para "las más recientes", busque con
+        ``sortby="-properties.datetime"``).
+    n : int
+        Número de ítems por grupo.
+    grupo : str or callable
+        Propiedad del ítem que define el grupo (por defecto la tesela MGRS
+        de Sentinel-2; ``"landsat:wrs_path"`` en Landsat) o función que
+        recibe el ítem y devuelve su grupo.
+    filtro : callable, optional
+        Función que recibe el ítem y devuelve si se acepta, por ejemplo
+        ``lambda item: item.properties["eo:cloud_cover"] < 10``.
+    grupos : iterable, optional
+        Grupos esperados. Con ellos la búsqueda termina en cuanto todos
+        están completos.
+
+    Returns
+    -------
+    dict
+        Listas de ítems por grupo, en el orden en que se encontraron.
+    """
+    if n < 1:
+        raise ValueError("n debe ser al menos 1")
+    clave = grupo if callable(grupo) else (lambda item: item.properties.get(grupo))
+    pendientes = None if grupos is None else set(grupos)
+    if pendientes is not None and not pendientes:
+        return {}
+
+    seleccion = {}
+    for item in items:
+        if filtro is not None and not filtro(item):
+            continue
+        nombre = clave(item)
+        lista = seleccion.setdefault(nombre, [])
+        if len(lista) >= n:
+            continue
+        lista.append(item)
+        if pendientes is not None and len(lista) == n:
+            pendientes.discard(nombre)
+            if not pendientes:
+                break
+    return seleccion
+
+
+# Composiciones de Sentinel-2, con las bandas en el orden rojo, verde, azul
+COMPOSICIONES_SENTINEL2 = {
+    "color_verdadero": ("B04", "B03", "B02"),
+    "falso_color_nir": ("B08", "B04", "B03"),
+    "agricultura": ("B11", "B08", "B02"),
+}
+
+# Índices de diferencia normalizada (a - b) / (a + b) de Sentinel-2
+INDICES_SENTINEL2 = {
+    "ndvi": ("B08", "B04"),
+    "ndwi": ("B03", "B08"),
+    "nbr": ("B08", "B12"),
+}
+
+
+def planificar_bandas(composiciones: dict, indices: dict | None = None) -> list:
+    """Unión de las bandas que usan las composiciones e índices, sin repetir.
+
+    Las bandas quedan en el orden en que aparecen por primera vez.
+    """
+    bandas = []
+    for grupo in (composiciones, indices or {}):
+        for nombre, componentes in grupo.items():
+            if isinstance(componentes, str) or len(componentes) not in (2, 3):
+                raise ValueError(
+                    f"{nombre!r} debe tener tres bandas (composición) o dos (índice)"
+                )
+            bandas.extend(b for b in componentes if b not in bandas)
+    return bandas
+
+
+def vistas_composiciones(
+    ds: xr.Dataset, composiciones: dict, indices: dict | None = None
+) -> dict:
+    """Composiciones e índices como vistas de un mismo conjunto de bandas.
+
+    Cada composición es una selección de variables de ``ds`` y cada índice
+    una expresión perezosa sobre ellas, de modo que ninguna copia ni vuelve
+    a leer datos: todas comparten las mismas tareas de lectura de dask.
+    Calcularlas juntas (``dask.compute``) o después de ``ds.persist()`` lee
+    cada banda una sola vez.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Bandas cargadas, por ejemplo con :func:`cargar_bandas`.
+    composiciones : dict
+        Nombre y bandas ``(rojo, verde, azul)`` de cada composición, como
+        ``COMPOSICIONES_SENTINEL2``.
+    indices : dict, optional
+        Nombre y bandas ``(a, b)`` de cada índice ``(a - b) / (a + b)``,
+        como ``INDICES_SENTINEL2``.
+
+    Returns
+    -------
+    dict
+        ``xarray.Dataset`` de tres variables por composición y
+        ``xarray.DataArray`` ``float32`` por índice (``NaN`` donde
+        ``a + b`` es cero, como en los píxeles sin dato).
+    """
+    faltantes = [b for b in planificar_bandas(composiciones, indices) if b not in ds]
+    if faltantes:
+        raise ValueError(f"faltan las bandas {faltantes} en el Dataset")
+
+    vistas = {nombre: ds[list(bandas)] for nombre, bandas in composiciones.items()}
+    for nombre, (a, b) in (indices or {}).items():
+        banda_a, banda_b = ds[a].astype(np.float32), ds[b].astype(np.float32)
+        suma = banda_a + banda_b
+        vistas[nombre] = ((banda_a - banda_b) / suma.where(suma != 0)).rename(nombre)
+    return vistas
+
+
+def cargar_bandas(
+    items, composiciones: dict, indices: dict | None = None, **parametros
+) -> xr.Dataset:
+    """Carga una sola vez todas las bandas de varias composiciones e índices.
+
+    En vez de llamar a ``odc.stac.load`` por cada composición (que leería
+    dos veces las bandas compartidas, como B04 y B03 en color verdadero y
+    falso color), se carga la unión de las bandas; las composiciones se
+    obtienen luego con :func:`vistas_composiciones`, sin más lecturas.
+
+    Parameters
+    ----------
+    items : iterable of pystac.Item
+        Ítems de la búsqueda.
+    composiciones, indices : dict
+        Como en :func:`vistas_composiciones`.
+    **parametros
+        Argumentos de ``odc.stac.load`` (``bbox``, ``crs``, ``resolution``,
+        ``group_by``, ``chunks``, ...).
+
+    Returns
+    -------
+    xarray.Dataset
+        Una variable por banda, perezosa si se indican ``chunks``.
+    """
+    import odc.stac
+
+    bandas = planificar_bandas(composiciones, indices)
+    return odc.stac.load(items, bands=bandas, **parametros)
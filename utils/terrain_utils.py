@@ -0,0 +1,188 @@
+"""Derivados de terreno a partir de modelos digitales de elevación (DEM).
+
+Complementa la sección 6 de ``01_datos_raster.py``: en lugar de llamar a
+``xrspatial.slope``, ``xrspatial.aspect`` y ``xrspatial.hillshade`` por
+separado (cada una recalcula los mismos gradientes de 3x3), un único kernel
+calcula los gradientes una vez por píxel y entrega todos los productos
+pedidos en la misma pasada.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+import xarray as xr
+from numba import njit
+
+# Productos disponibles, en el orden en que los entrega el kernel
+PRODUCTOS = ("pendiente", "aspecto", "sombreado", "curvatura", "rugosidad")
+
+UNIDADES = {
+    "pendiente": "grados",
+    "aspecto": "grados",
+    "sombreado": "",
+    "curvatura": "1/100 unidades de z",
+    "rugosidad": "unidades de z",
+}
+
+
+@njit(cache=True, nogil=True)
+def _kernel_terreno(z, posiciones, cx, cy, azimut, altitud, factor_z):
+    """Calcula los productos pedidos para el interior de ``z``.
+
+    ``z`` incluye un halo de 1 píxel en cada borde. ``posiciones[k]`` es la
+    capa de salida del producto ``PRODUCTOS[k]`` o ``-1`` si no se pidió; el
+    resultado tiene la forma ``(productos pedidos, filas - 2, columnas - 2)``.
+    Los gradientes siguen el método de Horn, igual que ``xrspatial``.
+    """
+    filas, columnas = z.shape
+    n_capas = 0
+    for k in range(posiciones.size):
+        if posiciones[k] >= 0:
+            n_capas += 1
+    out = np.full((n_capas, filas - 2, columnas - 2), np.nan, dtype=np.float32)
+    p_pendiente, p_aspecto, p_sombreado, p_curvatura, p_rugosidad = posiciones
+
+    zenit = np.deg2rad(90.0 - altitud)
+    azimut_mat = np.deg2rad((360.0 - azimut + 90.0) % 360.0)
+    cos_zenit = np.cos(zenit)
+    sin_zenit = np.sin(zenit)
+    grados = 180.0 / np.pi
+
+    for y in range(1, filas - 1):
+        for x in range(1, columnas - 1):
+            a = z[y - 1, x - 1]
+            b = z[y - 1, x]
+            c = z[y - 1, x + 1]
+            d = z[y, x - 1]
+            e = z[y, x]
+            f = z[y, x + 1]
+            g = z[y + 1, x - 1]
+            h = z[y + 1, x]
+            i = z[y + 1, x + 1]
+
+            # Gradientes de Horn sin escalar (compartidos por todos los productos)
+            gx = ((c + 2 * f + i) - (a + 2 * d + g)) / 8
+            gy = ((g + 2 * h + i) - (a + 2 * b + c)) / 8
+            dz_dx = gx / cx
+            dz_dy = gy / cy
+            pendiente = np.arctan(factor_z * np.sqrt(dz_dx * dz_dx + dz_dy * dz_dy))
+
+            if p_pendiente >= 0:
+                out[p_pendiente, y - 1, x - 1] = pendiente * grados
+            if p_aspecto >= 0:
+                if gx == 0 and gy == 0:
+                    out[p_aspecto, y - 1, x - 1] = -1.0
+                else:
+                    angulo = np.arctan2(gy, -gx) * grados
+                    if angulo < 0:
+                        out[p_aspecto, y - 1, x - 1] = 90.0 - angulo
+                    elif angulo > 90.0:
+                        out[p_aspecto, y - 1, x - 1] = 360.0 - angulo + 90.0
+                    else:
+                        out[p_aspecto, y - 1, x - 1] = 90.0 - angulo
+            if p_sombreado >= 0:
+                orientacion = np.arctan2(dz_dy, -dz_dx)
+                luz = cos_zenit * np.cos(pendiente) + sin_zenit * np.sin(
+                    pendiente
+                ) * np.cos(azimut_mat - orientacion)
+                out[p_sombreado, y - 1, x - 1] = (luz + 1) / 2
+            if p_curvatura >= 0:
+                dv = (h + b) / 2 - e
+                dh = (f + d) / 2 - e
+                out[p_curvatura, y - 1, x - 1] = -2 * (dv + dh) * 100 / (cx * cx)
+            if p_rugosidad >= 0 and not np.isnan(a + b + c + d + e + f + g + h + i):
+                minimo = min(a, b, c, d, e, f, g, h, i)
+                maximo = max(a, b, c, d, e, f, g, h, i)
+                out[p_rugosidad, y - 1, x - 1] = maximo - minimo
+    return out
+
+
+def derivados_terreno(
+    dem: xr.DataArray,
+    productos: tuple | list = ("pendiente", "aspecto", "sombreado"),
+    azimut: float = 225.0,
+    altitud: float = 25.0,
+    factor_z: float = 1.0,
+) -> xr.Dataset:
+    """Calcula varios derivados de un DEM en una sola pasada.
+
+    Cada tesela (chunk de dask) se lee una vez con un halo de 1 píxel, se
+    calculan sus gradientes de 3x3 y con ellos todos los ``productos``
+    pedidos; las teselas se procesan en paralelo. Con un DEM en memoria se
+    procesa la grilla completa de la misma forma.
+
+    Parameters
+    ----------
+    dem : xarray.DataArray
+        DEM de una banda en un CRS proyectado (la resolución se toma como el
+        tamaño de celda en las mismas unidades que la elevación).
+    productos : tuple of str
+        Cualquier combinación de ``PRODUCTOS``:
+
+        * ``pendiente``: en grados, como ``xrspatial.slope``.
+        * ``aspecto``: en grados desde el norte, ``-1`` en zonas planas, como
+          ``xrspatial.aspect``.
+        * ``sombreado``: entre 0 y 1 con la fórmula clásica de ESRI/GDAL. A
+          diferencia de ``xrspatial.hillshade`` (que usa ``np.gradient`` sin
+          el tamaño de celda), usa los mismos gradientes que la pendiente.
+        * ``curvatura``: como ``xrspatial.curvature``.
+        * ``rugosidad``: diferencia entre el máximo y el mínimo de la
+          ventana de 3x3 (definición de GDAL).
+    azimut, altitud : float
+        Posición del sol en grados para el sombreado.
+    factor_z : float
+        Factor de exageración vertical para la pendiente y el sombreado.
+
+    Returns
+    -------
+    xarray.Dataset
+        Una variable ``float32`` por producto, con las coordenadas del DEM.
+        Los bordes del raster y los píxeles junto a un valor sin dato
+        (``dem.rio.nodata``) quedan en ``NaN``.
+    """
+    productos = list(dict.fromkeys(productos))
+    desconocidos = set(productos) - set(PRODUCTOS)
+    if desconocidos:
+        raise ValueError(f"productos desconocidos: {sorted(desconocidos)}")
+    if "band" in dem.dims:
+        dem = dem.squeeze("band", drop=True)
+
+    cx, cy = (abs(r) for r in dem.rio.resolution())
+    posiciones = np.array(
+        [productos.index(p) if p in productos else -1 for p in PRODUCTOS]
+    )
+    parametros = (posiciones, cx, cy, azimut, altitud, factor_z)
+
+    # Los valores sin dato pasan a NaN, que el kernel trata como vecinos
+    # inválidos (en un DEM entero, -32768 daría pendientes enormes)
+    valores = dem.astype(np.float32)
+    nodata = dem.rio.nodata
+    if nodata is not None and not np.isnan(nodata):
+        valores = valores.where(dem != nodata)
+    datos = valores.data
+    if hasattr(datos, "dask"):
+        import dask.array as da
+
+        con_halo = da.overlap.overlap(datos, depth=1, boundary=np.nan)
+        apilado = con_halo.map_blocks(
+            lambda bloque: _kernel_terreno(bloque, *parametros),
+            new_axis=0,
+            chunks=((len(productos),),) + datos.chunks,
+            dtype=np.float32,
+            meta=np.empty((0, 0, 0), dtype=np.float32),
+        )
+    else:
+        con_halo = np.pad(datos, 1, constant_values=np.nan)
+        apilado = _kernel_terreno(con_halo, *parametros)
+
+    return xr.Dataset(
+        {
+            producto: xr.DataArray(
+                apilado[k],
+                dims=dem.dims,
+                coords=dem.coords,
+                attrs={"units": UNIDADES[producto]},
+            )
+            for k, producto in enumerate(productos)
+        }
+    )
@@ -0,0 +1,285 @@
+"""Conversión de rasters categóricos a capas vectoriales.
+
+Permite entregar como polígonos las clases de cobertura de
+``01_datos_raster.py`` (por ejemplo, para un SIG), sin cargar nunca el
+raster completo ni todos sus polígonos en memoria.
+"""
+
+from __future__ import annotations
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from rasterio.features import shapes
+from rasterio.windows import Window
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from .raster_utils import LEYENDA_MAPBIOMAS, abrir_por_proceso
+
+# Lado por defecto (en píxeles) de las teselas que se poligonizan por separado
+TAMANO_TESELA = 2048
+
+# Polígonos terminados que se acumulan antes de escribirlos en el archivo
+POLIGONOS_POR_ESCRITURA = 20_000
+
+# Teselas enviadas por proceso que pueden esperar a ser consumidas
+TESELAS_EN_VUELO_POR_PROCESO = 2
+
+
+def _poligonizar_tesela(ruta, banda, ventana, nodata, clases, tolerancia):
+    """Poligoniza una tesela en coordenadas de píxel del raster completo.
+
+    Los vértices quedan en coordenadas enteras (columna, fila), de modo que
+    los bordes compartidos con las teselas vecinas coinciden exactamente y
+    se pueden disolver sin errores de redondeo. Devuelve ``(codigos,
+    geometrias, en_borde)``, donde ``en_borde`` marca los polígonos que
+    tocan un borde interior de la tesela.
+    """
+    fila0, col0, alto, ancho, alto_raster, ancho_raster = ventana
+    datos = abrir_por_proceso(ruta).read(banda, window=Window(col0, fila0, ancho, alto))
+    validos = np.ones(datos.shape, dtype=bool)
+    if nodata is not None:
+        validos &= datos != nodata
+    if clases is not None:
+        validos &= np.isin(datos, clases)
+
+    desplazamiento = rasterio.Affine.translation(col0, fila0)
+    codigos = []
+    geometrias = []
+    for geometria, valor in shapes(datos, mask=validos, transform=desplazamiento):
+        exterior, *huecos = (
+            shapely.linearrings(anillo) for anillo in geometria["coordinates"]
+        )
+        codigos.append(valor)
+        geometrias.append(shapely.polygons(exterior, holes=huecos or None))
+    codigos = np.asarray(codigos, dtype=datos.dtype)
+    geometrias = np.asarray(geometrias, dtype=object)
+
+    if tolerancia and geometrias.size:
+        # Simplifica los bordes compartidos de la misma forma en ambos lados;
+        # el contorno de la tesela no se toca para poder unirla a sus vecinas
+        geometrias = shapely.coverage_simplify(
+            geometrias, tolerancia, simplify_boundary=False
+        )
+
+    limites = shapely.bounds(geometrias).reshape(-1, 4)
+    en_borde = (
+        ((limites[:, 0] == col0) & (col0 > 0))
+        | ((limites[:, 1] == fila0) & (fila0 > 0))
+        | ((limites[:, 2] == col0 + ancho) & (col0 + ancho < ancho_raster))
+        | ((limites[:, 3] == fila0 + alto) & (fila0 + alto < alto_raster))
+    )
+    return codigos, geometrias, en_borde
+
+
+def _en_orden(ejecutor, tareas: list, en_vuelo: int):
+    """Resultados de ``tareas`` en orden, con a lo sumo ``en_vuelo`` pendientes.
+
+    A diferencia de ``ejecutor.map``, que envía todas las tareas de una vez
+    y retiene sus resultados hasta que se consumen, aquí solo se envía una
+    tesela nueva cuando se entrega el resultado de otra.
+    """
+    pendientes = deque()
+    for tarea in tareas:
+        pendientes.append(ejecutor.submit(_poligonizar_tesela, *tarea))
+        if len(pendientes) >= en_vuelo:
+            yield pendientes.popleft().result()
+    while pendientes:
+        yield pendientes.popleft().result()
+
+
+def _componentes(n: int, pares: np.ndarray) -> np.ndarray:
+    """Etiqueta de componente conexa de ``n`` nodos unidos por ``pares``.
+
+    ``pares`` tiene la forma ``(2, m)``.
+    """
+    grafo = coo_matrix((np.ones(pares.shape[1]), (pares[0], pares[1])), shape=(n, n))
+    _, componentes = connected_components(grafo, directed=False)
+    return componentes
+
+
+def _disolver(codigos: np.ndarray, geometrias: np.ndarray):
+    """Une los polígonos vecinos de la misma clase y los separa en partes.
+
+    Solo se unen los grupos de polígonos que se tocan (buscados con un
+    índice espacial), lo que evita construir una única geometría gigante por
+    clase. Los polígonos que solo se tocan en una esquina quedan como partes
+    separadas, igual que dentro de una tesela.
+    """
+    salida_codigos = []
+    salida_geometrias = []
+    for codigo in np.unique(codigos):
+        grupo = geometrias[codigos == codigo]
+        pares = shapely.STRtree(grupo).query(grupo, predicate="intersects")
+        componentes = _componentes(grupo.size, pares[:, pares[0] < pares[1]])
+        for componente in np.unique(componentes):
+            miembros = grupo[componentes == componente]
+            if miembros.size == 1:
+                partes = miembros
+            else:
+                partes = shapely.get_parts(shapely.union_all(miembros))
+            salida_codigos.append(np.full(partes.size, codigo, dtype=codigos.dtype))
+            salida_geometrias.append(partes)
+    if not salida_codigos:
+        return codigos[:0], geometrias[:0]
+    return np.concatenate(salida_codigos), np.concatenate(salida_geometrias)
+
+
+def poligonizar(
+    ruta: str,
+    salida: str,
+    banda: int = 1,
+    nodata: int | None = None,
+    clases=None,
+    leyenda: dict | None = None,
+    simplificar: float | None = None,
+    tamano_tesela: int = TAMANO_TESELA,
+    capa: str | None = None,
+    procesos: int | None = None,
+) -> dict:
+    """Convierte un raster categórico en polígonos, tesela por tesela.
+
+    Cada tesela se poligoniza en un proceso de trabajo. Los polígonos que no
+    tocan los bordes entre teselas ya están completos y se escriben de
+    inmediato en ``salida``; los que cruzan un borde se disuelven con sus
+    vecinos de la misma clase cuando termina cada fila de teselas, y se
+    escriben en cuanto dejan de tocar la fila siguiente. En memoria solo
+    queda una fila de teselas y los polígonos abiertos en su borde inferior.
+
+    Parameters
+    ----------
+    ruta : str
+        Raster categórico (por ejemplo, la cobertura de MapBiomas).
+    salida : str
+        Archivo vectorial de salida (GeoPackage, FlatGeobuf, Shapefile...).
+        Si existe, se reemplaza.
+    banda : int
+        Banda que se poligoniza.
+    nodata : int, optional
+        Código que no se poligoniza. Por defecto, el del raster.
+    clases : array-like, optional
+        Poligoniza solo estos códigos.
+    leyenda : dict, optional
+        ``{código: nombre}`` para la columna ``clase``. Por defecto, la
+        leyenda de MapBiomas.
+    simplificar : float, optional
+        Tolerancia de simplificación en unidades del CRS. La simplificación
+        preserva la topología: los bordes compartidos entre polígonos
+        vecinos se simplifican igual en ambos lados, sin huecos ni
+        traslapes.
+    tamano_tesela : int
+        Lado de las teselas en píxeles.
+    capa : str, optional
+        Nombre de la capa en formatos que admiten varias.
+    procesos : int, optional
+        Número de procesos. Por defecto, todos los núcleos; con ``1`` se
+        calcula en el proceso actual.
+
+    Returns
+    -------
+    dict
+        ``salida``, ``poligonos`` (escritos) y ``teselas`` (procesadas).
+    """
+    if leyenda is None:
+        leyenda = LEYENDA_MAPBIOMAS
+    if clases is not None:
+        clases = np.asarray(clases)
+    with rasterio.open(ruta) as src:
+        alto_raster, ancho_raster = src.height, src.width
+        transform = src.transform
+        crs = src.crs
+        if nodata is None:
+            nodata = src.nodata
+    tolerancia = simplificar / abs(transform.a) if simplificar else None
+
+    filas_teselas = range(0, alto_raster, tamano_tesela)
+    tareas = [
+        (
+            ruta,
+            banda,
+            (
+                fila0,
+                col0,
+                min(tamano_tesela, alto_raster - fila0),
+                min(tamano_tesela, ancho_raster - col0),
+                alto_raster,
+                ancho_raster,
+            ),
+            nodata,
+            clases,
+            tolerancia,
+        )
+        for fila0 in filas_teselas
+        for col0 in range(0, ancho_raster, tamano_tesela)
+    ]
+    teselas_por_fila = len(tareas) // len(filas_teselas)
+
+    if os.path.isfile(salida):
+        os.remove(salida)
+    escritos = 0
+    pendientes = []
+
+    def _escribir(codigos, geometrias, forzar=False):
+        """Acumula polígonos terminados y los escribe en lotes."""
+        nonlocal escritos, pendientes
+        if geometrias.size:
+            pendientes.append((codigos, geometrias))
+        n_pendientes = sum(g.size for _, g in pendientes)
+        if not n_pendientes or (n_pendientes < POLIGONOS_POR_ESCRITURA and not forzar):
+            return
+        codigos = np.concatenate([c for c, _ in pendientes])
+        geometrias = np.concatenate([g for _, g in pendientes])
+        pendientes = []
+        # De coordenadas de píxel (columna, fila) a coordenadas del mapa
+        geometrias = shapely.transform(
+            geometrias,
+            lambda xy: np.column_stack(transform * (xy[:, 0], xy[:, 1])),
+        )
+        capa_salida = gpd.GeoDataFrame(
+            {
+                "codigo": codigos,
+                "clase": [leyenda.get(int(c), f"Clase {c}") for c in codigos],
+            },
+            geometry=geometrias,
+            crs=crs,
+        )
+        capa_salida.to_file(salida, layer=capa, engine="pyogrio", append=escritos > 0)
+        escritos += len(capa_salida)
+
+    procesos = procesos or os.cpu_count() or 1
+    ejecutor = ProcessPoolExecutor(procesos) if procesos > 1 else None
+    try:
+        resultados = (
+            _en_orden(ejecutor, tareas, procesos * TESELAS_EN_VUELO_POR_PROCESO)
+            if ejecutor is not None
+            else (_poligonizar_tesela(*tarea) for tarea in tareas)
+        )
+        abiertos_codigos = np.empty(0, dtype=np.int64)
+        abiertos = np.empty(0, dtype=object)
+        for k, (codigos, geometrias, en_borde) in enumerate(resultados, start=1):
+            _escribir(codigos[~en_borde], geometrias[~en_borde])
+            abiertos_codigos = np.concatenate([abiertos_codigos, codigos[en_borde]])
+            abiertos = np.concatenate([abiertos, geometrias[en_borde]])
+            if k % teselas_por_fila:
+                continue
+
+            # Terminó una fila de teselas: se disuelven los polígonos abiertos
+            # y se escriben los que ya no tocan la fila siguiente
+            fila_fin = (k // teselas_por_fila) * tamano_tesela
+            abiertos_codigos, abiertos = _disolver(abiertos_codigos, abiertos)
+            siguen = shapely.bounds(abiertos).reshape(-1, 4)[:, 3] >= fila_fin
+            siguen &= fila_fin < alto_raster
+            _escribir(abiertos_codigos[~siguen], abiertos[~siguen])
+            abiertos_codigos, abiertos = abiertos_codigos[siguen], abiertos[siguen]
+        _escribir(abiertos_codigos, abiertos, forzar=True)
+    finally:
+        if ejecutor is not None:
+            ejecutor.shutdown()
+
+    return {"salida": salida, "poligonos": escritos, "teselas": len(tareas)}
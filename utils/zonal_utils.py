@@ -0,0 +1,269 @@
+"""Estadísticas zonales de rasters sobre capas de polígonos.
+
+Combina los rasters de ``notebooks/02_raster`` (por ejemplo, la cobertura de
+MapBiomas) con geometrías de Shapely o GeoPandas como las de
+``notebooks/01_vector``: comunas, cuencas, rodales, etc.
+"""
+
+from __future__ import annotations
+
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from rasterio.windows import transform as transform_ventana
+
+from .raster_utils import (
+    _combinar_estadisticas,
+    _estadisticas_bloque,
+    abrir_por_proceso,
+)
+
+# Lado (en píxeles) de las celdas que agrupan polígonos pequeños en un lote
+PIXELES_POR_LOTE = 1024
+
+def _procesar_lote(ruta, banda, ventana, elementos, nodata, categorico, todos_tocados):
+    """Calcula los parciales de los polígonos de un lote.
+
+    Lee la ventana del lote en franjas de filas y, para cada polígono, recorta
+    su propia ventana dentro de la franja y la rasteriza una sola vez.
+    ``elementos`` es una lista de ``(posicion, geometria, (fila0, col0, alto,
+    ancho))``.
+    """
+    src = abrir_por_proceso(ruta)
+    fila_lote, col_lote, alto_lote, ancho_lote = ventana
+    filas_por_franja = max(1, PIXELES_POR_LOTE**2 // max(ancho_lote, 1))
+    parciales = {}
+    histogramas = {}
+
+    for fila_franja in range(fila_lote, fila_lote + alto_lote, filas_por_franja):
+        alto_franja = min(filas_por_franja, fila_lote + alto_lote - fila_franja)
+        franja = src.read(
+            banda, window=Window(col_lote, fila_franja, ancho_lote, alto_franja)
+        )
+        for posicion, geometria, (fila0, col0, alto, ancho) in elementos:
+            inicio = max(fila0, fila_franja)
+            fin = min(fila0 + alto, fila_franja + alto_franja)
+            if inicio >= fin:
+                continue
+            sub = franja[
+                inicio - fila_franja : fin - fila_franja,
+                col0 - col_lote : col0 - col_lote + ancho,
+            ]
+            mascara = geometry_mask(
+                [geometria],
+                out_shape=sub.shape,
+                transform=transform_ventana(
+                    Window(col0, inicio, ancho, fin - inicio), src.transform
+                ),
+                invert=True,
+                all_touched=todos_tocados,
+            )
+            valores = sub[mascara]
+            parcial = _estadisticas_bloque(valores, None, nodata, 0)
+            if posicion in parciales:
+                parcial = _combinar_estadisticas(parciales[posicion], parcial)
+            parciales[posicion] = parcial
+
+            if categorico:
+                if nodata is not None:
+                    valores = valores[valores != nodata]
+                conteo = np.bincount(valores.astype(np.int64, copy=False))
+                previo = histogramas.get(posicion)
+                if previo is not None:
+                    largo = max(previo.size, conteo.size)
+                    conteo = np.pad(conteo, (0, largo - conteo.size))
+                    conteo += np.pad(previo, (0, largo - previo.size))
+                histogramas[posicion] = conteo
+
+    return [(p, parciales[p], histogramas.get(p)) for p in parciales]
+
+
+def _armar_lotes(ventanas: np.ndarray, forma_raster: tuple, lado: int) -> list:
+    """Agrupa polígonos pequeños que caen en la misma celda de ``lado`` píxeles.
+
+    Devuelve una lista de ``(ventana_lote, posiciones)``. Los polígonos cuya
+    ventana supera el lado de la celda forman un lote propio.
+    """
+    grupos = defaultdict(list)
+    lotes = []
+    for posicion, (fila0, col0, alto, ancho) in enumerate(ventanas):
+        if alto <= 0 or ancho <= 0:
+            continue
+        if alto > lado or ancho > lado:
+            lotes.append(((fila0, col0, alto, ancho), [posicion]))
+        else:
+            grupos[(fila0 // lado, col0 // lado)].append(posicion)
+
+    alto_raster, ancho_raster = forma_raster
+    for posiciones in grupos.values():
+        sel = ventanas[posiciones]
+        fila0, col0 = sel[:, 0].min(), sel[:, 1].min()
+        fila1 = min(alto_raster, (sel[:, 0] + sel[:, 2]).max())
+        col1 = min(ancho_raster, (sel[:, 1] + sel[:, 3]).max())
+        lotes.append(((fila0, col0, fila1 - fila0, col1 - col0), posiciones))
+    return lotes
+
+
+def _ventanas_pixeles(geometrias: np.ndarray, src) -> np.ndarray:
+    """Ventana ``(fila0, col0, alto, ancho)`` bajo la caja envolvente de cada polígono."""
+    limites = shapely.bounds(geometrias)
+    inversa = ~src.transform
+    cols_a, filas_a = inversa * (limites[:, 0], limites[:, 3])
+    cols_b, filas_b = inversa * (limites[:, 2], limites[:, 1])
+    fila0 = np.floor(np.minimum(filas_a, filas_b))
+    fila1 = np.ceil(np.maximum(filas_a, filas_b))
+    col0 = np.floor(np.minimum(cols_a, cols_b))
+    col1 = np.ceil(np.maximum(cols_a, cols_b))
+
+    vacias = np.isnan(fila0)
+    fila0 = np.clip(np.nan_to_num(fila0), 0, src.height)
+    fila1 = np.clip(np.nan_to_num(fila1), 0, src.height)
+    col0 = np.clip(np.nan_to_num(col0), 0, src.width)
+    col1 = np.clip(np.nan_to_num(col1), 0, src.width)
+    ventanas = np.stack([fila0, col0, fila1 - fila0, col1 - col0], axis=1)
+    ventanas[vacias] = 0
+    return ventanas.astype(np.int64)
+
+
+def estadisticas_zonales(
+    ruta: str,
+    poligonos,
+    categorico: bool = False,
+    leyenda: dict | None = None,
+    nodata: float | None = None,
+    banda: int = 1,
+    todos_tocados: bool = False,
+    procesos: int | None = None,
+) -> pd.DataFrame:
+    """Calcula estadísticas de un raster dentro de cada polígono de una capa.
+
+    En lugar de recortar el raster una vez por polígono, se lee solo la
+    ventana bajo la caja envolvente de cada polígono y su máscara se
+    rasteriza una sola vez a la resolución del raster. Los polígonos
+    pequeños que comparten una misma zona del raster se agrupan en lotes que
+    leen esa zona una sola vez, y los lotes se reparten entre procesos, lo
+    que permite trabajar con capas de más de 100 000 polígonos.
+
+    Parameters
+    ----------
+    ruta : str
+        Ruta del raster (cada proceso abre su propia conexión).
+    poligonos : geopandas.GeoDataFrame, geopandas.GeoSeries or list
+        Polígonos de Shapely. Si tienen CRS se reproyectan al del raster.
+    categorico : bool
+        Si es ``True`` se agrega la fracción de cada clase dentro del
+        polígono (composición de cobertura).
+    leyenda : dict, optional
+        ``{código: nombre}`` para nombrar las columnas de clases.
+    nodata : float, optional
+        Valor sin dato. Por defecto, el del raster.
+    banda : int
+        Banda del raster que se analiza.
+    todos_tocados : bool
+        Incluye todos los píxeles que toca el polígono, no solo aquellos
+        cuyo centro está dentro (``all_touched`` de rasterio).
+    procesos : int, optional
+        Número de procesos. Por defecto, todos los núcleos; con ``1`` se
+        calcula en el proceso actual.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Una fila por polígono (mismo índice que ``poligonos``) con
+        ``conteo``, ``nodata``, ``minimo``, ``maximo``, ``media`` y
+        ``desviacion`` y, si ``categorico``, una columna por clase con la
+        fracción de píxeles válidos.
+    """
+    with rasterio.open(ruta) as src:
+        return _estadisticas_zonales(
+            src,
+            ruta,
+            poligonos,
+            categorico,
+            leyenda,
+            src.nodata if nodata is None else nodata,
+            banda,
+            todos_tocados,
+            procesos,
+        )
+
+
+def _estadisticas_zonales(
+    src, ruta, poligonos, categorico, leyenda, nodata, banda, todos_tocados, procesos
+) -> pd.DataFrame:
+    """Implementación de :func:`estadisticas_zonales` con el raster ya abierto."""
+    if isinstance(poligonos, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        if poligonos.crs is not None and src.crs is not None:
+            poligonos = poligonos.to_crs(src.crs)
+        indice = poligonos.index
+        geometrias = np.asarray(poligonos.geometry.values, dtype=object)
+    else:
+        geometrias = np.asarray(list(poligonos), dtype=object)
+        indice = pd.RangeIndex(len(geometrias))
+
+    ventanas = _ventanas_pixeles(geometrias, src)
+    lotes = _armar_lotes(ventanas, (src.height, src.width), PIXELES_POR_LOTE)
+    tareas = [
+        (
+            ruta,
+            banda,
+            ventana,
+            [(p, geometrias[p], tuple(ventanas[p])) for p in posiciones],
+            nodata,
+            categorico,
+            todos_tocados,
+        )
+        for ventana, posiciones in lotes
+    ]
+
+    procesos = procesos or os.cpu_count() or 1
+    if procesos == 1 or len(tareas) <= 1:
+        resultados = [_procesar_lote(*tarea) for tarea in tareas]
+    else:
+        with ProcessPoolExecutor(max_workers=procesos) as ejecutor:
+            resultados = list(
+                ejecutor.map(_procesar_lote, *zip(*tareas), chunksize=4)
+            )
+
+    filas = [{"conteo": 0, "nodata": 0} for _ in range(len(geometrias))]
+    histogramas = {}
+    for resultado in resultados:
+        for posicion, parcial, histograma in resultado:
+            n = parcial["conteo"]
+            varianza = parcial["m2"] / n if n else np.nan
+            filas[posicion] = {
+                "conteo": n,
+                "nodata": parcial["nodata"],
+                "minimo": parcial["minimo"] if n else np.nan,
+                "maximo": parcial["maximo"] if n else np.nan,
+                "media": parcial["media"] if n else np.nan,
+                "desviacion": np.sqrt(varianza),
+            }
+            if histograma is not None:
+                histogramas[posicion] = histograma
+
+    tabla = pd.DataFrame(
+        filas,
+        index=indice,
+        columns=["conteo", "nodata", "minimo", "maximo", "media", "desviacion"],
+    )
+    if categorico:
+        largo = max((h.size for h in histogramas.values()), default=0)
+        conteos = np.zeros((len(geometrias), largo), dtype=np.int64)
+        for posicion, histograma in histogramas.items():
+            conteos[posicion, : histograma.size] = histograma
+        codigos = np.flatnonzero(conteos.sum(axis=0))
+        totales = conteos[:, codigos].sum(axis=1, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fracciones = conteos[:, codigos] / totales
+        nombres = [(leyenda or {}).get(int(c), int(c)) for c in codigos]
+        tabla = tabla.join(pd.DataFrame(fracciones, index=indice, columns=nombres))
+    return tabla